@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of request parsing with Connection.
+
+Counts the recv() calls and the time needed for parsing a set of typical
+mifcho requests, with the buffered Connection and with the former
+byte-at-a-time reader.
+
+  python benchmarks/connection_syscalls.py [iterations]
+"""
+import socket
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.connection import Connection
+import mifcholib.messages as messages
+
+REQUESTS = {
+  'hobs_poll': (
+    "GET /hobs/session/1234567890 HTTP/1.1\r\n"
+    "Host: mifcho.example.org:8000\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/3.6\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    "Accept-Language: en-us,en;q=0.5\r\n"
+    "Accept-Encoding: gzip,deflate\r\n"
+    "Connection: keep-alive\r\n"
+    "\r\n"
+  ),
+  'hobs_send': (
+    "POST /hobs/session/1234567890/2 HTTP/1.1\r\n"
+    "Host: mifcho.example.org:8000\r\n"
+    "Content-Type: text/plain\r\n"
+    "Content-Length: 64\r\n"
+    "\r\n" + "A"*64
+  ),
+  'peer_handshake': (
+    "POST /mifcho/handshake/ HTTP/1.1\r\n"
+    "Host: localhost:8080\r\n"
+    "Upgrade: mifcho-reverse/0.1\r\n"
+    "Connection: Upgrade\r\n"
+    "X-Mifcho-Id: 2222\r\n"
+    "\r\n"
+  ),
+  'tunnel_request': (
+    "POST /mifcho/tunnel_request HTTP/1.1\r\n"
+    "Host: localhost:8080\r\n"
+    "X-Mifcho-Id: 2222\r\n"
+    "X-Mifcho-Tunnel-Id: 6f1c7a2e-d6f1-11df-9d3a-001e4fd1a2b3\r\n"
+    "X-Mifcho-Tunnel-EndpointHost: localhost\r\n"
+    "X-Mifcho-Tunnel-EndpointPort: 5900\r\n"
+    "\r\n"
+  )
+}
+
+class CountingSocket:
+    """Socket proxy counting the calls to recv()."""
+
+    def __init__(self, s):
+        self.s      = s
+        self.recvs  = 0
+
+    def recv(self, length):
+        self.recvs += 1
+        return self.s.recv(length)
+
+class ByteConnection(Connection):
+    """The reader Connection used before buffering, one recv() per byte."""
+
+    def readline(self, term='\r\n'):
+
+        line = ''
+        while not line.endswith(term):
+            c = self.s.recv(1)
+            if not c:
+                break
+            line += c
+
+        return line
+
+    def read_bytes(self, bytes_to_read):
+
+        data = ''
+        while len(data) < bytes_to_read:
+            chunk = self.s.recv(bytes_to_read-len(data))
+            if not chunk:
+                break
+            data += chunk
+
+        return data
+
+def parse(conn_cls, raw, iterations):
+    """Parse 'raw' 'iterations' times, returns (recv-calls per request, usec per request)."""
+
+    (a, b) = socket.socketpair()
+    counter = CountingSocket(b)
+    conn    = conn_cls(counter)
+
+    elapsed = 0.0
+    for _ in xrange(iterations):
+
+        a.sendall(raw)
+
+        begin = time.time()
+        (method, uri, version, headers) = messages.get_request(conn)
+        length = int(dict(headers).get('Content-Length', 0))
+        if length:
+            conn.read_bytes(length)
+        elapsed += time.time() - begin
+
+    a.close()
+    b.close()
+
+    return (counter.recvs / float(iterations), elapsed / iterations * 1e6)
+
+def main():
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    print '%-16s %8s   %-22s %-22s' % ('', '', 'byte-at-a-time', 'buffered')
+    print '%-16s %8s %12s %10s %12s %10s' % (
+        'request', 'bytes', 'recv()', 'usec', 'recv()', 'usec'
+    )
+    for name in sorted(REQUESTS):
+
+        raw = REQUESTS[name]
+        (old_recvs, old_usec) = parse(ByteConnection, raw, iterations)
+        (new_recvs, new_usec) = parse(Connection, raw, iterations)
+
+        print '%-16s %8d %12.1f %10.1f %12.1f %10.1f' % (
+            name, len(raw), old_recvs, old_usec, new_recvs, new_usec
+        )
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+Connection-rate and request-rate of a Listener and its HTTPDispatcher.
+
+A ConnectionManager runs in this process with a plain and a tls:// bind,
+both routing /admin to the ManagementHandler and /static to a
+StaticWebHandler serving a generated file, any other path is a 404 of
+the dispatcher. Concurrent clients connect, send their requests and
+close, for a number of seconds, one case per bind and target.
+
+Reported per case, as JSON:
+
+  connections_per_s   Connections served, each sends --requests requests
+  requests_per_s
+  latency_ms          p50, p90 and p99 from sending a request until the
+                      whole response, connecting included for the first
+  stages              Count, mean, p50 and p99 in microseconds of where
+                      the server spends the time:
+
+    accept              accept until dispatch, the TLS handshake and
+                        reading the request-head on a reactor included
+    tls_handshake       accept until the TLS handshake is done
+    get_request_line    messages.get_request_line
+    get_headers         messages.get_headers
+    routing             RoutingIndex.lookup
+    order               WorkerPool.order
+    dispatch            all of HTTPDispatcher.dispatch
+
+The stages are timed by wrapping the functions of this process, which
+costs a little of its own.
+
+  python benchmarks/http_rate.py [--clients 32] [--requests 1] [--seconds 5]
+                                 [--runtime threads|reactor]
+"""
+from optparse import OptionParser
+import threading
+import tempfile
+import logging
+import socket
+import json
+import time
+import ssl
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import loopback
+
+import mifcholib.messages as messages
+from mifcholib.dispatchers import HTTPDispatcher
+from mifcholib.listener import Incoming
+from mifcholib.routing import RoutingIndex
+from mifcholib.threadutils import WorkerPool
+
+TARGETS = {
+    'admin':    '/admin',
+    'static':   '/static/index.html',
+    'missing':  '/missing'
+}
+
+class Stages:
+    """Durations of the stages, appended by the wrapped functions."""
+
+    def __init__(self):
+        self.durations = dict((stage, []) for stage in [
+            'accept', 'tls_handshake', 'get_request_line', 'get_headers', 'routing', 'order', 'dispatch'
+        ])
+
+    def reset(self):
+        for durations in self.durations.values():
+            del durations[:]                # The wrappers hold on to the lists
+
+    def timed(self, owner, name, stage):
+        """Replaces owner.name with a function timing each call."""
+
+        original    = getattr(owner, name)
+        durations   = self.durations[stage]
+
+        def wrapper(*args, **kwargs):
+            begin = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                durations.append(time.time() - begin)
+
+        setattr(owner, name, wrapper)
+
+    def install(self):
+
+        self.timed(messages, 'get_request_line', 'get_request_line')
+        self.timed(messages, 'get_headers', 'get_headers')
+        self.timed(RoutingIndex, 'lookup', 'routing')
+        self.timed(WorkerPool, 'order', 'order')
+        self.timed(HTTPDispatcher, 'dispatch', 'dispatch')
+
+        accept      = self.durations['accept']
+        handshakes  = self.durations['tls_handshake']
+        dispatch    = Incoming.dispatch
+        handshake   = Incoming._handshake
+
+        def timed_dispatch(incoming):
+            if incoming.accepted:           # Not a persistent connection
+                accept.append(time.time() - incoming.accepted)
+            return dispatch(incoming)
+
+        def timed_handshake(incoming):
+            handshake(incoming)
+            if incoming.handshaken and incoming.accepted:
+                handshakes.append(time.time() - incoming.accepted)
+
+        Incoming.dispatch   = timed_dispatch
+        Incoming._handshake = timed_handshake
+
+    def report(self):
+
+        report = {}
+        for (stage, durations) in self.durations.items():
+            durations = sorted(durations)
+            report[stage] = {
+                'count':    len(durations),
+                'mean_us':  sum(durations) / len(durations) * 1e6 if durations else None,
+                'p50_us':   loopback.percentile(durations, 50) * 1e6 if durations else None,
+                'p99_us':   loopback.percentile(durations, 99) * 1e6 if durations else None
+            }
+
+        return report
+
+def read_response(conn, buff):
+    """Reads a response with a Content-Length, returns what was read beyond it."""
+
+    while '\r\n\r\n' not in buff:
+        data = conn.recv(65536)
+        if not data:
+            raise socket.error('Connection closed.')
+        buff += data
+
+    (head, buff) = buff.split('\r\n\r\n', 1)
+    length = 0
+    for line in head.split('\r\n')[1:]:
+        (name, value) = line.split(':', 1)
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+
+    while len(buff) < length:
+        data = conn.recv(65536)
+        if not data:
+            raise socket.error('Connection closed.')
+        buff += data
+
+    return buff[length:]
+
+def client(port, use_tls, path, requests, deadline, started, results):
+
+    latencies   = []
+    connections = 0
+    errors      = 0
+
+    started.wait()
+    while time.time() < deadline:
+
+        conn = None
+        try:
+            begin = time.time()
+            conn = socket.create_connection(('127.0.0.1', port))
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if use_tls:
+                conn = ssl.wrap_socket(conn)
+
+            buff = ''
+            for i in xrange(requests):
+                conn.sendall('GET %s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: %s\r\n\r\n' % (
+                    path, 'close' if i == requests - 1 else 'keep-alive'
+                ))
+                buff = read_response(conn, buff)
+                latencies.append(time.time() - begin)
+                begin = time.time()
+
+            connections += 1
+
+        except (socket.error, ssl.SSLError):
+            errors += 1
+
+        if conn:
+            conn.close()
+
+    results.append((latencies, connections, errors))
+
+def load(pipe):
+    """
+    Child process, runs a case for every (port, use_tls, path, clients,
+    requests, seconds) received and answers with what the clients measured.
+    """
+
+    while True:
+        (port, use_tls, path, clients, requests, seconds) = pipe.recv()
+
+        started     = threading.Event()
+        results     = []
+        deadline    = time.time() + seconds
+        threads     = [
+            threading.Thread(target=client, args=(port, use_tls, path, requests, deadline, started, results))
+            for i in xrange(clients)
+        ]
+        for t in threads:
+            t.start()
+        begin = time.time()
+        started.set()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - begin
+
+        latencies   = sorted(l for (r, c, e) in results for l in r)
+        connections = sum(c for (r, c, e) in results)
+        pipe.send({
+            'connections':          connections,
+            'requests':             len(latencies),
+            'errors':               sum(e for (r, c, e) in results),
+            'seconds':              elapsed,
+            'connections_per_s':    connections / elapsed,
+            'requests_per_s':       len(latencies) / elapsed,
+            'latency_ms':           dict(
+                ('p%d' % q, loopback.percentile(latencies, q) * 1000 if latencies else None)
+                for q in (50, 90, 99)
+            )
+        })
+
+def main():
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--clients', type='int', default=32, help='Concurrent clients.')
+    parser.add_option('--requests', type='int', default=1, help='Requests per connection.')
+    parser.add_option('--seconds', type='float', default=5, help='Duration of each case.')
+    parser.add_option('--targets', default='admin,static,missing', help='Of %s.' % ', '.join(sorted(TARGETS)))
+    parser.add_option('--binds', default='tcp,tls', help='Schemes of the binds, tcp and tls.')
+    parser.add_option('--static-size', dest='static_size', type='int', default=4096, help='Bytes of the static file.')
+    parser.add_option('--runtime', default='threads', help='Runtime, threads or reactor.')
+    parser.add_option('--workers', default='10', help='Workers of each handler.')
+    parser.add_option('--output', help='File for the JSON, default stdout.')
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    docroot = tempfile.mkdtemp(prefix='mifcho-bench-')
+    with open(os.path.join(docroot, 'index.html'), 'wb') as static:
+        static.write('x' * options.static_size)
+
+    load_pipe = loopback.spawn(load)        # Forked before any thread is started
+
+    stages = Stages()
+    stages.install()
+
+    ports = dict((scheme, loopback.free_port()) for scheme in options.binds.split(','))
+    loopback.start(
+        'bench', [(scheme, port) for (scheme, port) in ports.items()],
+        '\n'.join(
+            '%d http /admin ManagementHandler\n%d http /static StaticWebHandler' % (port, port)
+            for port in ports.values()
+        ),
+        runtime=options.runtime,
+        keepalive_requests=max(100, options.requests),
+        handler_params={
+            'ManagementHandler':    {'workers': options.workers},
+            'StaticWebHandler':     {'workers': options.workers, 'path_prefix': docroot}
+        }
+    )
+    time.sleep(0.5)                         # Listeners are up
+
+    cases = []
+    for (scheme, port) in sorted(ports.items()):
+        for target in options.targets.split(','):
+            stages.reset()
+            load_pipe.send((port, scheme == 'tls', TARGETS[target], options.clients, options.requests, options.seconds))
+            result = load_pipe.recv()
+            time.sleep(0.2)                 # Workers finish their last jobs
+
+            result.update({'bind': scheme, 'target': target, 'stages': stages.report()})
+            cases.append(result)
+            print >> sys.stderr, '%-4s %-8s %9.1f conn/s %9.1f req/s  p99 %8.3f ms' % (
+                scheme, target, result['connections_per_s'], result['requests_per_s'],
+                result['latency_ms']['p99'] or 0
+            )
+
+    report = json.dumps({
+        'runtime':  options.runtime,
+        'clients':  options.clients,
+        'requests': options.requests,
+        'seconds':  options.seconds,
+        'cases':    cases
+    }, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print report
+
+    loopback.reap()
+    os._exit(0)                             # The ConnectionManager does not stop on its own
+
+if __name__ == "__main__":
+    sys.exit(main())
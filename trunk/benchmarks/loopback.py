@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Helpers of the loopback benchmarks, running ConnectionManagers in-process
+with a generated orchestration and sampling what the process spends.
+
+Load is generated in child processes forked before any ConnectionManager
+is started, so the CPU-time of this process is mifcho's own.
+"""
+import multiprocessing
+import threading
+import resource
+import socket
+import time
+import sys
+import os
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+children = []                               # Processes of spawn(), see reap()
+
+sys.path.insert(0, ROOT)
+
+from mifcholib.cm import ConnectionManager
+from mifcholib.peer_info import PeerInfo
+from mifcholib.utils import ORCHESTRATION_REGEX
+
+class Options:
+    """What the mifcho script parses, for a ConnectionManager on 127.0.0.1."""
+
+    def __init__(self, identifier, binds, orchestration, peers=(), **options):
+
+        self.id             = identifier
+        self.bind_addresses = [
+            {'scheme': scheme, 'hostname': '127.0.0.1', 'port': port, 'path': ''}
+            for (scheme, port) in binds
+        ]
+        self.orchestration  = [m.groupdict() for m in ORCHESTRATION_REGEX.finditer(orchestration)]
+        self.handler_params = options.pop('handler_params', {})
+        self.peers          = [PeerInfo(None, None, ('127.0.0.1', port, path, False)) for (port, path) in peers]
+
+        for (name, value) in options.items():
+            setattr(self, name, value)
+
+def free_port():
+    """A port nobody listens on, right now."""
+
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+def start(identifier, binds, orchestration, peers=(), **options):
+    """Starts a ConnectionManager, certificates are found relative to ROOT."""
+
+    os.chdir(ROOT)
+
+    cm = ConnectionManager(Options(identifier, binds, orchestration, peers, **options))
+    cm.daemon = True
+    cm.start()
+
+    return cm
+
+def wait_for_peer(cm, peer_id, timeout=10):
+
+    deadline = time.time() + timeout
+    while not cm.get_peer(peer_id):
+        if time.time() > deadline:
+            raise RuntimeError('%s did not connect to %s.' % (cm.identifier, peer_id))
+        time.sleep(0.1)
+
+def spawn(target, *args):
+    """
+    Runs target(connection, *args) in a child process, returns the parent
+    end of a pipe to it.
+    """
+
+    (parent, child) = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=target, args=(child,) + args)
+    process.daemon = True
+    process.start()
+    children.append(process)
+
+    return parent
+
+def reap(timeout=5):
+    """
+    Terminates and joins the children of spawn(), before os._exit() which
+    skips what multiprocessing does for them on exit.
+    """
+
+    while children:
+        process = children.pop()
+        process.terminate()
+        process.join(timeout)
+
+def rss():
+    """Resident set size of this process in kB."""
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:                         # Not Linux, the peak will have to do
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def sample():
+    """Threads, RSS and CPU-seconds of this process."""
+
+    (user, system) = os.times()[:2]
+
+    return {'threads': threading.active_count(), 'rss': rss(), 'cpu': user + system}
+
+def percentile(values, q):
+    """Nearest-rank percentile of sorted values."""
+
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of routing a request path to a handler.
+
+Compares the former linear first-match scan of the handlers of a port with
+the RoutingIndex, uncached and with the LRU, for an increasing amount of
+routes per port.
+
+  python benchmarks/routing.py [lookups]
+"""
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.routing import RoutingIndex
+
+def make_routes(count):
+    """Routes shaped like the orchestration of a busy port."""
+
+    routes = ['/hobs', '/mifcho', '/static', '/admin', '/ws']
+    for i in xrange(count - len(routes)):
+        routes.append('/app%03d/%s' % (i, ['api', 'static', 'ws'][i % 3]))
+
+    return [{'criteria': r, 'instance': r, 'params': None} for r in routes]
+
+def make_paths(routes, count, distinct):
+    """Request paths hitting random routes, 'distinct' different ones."""
+
+    rand    = random.Random(42)
+    pool    = [
+        rand.choice(routes)['criteria'] + '/session/%d' % rand.randint(0, 10**9)
+        for _ in xrange(distinct)
+    ]
+    return [rand.choice(pool) for _ in xrange(count)]
+
+def linear(handlers, path):
+    """The lookup of HTTPDispatcher before the RoutingIndex."""
+
+    for handler_d in handlers:
+        criteria = handler_d['criteria']
+        if path[:len(criteria)] == criteria:
+            return handler_d
+
+def measure(fun, paths):
+    """Microseconds per lookup."""
+
+    begin = time.time()
+    for path in paths:
+        fun(path)
+
+    return (time.time() - begin) / len(paths) * 1e6
+
+def main():
+
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    print '%8s %12s %12s %12s' % ('routes', 'linear', 'trie', 'trie+lru')
+    print '%8s %12s %12s %12s' % ('', 'usec', 'usec', 'usec')
+    for count in (5, 10, 50, 100, 200, 500):
+
+        routes  = make_routes(count)
+        paths   = make_paths(routes, lookups, 512)
+
+        uncached = RoutingIndex(routes, cache_size=0)
+        cached   = RoutingIndex(routes)
+
+        for path in paths[:1000]:                   # Same answers as before
+            assert linear(routes, path) is cached.lookup(path)
+
+        print '%8d %12.2f %12.2f %12.2f' % (
+            count,
+            measure(lambda p: linear(routes, p), paths),
+            measure(uncached._walk, paths),
+            measure(cached.lookup, paths)
+        )
+
+if __name__ == "__main__":
+    sys.exit(main())
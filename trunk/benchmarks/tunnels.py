@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Throughput and latency of TCPTunnelingHandler routes over loopback.
+
+Two ConnectionManagers run in this process, A and its peer B. A forwards
+one port directly to an echo server and another via B, the baseline
+connects to the echo server itself. For every route, amount of concurrent
+connections and message size, the clients send a message and wait for it
+to be echoed back, for a number of seconds.
+
+Reported per case, as JSON:
+
+  mb_per_s            Echoed payload, one direction, in MB/s
+  rtt_ms              p50 and p99 of the round-trips
+  cpu_s_per_gb        CPU-seconds of this process per GB relayed, both
+                      directions counted
+  threads_per_tunnel  Threads, and kB of RSS, added per open tunnel
+  rss_kb_per_tunnel
+
+  python benchmarks/tunnels.py [--connections 1,8,32] [--sizes 64,4096,65536]
+                               [--seconds 5] [--runtime threads|reactor]
+"""
+from optparse import OptionParser
+import threading
+import logging
+import socket
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import loopback
+
+ROUTES = ['baseline', 'direct', 'via']
+
+def echo(pipe):
+    """Child process, echoes whatever it receives."""
+
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', 0))
+    server.listen(128)
+    pipe.send(server.getsockname()[1])
+
+    def serve(conn):
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    while True:
+        (conn, address) = server.accept()
+        t = threading.Thread(target=serve, args=(conn,))
+        t.daemon = True
+        t.start()
+
+def client(port, size, deadline, started, results):
+
+    message = os.urandom(size)
+    rtts    = []
+    errors  = 0
+    conn    = None
+
+    try:
+        conn = socket.create_connection(('127.0.0.1', port))
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        started.wait()
+
+        while time.time() < deadline:
+            begin = time.time()
+            conn.sendall(message)
+            left = size
+            while left:
+                data = conn.recv(min(left, 65536))
+                if not data:
+                    raise socket.error('Tunnel closed.')
+                left -= len(data)
+            rtts.append(time.time() - begin)
+
+    except socket.error:
+        errors += 1
+
+    if conn:
+        conn.close()
+
+    results.append((rtts, errors))
+
+def load(pipe):
+    """
+    Child process, runs a case for every (port, connections, size, seconds)
+    received and answers with what the clients measured.
+    """
+
+    while True:
+        (port, connections, size, seconds) = pipe.recv()
+
+        started     = threading.Event()
+        results     = []
+        deadline    = time.time() + seconds + 1
+        clients     = [
+            threading.Thread(target=client, args=(port, size, deadline, started, results))
+            for i in xrange(connections)
+        ]
+        for t in clients:
+            t.start()
+        time.sleep(1)                       # Every tunnel is set up
+        begin = time.time()
+        started.set()
+        for t in clients:
+            t.join()
+        elapsed = time.time() - begin
+
+        rtts = sorted(rtt for (r, e) in results for rtt in r)
+        pipe.send({
+            'messages': len(rtts),
+            'bytes':    len(rtts) * size,
+            'seconds':  elapsed,
+            'errors':   sum(e for (r, e) in results),
+            'rtt_ms':   {
+                'p50':  loopback.percentile(rtts, 50) * 1000 if rtts else None,
+                'p99':  loopback.percentile(rtts, 99) * 1000 if rtts else None
+            }
+        })
+
+def case(pipe, route, port, connections, size, seconds):
+
+    before = loopback.sample()
+    pipe.send((port, connections, size, seconds))
+    time.sleep(1 + seconds / 2.0)           # Tunnels are open and busy
+    during = loopback.sample()
+    result = pipe.recv()
+    after  = loopback.sample()
+
+    relayed = 2 * result['bytes']
+
+    result.update({
+        'route':                route,
+        'connections':          connections,
+        'size':                 size,
+        'mb_per_s':             result['bytes'] / result['seconds'] / 1e6,
+        'cpu_s_per_gb':         (after['cpu'] - before['cpu']) / (relayed / 1e9) if relayed else None,
+        'threads_per_tunnel':   float(during['threads'] - before['threads']) / connections,
+        'rss_kb_per_tunnel':    float(during['rss'] - before['rss']) / connections
+    })
+
+    return result
+
+def main():
+
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--connections', default='1,8,32', help='Concurrent tunnels, comma-separated.')
+    parser.add_option('--sizes', default='64,4096,65536', help='Message sizes, comma-separated.')
+    parser.add_option('--seconds', type='float', default=5, help='Duration of each case.')
+    parser.add_option('--routes', default=','.join(ROUTES), help='Of %s.' % ', '.join(ROUTES))
+    parser.add_option('--runtime', default='threads', help='Piper runtime, threads or reactor.')
+    parser.add_option('--compression', action='store_true', default=False, help='Deflate the tunnel via B.')
+    parser.add_option('--workers', default='64', help='Workers of the TCPTunnelingHandler.')
+    parser.add_option('--output', help='File for the JSON, default stdout.')
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    echo_pipe   = loopback.spawn(echo)      # Forked before any thread is started
+    load_pipe   = loopback.spawn(load)
+    echo_port   = echo_pipe.recv()
+
+    (peer_port, direct_port, via_port) = [loopback.free_port() for i in xrange(3)]
+    params = {'TCPTunnelingHandler': {'workers': options.workers}}
+
+    loopback.start(
+        'B', [('tcp', peer_port)],
+        '%d http /mifcho PeerHandler' % peer_port,
+        runtime=options.runtime, compression=options.compression, handler_params=params
+    )
+    a = loopback.start(
+        'A', [('tcp', direct_port), ('tcp', via_port)],
+        '\n'.join([
+            '%d tcp /None TCPTunnelingHandler forward to 127.0.0.1:%d' % (direct_port, echo_port),
+            '%d tcp /None TCPTunnelingHandler forward to 127.0.0.1:%d via B' % (via_port, echo_port)
+        ]),
+        peers=[(peer_port, '/mifcho')],
+        runtime=options.runtime, compression=options.compression, handler_params=params
+    )
+    loopback.wait_for_peer(a, 'B')
+
+    ports = {'baseline': echo_port, 'direct': direct_port, 'via': via_port}
+
+    cases = []
+    for route in options.routes.split(','):
+        for connections in [int(c) for c in options.connections.split(',')]:
+            for size in [int(s) for s in options.sizes.split(',')]:
+                result = case(load_pipe, route, ports[route], connections, size, options.seconds)
+                cases.append(result)
+                print >> sys.stderr, '%-8s %4d x %6d B %10.2f MB/s  p99 %8.3f ms' % (
+                    route, connections, size, result['mb_per_s'], result['rtt_ms']['p99'] or 0
+                )
+                time.sleep(0.5)             # Pipes of the case are torn down
+
+    report = json.dumps({
+        'runtime':      options.runtime,
+        'compression':  options.compression,
+        'seconds':      options.seconds,
+        'cases':        cases
+    }, indent=2, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print report
+
+    loopback.reap()
+    os._exit(0)                             # The ConnectionManagers do not stop on their own
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+Accounting - traffic and latency of every pipe.
+
+Each direction of a pipe counts what it moves in plain attributes, which
+only the thread or reactor moving its bytes writes to. A single thread
+samples them periodically into rates, per pipe and aggregated per route
+and per peer, and keeps a rolling history of the aggregated rates.
+"""
+import collections
+import threading
+import time
+
+import mifcholib.metrics as metrics
+from mifcholib.threadutils import Worker
+
+DIRECTIONS = ('source_to_sink', 'sink_to_source')
+
+TUNNELS = metrics.gauge(
+    'mifcho_tunnels',
+    'Pipes running, per peer they go through.',
+    ('peer',)
+)
+PIPE_BYTES = metrics.counter(
+    'mifcho_pipe_bytes_total',
+    'Bytes piped, per peer and direction, added when the pipes are sampled.',
+    ('peer', 'direction')
+)
+
+def route_name(address):
+    """Name of the route to an endpoint-address."""
+    return '%s:%d' % (address[0], int(address[1]))
+
+class FlowStats:
+    """Counters of one direction of a pipe."""
+
+    def __init__(self, started):
+
+        self.started    = started
+        self.bytes      = 0
+        self.messages   = 0             # Reads
+        self.buffered   = 0             # Bytes read but not yet written
+        self.spooled    = 0             # Bytes spooled while the sink recovers
+        self.first      = None          # Seconds from the start of the pipe until the first read
+        self.last       = None          # Time of the last read
+
+        self.sampled    = 0             # Bytes at the last sample
+        self.rate       = 0.0           # Bytes per second since the previous sample
+
+    def record(self, nbytes, buffered):
+        """Called after every read, with the bytes read and still buffered."""
+
+        now = time.time()
+        if self.first is None:
+            self.first = now - self.started
+
+        self.bytes      += nbytes
+        self.messages   += 1
+        self.buffered   = buffered
+        self.last       = now
+
+    def report(self):
+
+        return {
+            'bytes':    self.bytes,
+            'messages': self.messages,
+            'buffered': self.buffered,
+            'spooled':  self.spooled,
+            'rate':     self.rate
+        }
+
+class PipeStats:
+    """Counters of a pipe, one FlowStats per direction."""
+
+    def __init__(self, route=None, peer=None):
+
+        self.route      = route or 'unknown'
+        self.peer       = peer or 'direct'
+        self.started    = time.time()
+
+        self.source_to_sink = FlowStats(self.started)
+        self.sink_to_source = FlowStats(self.started)
+
+        self.compression    = None      # DeflateConnection of a compressed tunnel
+
+    def last_activity(self):
+        return max(self.source_to_sink.last, self.sink_to_source.last, self.started)
+
+    def report(self, now):
+
+        return {
+            'route':            self.route,
+            'peer':             self.peer,
+            'age':              now - self.started,
+            'idle':             now - self.last_activity(),
+            'ttfb':             self.sink_to_source.first,
+            'source_to_sink':   self.source_to_sink.report(),
+            'sink_to_source':   self.sink_to_source.report(),
+            'compression':      self.compression.report() if self.compression else None
+        }
+
+def _aggregate():
+    return {
+        'pipes':            0,
+        'closed':           0,
+        'source_to_sink':   {'bytes': 0, 'messages': 0, 'buffered': 0, 'rate': 0.0},
+        'sink_to_source':   {'bytes': 0, 'messages': 0, 'buffered': 0, 'rate': 0.0}
+    }
+
+class Traffic(Worker):
+    """
+    The pipes of a connection-manager, sampled each 'interval' seconds.
+
+    Aggregates are keyed by ('routes', route) and ('peers', peer), closed
+    pipes are folded into them so totals survive the pipes.
+    """
+
+    def __init__(self, interval=1, history=300):
+
+        self.interval   = interval
+
+        self.lock       = threading.Lock()
+        self.live       = set()                 # PipeStats of running pipes
+        self.closed     = {}                    # key ---> aggregate of closed pipes
+        self.history    = {}                    # key ---> deque of (stamp, rate, rate)
+        self.history_size = history
+
+        self.sampled    = {}                    # key ---> (bytes, bytes) at the last sample
+        self.stamp      = time.time()           # Time of the last sample
+
+        self.cond       = threading.Condition()
+
+        Worker.__init__(self, 'Traffic')
+
+    def open(self, stats):
+
+        self.lock.acquire()
+        self.live.add(stats)
+        self.lock.release()
+
+        TUNNELS.inc(labels=(stats.peer,))
+
+    def close(self, stats):
+        """Fold the counters of a finished pipe into the aggregates."""
+
+        self.lock.acquire()
+        if stats in self.live:
+            self.live.remove(stats)
+            for key in (('routes', stats.route), ('peers', stats.peer)):
+                agg = self.closed.setdefault(key, _aggregate())
+                agg['closed'] += 1
+                for direction in DIRECTIONS:
+                    flow = getattr(stats, direction)
+                    agg[direction]['bytes']     += flow.bytes
+                    agg[direction]['messages']  += flow.messages
+            TUNNELS.dec(labels=(stats.peer,))
+        self.lock.release()
+
+    def totals(self):
+        """Aggregates of live and closed pipes, key ---> aggregate."""
+
+        self.lock.acquire()
+        live    = list(self.live)
+        totals  = {}
+        for (key, closed) in self.closed.items():
+            agg = totals[key] = _aggregate()
+            agg['closed'] = closed['closed']
+            for direction in DIRECTIONS:
+                agg[direction]['bytes']     = closed[direction]['bytes']
+                agg[direction]['messages']  = closed[direction]['messages']
+        self.lock.release()
+
+        for stats in live:
+            for key in (('routes', stats.route), ('peers', stats.peer)):
+                agg = totals.setdefault(key, _aggregate())
+                agg['pipes'] += 1
+                for direction in DIRECTIONS:
+                    flow = getattr(stats, direction)
+                    agg[direction]['bytes']     += flow.bytes
+                    agg[direction]['messages']  += flow.messages
+                    agg[direction]['buffered']  += flow.buffered
+
+        return (live, totals)
+
+    def sample(self):
+        """Compute rates since the previous sample and extend the history."""
+
+        now     = time.time()
+        elapsed = max(now - self.stamp, 1e-6)
+        self.stamp = now
+
+        (live, totals) = self.totals()
+
+        for stats in live:
+            for direction in DIRECTIONS:
+                flow = getattr(stats, direction)
+                moved = flow.bytes
+                flow.rate       = (moved - flow.sampled) / elapsed
+                flow.sampled    = moved
+
+        self.lock.acquire()
+        for (key, agg) in totals.items():
+            moved = tuple(agg[direction]['bytes'] for direction in DIRECTIONS)
+            prev  = self.sampled.get(key, (0, 0))
+            rates = [(m - p) / elapsed for (m, p) in zip(moved, prev)]
+            self.sampled[key] = moved
+
+            if key[0] == 'peers':
+                for (direction, m, p) in zip(DIRECTIONS, moved, prev):
+                    if m > p:
+                        PIPE_BYTES.inc(m - p, labels=(key[1], direction))
+
+            history = self.history.get(key)
+            if history is None:
+                history = self.history[key] = collections.deque(maxlen=self.history_size)
+            history.append((int(now), rates[0], rates[1]))
+        self.lock.release()
+
+    def report(self):
+        """Per pipe details and per route and per peer aggregates with history."""
+
+        now = time.time()
+        (live, totals) = self.totals()
+
+        report = {'interval': self.interval, 'pipes': [], 'routes': {}, 'peers': {}}
+
+        for stats in live:
+            report['pipes'].append(stats.report(now))
+
+        self.lock.acquire()
+        histories = dict((key, list(history)) for (key, history) in self.history.items())
+        self.lock.release()
+
+        for ((kind, name), agg) in totals.items():
+            history = histories.get((kind, name), [])
+            if history:
+                for (direction, rate) in zip(DIRECTIONS, history[-1][1:]):
+                    agg[direction]['rate'] = rate
+            agg['history'] = history
+            report[kind][name] = agg
+
+        return report
+
+    def work(self):
+
+        self.cond.acquire()
+        if self.running:
+            self.cond.wait(self.interval)
+        self.cond.release()
+
+        self.sample()
+
+    def deallocate(self):
+
+        self.cond.acquire()
+        self.cond.notify()
+        self.cond.release()
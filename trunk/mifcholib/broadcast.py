@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+"""
+Broadcast - one VNC server session shown to many viewers.
+
+A Broadcast holds the only connection to the VNC server. It does the RFB
+handshake itself, asks for raw and copy-rect rectangles in rfb.PIXEL_FORMAT
+only and parses what the server sends with an RFBStatemachine mirroring the
+screen. Viewers get that pixel format, asking for another one closes them.
+
+Each viewer is a Viewer, which quacks like a Connection and is the sink
+of the viewer's Piper. The Viewer plays the server side of the handshake,
+then gets every server message the Broadcast reads, whole. A viewer
+joining late, asking for a full update or falling more than 'backlog'
+bytes behind gets the mirrored screen instead of what it missed, so slow
+viewers never hold up the others.
+
+Input of the viewers, keys, pointer and cut-text, is forwarded to the
+server. With 'exclusive' only the viewer which joined first controls the
+session, the next one when it leaves.
+"""
+import collections
+import threading
+import logging
+import socket
+import struct
+
+import mifcholib.metrics as metrics
+from mifcholib import rfb
+from mifcholib.threadutils import Worker
+
+VIEWERS = metrics.gauge(
+    'mifcho_broadcast_viewers',
+    'Viewers of broadcasted VNC sessions.'
+)
+FRAMES = metrics.counter(
+    'mifcho_broadcast_frames_total',
+    'Whole screens sent to viewers, reason is "join", "request" or "slow".',
+    ('reason',)
+)
+
+_CLI_FIXED  = {0: 20, 3: 10, 4: 8, 5: 6}    # Client messages of a fixed size
+_INPUT      = (4, 5, 6)                     # Key, pointer and cut-text
+
+def _client_message_size(buff):
+    """Bytes of the client message at the start of buff, None until they are known."""
+
+    if not buff:
+        return None
+
+    kind = buff[0]
+    if kind in _CLI_FIXED:
+        return _CLI_FIXED[kind]
+
+    if kind == 2 and len(buff) >= 4:            # Set encodings
+        return 4 + 4 * struct.unpack_from('!H', buff, 2)[0]
+
+    if kind == 6 and len(buff) >= 8:            # Client cut-text
+        return 8 + struct.unpack_from('!I', buff, 4)[0]
+
+    if kind not in (2, 6):
+        raise socket.error('Unsupported client message %d.' % kind)
+
+    return None
+
+class Viewer:
+    """
+    The end of a Broadcast for one viewer, recv() gives server messages
+    and sendall() takes the messages of the client.
+    """
+
+    HANDSHAKE   = [12, 1, 1]                    # Version, security type, shared-flag
+
+    def __init__(self, broadcast):
+
+        self.broadcast  = broadcast
+        self.use_tls    = False
+
+        self.cond       = threading.Condition()
+        self.greeting   = ''                    # Handshake, sent before any message
+        self.queue      = collections.deque()   # Messages, dropped when behind
+        self.queued     = 0
+        self.frame      = 0                     # Bytes of the screen heading the queue
+        self.closed     = False
+
+        self.stale      = None                  # Why it gets the screen at the next message boundary
+        self.step       = 0                     # Of the handshake
+        self.buff       = bytearray()
+
+        self.greet(rfb.protocolVersion())
+
+    # Server to viewer
+
+    def greet(self, data):
+
+        self.cond.acquire()
+        self.greeting += data
+        self.cond.notify()
+        self.cond.release()
+
+    def push(self, data):
+
+        self.cond.acquire()
+        self.queue.append(data)
+        self.queued += len(data)
+        self.cond.notify()
+        self.cond.release()
+
+    def replace(self, frame, reason):
+        """The screen instead of whatever is queued."""
+
+        self.cond.acquire()
+        self.queue.clear()
+        self.queue.append(frame)
+        self.queued = len(frame)
+        self.frame  = len(frame)
+        self.stale  = None
+        self.cond.notify()
+        self.cond.release()
+
+        FRAMES.inc(labels=(reason,))
+
+    def recv(self, length):
+        """Everything queued, which can exceed length, '' when closed."""
+
+        self.cond.acquire()
+        while not self.greeting and not self.queue and not self.closed:
+            self.cond.wait()
+
+        data = self.greeting + ''.join(self.queue)
+        self.greeting = ''
+        self.queue.clear()
+        self.queued = 0
+        self.frame  = 0
+        self.cond.release()
+
+        return data
+
+    def behind(self):
+        """Bytes of messages queued after the screen."""
+        return self.queued - self.frame
+
+    # Viewer to server
+
+    def sendall(self, data):
+
+        self.buff.extend(data)
+
+        while self.step < len(Viewer.HANDSHAKE):
+            size = Viewer.HANDSHAKE[self.step]
+            if len(self.buff) < size:
+                return
+            del self.buff[:size]
+            self.step += 1
+
+            if self.step == 1:
+                self.greet(rfb.securityTypes([1]))
+            elif self.step == 2:
+                self.greet(rfb.securityResult(True))
+            else:
+                self.broadcast.admit(self)
+
+        while True:
+            size = _client_message_size(self.buff)
+            if size is None or len(self.buff) < size:
+                return
+
+            message = str(self.buff[:size])
+            del self.buff[:size]
+
+            kind = ord(message[0])
+            if kind in _INPUT:
+                self.broadcast.input(self, message)
+            elif kind == 3 and ord(message[1]) == 0:    # Non-incremental update request
+                self.broadcast.refresh(self)
+            elif kind == 0 and message[4:17] != rfb.PIXEL_FORMAT[:13]:
+                raise socket.error('Viewer asked for another pixel format.')
+                                    # Encodings are the Broadcast's
+
+    def send(self, data, flags=0):
+        self.sendall(data)
+        return len(data)
+
+    # The rest of a Connection
+
+    def settimeout(self, value):
+        pass                        # The Broadcast watches the server
+
+    def setblocking(self, flag):
+        pass
+
+    def pending(self):
+        return 0
+
+    def shutdown(self):
+        self.close()
+
+    def close(self):
+
+        self.cond.acquire()
+        closed = self.closed
+        self.closed = True
+        self.cond.notify()
+        self.cond.release()
+
+        if not closed:
+            self.broadcast.leave(self)
+
+    def getpeername(self):
+        return self.broadcast.address
+
+    def getsockname(self):
+        return ('broadcast', id(self))
+
+class Broadcast(Worker):
+    """The connection to the VNC server and the viewers of it."""
+
+    def __init__(self, registry, key, conn, exclusive=False, backlog=4194304):
+
+        self.registry   = registry
+        self.key        = key
+        self.address    = key[0]
+        self.upstream   = conn
+        self.exclusive  = exclusive
+        self.backlog    = backlog
+
+        self.lock       = threading.Lock()      # Parsing and delivering
+        self.send_lock  = threading.Lock()      # Writing to the server
+        self.members    = []                    # Every viewer, also those shaking hands
+        self.viewers    = []                    # Live viewers, in order of joining
+        self.done       = False
+
+        self.rfb_state  = rfb.RFBStatemachine(mirror=True)
+        self.buff       = bytearray()
+        self.message    = bytearray()           # Released bytes of the unfinished message
+        self.updates    = 0
+
+        Worker.__init__(self, name='Broadcast')
+
+    def _read(self, head, length):
+
+        data = ''
+        while len(data) < length:
+            chunk = self.upstream.recv(length-len(data))
+            if not chunk:
+                raise socket.error('VNC server left during the handshake.')
+            data += chunk
+
+        head.extend(data)
+        return data
+
+    def handshake(self):
+        """Shake hands with the server as a shared, unauthenticated client."""
+
+        head = bytearray()
+
+        self._read(head, 12)
+        self.upstream.sendall(rfb.protocolVersion())
+
+        (count,) = struct.unpack('!B', self._read(head, 1))
+        if rfb.security['NONE'] not in self._read(head, count):
+            raise socket.error('VNC server requires authentication.')
+        self.upstream.sendall(rfb.securityType(1))
+
+        if struct.unpack('!I', self._read(head, 4))[0] != 0:
+            raise socket.error('VNC server refused the session.')
+        self.upstream.sendall(rfb.clientInit(1))
+
+        srv_init = self._read(head, 24)
+        self._read(head, struct.unpack('!I', srv_init[20:24])[0])
+
+        self.rfb_state.from_srv(head, len(head))    # Server-init, sizes the mirror
+
+        server = self.rfb_state.server
+        self.upstream.sendall(rfb.clientMessages['SET_PIXEL_FORMAT'] + '\x00' * 3 + rfb.PIXEL_FORMAT)
+        self.rfb_state.set_pixel_format(struct.unpack('!BBBBHHHBBB', rfb.PIXEL_FORMAT[:13]))
+
+        self.upstream.sendall(rfb.setEncodings([0, 1]))
+        self.upstream.sendall(rfb.framebufferUpdateRequest(0, 0, 0, server['w'], server['h']))
+
+    def server_init(self):
+
+        server = self.rfb_state.server
+        return rfb.serverInit(server['w'], server['h'], rfb.PIXEL_FORMAT, server['name'])
+
+    def screen(self):
+        return self.rfb_state.framebuffer.update()
+
+    # Viewers
+
+    def attach(self):
+        """A new Viewer, closed already when the Broadcast is done."""
+
+        viewer = Viewer(self)
+
+        self.lock.acquire()
+        if self.done:
+            viewer.closed = True
+        else:
+            self.members.append(viewer)
+        self.lock.release()
+
+        return viewer
+
+    def admit(self, viewer):
+        """The viewer finished its handshake, it gets the screen."""
+
+        self.lock.acquire()
+        viewer.greet(self.server_init())
+        if self.rfb_state.state == rfb.SRV_MSG:
+            viewer.replace(self.screen(), 'join')
+        else:                       # Once the current message is read
+            viewer.stale = 'join'
+        self.viewers.append(viewer)
+        self.lock.release()
+
+        VIEWERS.inc()
+
+    def refresh(self, viewer):
+
+        self.lock.acquire()
+        if self.rfb_state.state == rfb.SRV_MSG:
+            viewer.replace(self.screen(), 'request')
+        else:
+            viewer.stale = 'request'
+        self.lock.release()
+
+    def leave(self, viewer):
+
+        self.lock.acquire()
+        joined = viewer in self.viewers
+        if joined:
+            self.viewers.remove(viewer)
+        if viewer in self.members:
+            self.members.remove(viewer)
+        alone = not self.members and not self.done
+        self.lock.release()
+
+        if joined:
+            VIEWERS.dec()
+        if alone:                   # Unless one attached since
+            self.registry.remove(self, abandoned=True)
+
+    def attached(self):
+
+        self.lock.acquire()
+        attached = bool(self.members)
+        self.lock.release()
+
+        return attached
+
+    def controls(self, viewer):
+
+        self.lock.acquire()
+        controls = not self.exclusive or (self.viewers and self.viewers[0] is viewer)
+        self.lock.release()
+
+        return controls
+
+    def input(self, viewer, message):
+
+        if not self.controls(viewer):
+            return
+
+        self.send_lock.acquire()
+        try:
+            self.upstream.sendall(message)
+        finally:
+            self.send_lock.release()
+
+    # Server
+
+    def _deliver(self, data):
+        """
+        Whole messages to the viewers keeping up. The viewers which need
+        the screen are returned, with the reason.
+        """
+
+        behind = []
+        for viewer in self.viewers:
+            if viewer.stale or viewer.behind() + len(data) > self.backlog:
+                behind.append((viewer, viewer.stale or 'slow'))
+            else:
+                viewer.push(data)
+
+        return behind
+
+    def work(self):
+
+        try:
+            data = self.upstream.recv(65536)
+        except:
+            logging.debug('Error reading from VNC server.', exc_info=3)
+            data = None
+
+        if not data:
+            if self.done:                       # Shut down by deallocate(), maybe before run()
+                self.running = False
+            else:
+                logging.debug('VNC server %s left.' % repr(self.address))
+                self.registry.remove(self)
+            return
+
+        behind  = []
+
+        self.lock.acquire()
+        buff    = self.buff
+        buff.extend(data)
+        cursor  = self.rfb_state.from_srv(buff, len(buff))
+        self.message.extend(buff[:cursor])
+        del buff[:cursor]
+
+        if self.rfb_state.state == rfb.SRV_MSG and self.message:
+            behind = self._deliver(str(self.message))
+            del self.message[:]
+
+        updated = self.rfb_state.updates != self.updates
+        self.updates = self.rfb_state.updates
+        self.lock.release()
+
+        if behind:                  # Only this thread paints the mirror, no lock needed
+            screen = self.screen()
+            for (viewer, reason) in behind:
+                viewer.replace(screen, reason)
+
+        if updated:                 # Ask for what changes next
+            server = self.rfb_state.server
+            self.send_lock.acquire()
+            try:
+                self.upstream.sendall(rfb.framebufferUpdateRequest(1, 0, 0, server['w'], server['h']))
+            except:
+                logging.debug('Error requesting an update.', exc_info=3)
+            self.send_lock.release()
+
+    def deallocate(self):
+
+        self.lock.acquire()
+        self.done   = True
+        members     = list(self.members)
+        self.lock.release()
+
+        for viewer in members:
+            viewer.close()
+
+        try:
+            self.upstream.shutdown()
+        except:
+            pass
+        try:
+            self.upstream.close()
+        except:
+            pass
+
+    def report(self):
+
+        self.lock.acquire()
+        report = {
+            'address':      '%s:%d' % self.address,
+            'peer':         self.key[1] or 'direct',
+            'viewers':      len(self.viewers),
+            'queued':       [v.queued for v in self.viewers],
+            'exclusive':    self.exclusive
+        }
+        self.lock.release()
+
+        return report
+
+class Broadcasts:
+    """The Broadcasts of a connection-manager, by endpoint and peer."""
+
+    handshake_timeout = 10      # Seconds the VNC server has to shake hands
+
+    def __init__(self, cm):
+
+        self.cm         = cm
+        self.lock       = threading.Lock()
+        self.active     = {}
+        self.connecting = {}    # key ---> Event, set once the first viewer connected or failed
+
+    def _connect(self, key, exclusive, backlog):
+        """A started Broadcast of the VNC server of key, None on failure."""
+
+        (address, peer_id) = key
+
+        conn = self.cm.connect(address, peer_id)
+        if not conn:
+            return None
+
+        broadcast = Broadcast(self, key, conn, exclusive, backlog)
+        try:
+            conn.settimeout(self.handshake_timeout)
+            broadcast.handshake()
+            conn.settimeout(None)
+        except:
+            logging.error('Handshake with VNC server %s failed.' % repr(address), exc_info=3)
+            self.cm.teardown(conn)
+            return None
+
+        broadcast.start()
+        return broadcast
+
+    def viewer(self, address, peer_id=None, exclusive=False, backlog=4194304):
+        """
+        A Viewer of the VNC server at address, connected via peer_id, the
+        first one connects to the server. None when that fails.
+
+        Connecting and shaking hands is done outside the lock, viewers of
+        the same server wait for the first one, others are not held up.
+        """
+
+        key = (address, peer_id)
+
+        while True:
+
+            self.lock.acquire()
+            broadcast   = self.active.get(key)
+            connecting  = self.connecting.get(key)
+            if broadcast is not None:
+                viewer = broadcast.attach()     # Under the lock, see remove()
+                self.lock.release()
+                return viewer
+
+            if connecting is None:
+                connecting = self.connecting[key] = threading.Event()
+                self.lock.release()
+                break
+
+            self.lock.release()
+            connecting.wait()                   # Then attach, or try ourselves
+
+        broadcast = None
+        try:
+            broadcast = self._connect(key, exclusive, backlog)
+        finally:
+            self.lock.acquire()
+            del self.connecting[key]
+            viewer = None
+            if broadcast is not None:
+                self.active[key] = broadcast
+                viewer = broadcast.attach()
+            self.lock.release()
+            connecting.set()
+
+        return viewer
+
+    def remove(self, broadcast, abandoned=False):
+        """
+        Stop broadcast, once its server left. When abandoned by its last
+        viewer it is kept if another one attached meanwhile, viewers are
+        attached under the same lock.
+        """
+
+        self.lock.acquire()
+        if abandoned and broadcast.attached():
+            self.lock.release()
+            return
+        if self.active.get(broadcast.key) is broadcast:
+            del self.active[broadcast.key]
+        self.lock.release()
+
+        if not broadcast.done:
+            broadcast.stop()
+
+    def stop(self):
+
+        for broadcast in self.active.values():
+            self.remove(broadcast)
+
+    def report(self):
+        return [b.report() for b in self.active.values()]
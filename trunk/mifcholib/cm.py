@@ -10,8 +10,17 @@ import time
 import re
 import os
 
-from mifcholib.listener import Listener
+import mifcholib.metrics as metrics
+from mifcholib.listener import Listener, ReactiveListener
+from mifcholib.reactor import ReactorPool
+from mifcholib.mux import Carrier, MUX_VERSION
+from mifcholib.pool import CarrierPool
+from mifcholib.routing import RoutingIndex
 from mifcholib.performance_collector import PerformanceCollector
+from mifcholib.accounting import Traffic, route_name
+from mifcholib.spool import Budget
+from mifcholib.compression import DeflateConnection, HEADER, negotiate
+from mifcholib.broadcast import Broadcasts
 from mifcholib.tunnel import Tunnel
 from mifcholib.connection import Connection
 from mifcholib.handlers import *
@@ -19,6 +28,12 @@ from mifcholib.dispatchers import *
 from mifcholib.connectors import *
 from mifcholib.threadutils import Worker
 
+CONNECT_FAILURES = metrics.counter(
+    'mifcho_connect_failures_total',
+    'Failed connects to endpoints, directly or via a peer.',
+    ('peer',)
+)
+
 class Connector(Worker):
     
     def __init__(self, cm, address, use_tls=False):
@@ -35,6 +50,8 @@ class Connector(Worker):
         
     def work(self):
         
+        self.cb_event.clear()
+        
         try:
             conn = self.cm.connect(self.address, None, self.use_tls)
         except socket.error:
@@ -79,15 +96,19 @@ class PeerConnector(Connector):
 
     def on_connect(self, conn):
         
+        headers = [
+            ('Upgrade',     'mifcho-reverse/0.1'),
+            ('Connection',  'Upgrade'),
+            ('X-Mifcho-Id', self.cm.identifier)
+        ]
+        if self.cm.multiplex:                       # Offer multiplexing
+            headers.append(('X-Mifcho-Mux', MUX_VERSION))
+        
         messages.send_request(                      # Send handshake
             conn,
             'POST',
             '/mifcho/handshake/',
-            headers=[
-                ('Upgrade',     'mifcho-reverse/0.1'),
-                ('Connection',  'Upgrade'),
-                ('X-Mifcho-Id', self.cm.identifier)
-            ]
+            headers=headers
         )
         
         response    = (                             # Read response
@@ -105,6 +126,14 @@ class PeerConnector(Connector):
                 res_headers.get('Connection') == 'Upgrade'
             
             self.peer.id = res_headers.get('X-Mifcho-Id')   # Update Peer Id
+            
+            if res_headers.get('X-Mifcho-Mux') == MUX_VERSION:
+                                    # Connection becomes carrier of tunnels
+                self.peer.carrier = Carrier(self.cm, conn, self.peer, True)
+                self.cm.add_peer(self.peer)
+                self.peer.carrier.start()
+                return
+            
             self.cm.add_peer(self.peer)
         
         while self.running:         # Handle tunnel-requests
@@ -127,37 +156,29 @@ class PeerConnector(Connector):
                     
                     peer_conn   = self.cm.connect(self.peer_address, None, self.use_tls)
                                     
-                    messages.send_response(
-                        conn,
-                        code=200,
-                        message='OK'
-                    )
+                    messages.TUNNEL_OK.send(conn)
                     
                 else:
                     peer_conn   = None
                     
-                    messages.send_response(
-                        conn,
-                        code=404,
-                        message='Not Found'
-                    )
+                    messages.TUNNEL_NOT_FOUND.send(conn)
                 
                 if ep_conn and peer_conn:
-                    messages.send_request(
+                    compression = negotiate(req_headers.get(HEADER), self.cm.compression)
+                    messages.TUNNEL_CALLBACK.send(
                         peer_conn,
-                        'POST',
-                        '/mifcho/tunnel',
-                        headers=[
-                            ('X-Mifcho-Id',         self.cm.identifier),
-                            ('X-Mifcho-Tunnel-Id',  tunnel_id),
-                        ]
+                        self.cm.identifier,
+                        tunnel_id,
+                        compression
                     )
                     res = messages.get_response(peer_conn)        
             
                     pipe = Piper(
                         self.cm,
                         ep_conn,
-                        peer_conn
+                        self.cm.compress(peer_conn, compression),
+                        route   = route_name(ep_address),
+                        peer    = self.peer.id
                     )
                     pipe.start()
                     self.cm.pipes.append(pipe)
@@ -201,15 +222,29 @@ class ConnectionManager(threading.Thread):
 
         self.identifier = self.options.id
 
+        self.multiplex  = getattr(self.options, 'multiplex', False)
+
+        self.head_timeout = getattr(self.options, 'head_timeout', 10)  # Seconds to read a request-head
+
+        self.runtime = getattr(self.options, 'runtime', 'threads')
+
+        self.reactors = None                  # Piping engine, threads or reactors
+        if getattr(self.options, 'piping', 'threads') == 'reactor' or \
+           self.runtime == 'reactor':
+            self.reactors = ReactorPool(getattr(self.options, 'reactors', 2))
+
         self.running = False              # We are not running until we are started
 
         # Listeners bind to addresses
-        for l_address in self.options.bind_addresses:
-            l = Listener(
-                self,
-                (l_address['hostname'], int(l_address['port'])),
-                l_address['scheme'] == 'tls'
-            )
+        for (i, l_address) in enumerate(self.options.bind_addresses):
+            address = (l_address['hostname'], int(l_address['port']))
+            use_tls = l_address['scheme'] == 'tls'
+
+            if self.runtime == 'reactor':     # Accept on a reactor
+                reactor = self.reactors.reactors[i % len(self.reactors.reactors)]
+                l = ReactiveListener(self, address, use_tls, reactor)
+            else:
+                l = Listener(self, address, use_tls)
             self.listeners.append(l)
 
         self.routing_map = {} # The routing map is per example organized as:
@@ -220,7 +255,8 @@ class ConnectionManager(threading.Thread):
                               #     'criteria': SOMETHING,
                               #     'instance': handler_instance,
                               #     'params': job_parameters
-                              #   }]
+                              #   }],
+                              #   'index': RoutingIndex(handlers)
                               # },
                               # {'8001': {
                               #   'dispatcher': dispatcher_instance,
@@ -248,6 +284,7 @@ class ConnectionManager(threading.Thread):
           'PeerHandler':          PeerHandler,
           'StaticWebHandler':     StaticWebHandler,
           'TCPTunnelingHandler':  TCPTunnelingHandler,
+          'MetricsHandler':       MetricsHandler,
           'MiGISH':    MiGISH
         }
         for o in options.orchestration:
@@ -296,6 +333,9 @@ class ConnectionManager(threading.Thread):
                   }]
                 }
 
+        for port in self.routing_map:             # Compile routing for prefix lookups
+            self.routing_map[port]['index'] = RoutingIndex(self.routing_map[port]['handlers'])
+
         for p in self.options.peers:               # Instanciate PeerConnectors
 
             # Note the constructor should also utilize the "path"
@@ -307,7 +347,28 @@ class ConnectionManager(threading.Thread):
             )
             self.connectors.append(peer_connector)
 
+        self.carrier_pool = None                  # Warm connections to peer interfaces
+        if getattr(options, 'pool_min', 0) > 0:
+            self.carrier_pool = CarrierPool(
+              self,
+              options.pool_min,
+              getattr(options, 'pool_max', 8),
+              getattr(options, 'pool_idle', 60)
+            )
+
         self.performance_collector = PerformanceCollector(1)
+        self.traffic = Traffic(1)                 # Counters of the pipes
+
+                                                  # Buffering while sinks recover
+        self.recovery_budget = Budget(getattr(options, 'recovery_total', 67108864))
+        self.recovery_memory = getattr(options, 'recovery_memory', 262144)
+        self.recovery_disk   = getattr(options, 'recovery_disk', 16777216)
+
+                                                  # Deflate tunnels between peers
+        self.compression        = getattr(options, 'compression', False)
+        self.compression_level  = getattr(options, 'compression_level', 6)
+
+        self.broadcasts = Broadcasts(self)        # VNC sessions shared by viewers
 
         count = ConnectionManager.cm_count
         ConnectionManager.cm_count += 1
@@ -320,6 +381,16 @@ class ConnectionManager(threading.Thread):
 
         logging.debug('Starting...')
         self.performance_collector.start()        # Start performance collector
+        self.traffic.start()
+
+        if self.reactors:                         # Start piping reactors
+            self.reactors.start()
+
+        if self.carrier_pool:
+            self.carrier_pool.start()
+
+        for d in self.dispatchers:
+            d.start()
 
         for t in self.handlers + \
                   self.connectors + \
@@ -327,12 +398,18 @@ class ConnectionManager(threading.Thread):
             t.start()
 
         logging.debug('Started!')
-        for t in [self.performance_collector]+ \
+        for t in [self.performance_collector, self.traffic]+ \
           self.handlers+ \
           self.connectors+ \
           self.listeners:                         # Wait for them to exit
             t.join()
 
+        if self.reactors:
+            self.reactors.join()
+
+        if self.carrier_pool:
+            self.carrier_pool.join()
+
         logging.debug('Stopped.')
 
     def connect(self, address, peer_id=None, use_tls=False):
@@ -364,23 +441,29 @@ class ConnectionManager(threading.Thread):
             except:
                 logging.error('Unexpected error', exc_info=3)
         
+        elif peer and peer.carrier:         # Open stream on carrier
+            
+            conn = peer.carrier.open(address)
+        
         elif peer and peer.interface:       # Connect via peer interface
             
             # Extract address and parameters of peer interface.
             peer_address = (peer.interface[0], peer.interface[1])            
                         
             try:
-                peer_conn = self.connect(peer_address)  # Socket Connect
+                peer_conn = None                        # Warm connection
+                if self.carrier_pool:
+                    peer_conn = self.carrier_pool.take(peer)
+                
+                if not peer_conn:                       # Socket Connect
+                    peer_conn = self.connect(peer_address, None, peer.interface[3])
                 
-                messages.send_request(                  # Send TunnelReq
+                messages.TUNNEL_REQUEST.send(           # Send TunnelReq
                     peer_conn,
-                    type    = 'POST',
-                    url     = '/mifcho/tunnel',
-                    headers = [
-                        ('X-Mifcho-Id', self.identifier),
-                        ('X-Mifcho-Tunnel-EndpointHost', address[0]),
-                        ('X-Mifcho-Tunnel-EndpointPort', address[1])
-                    ]
+                    self.identifier,
+                    address[0],
+                    address[1],
+                    self.offer()
                 )
       
                 resp = (                                # Wait for response
@@ -402,7 +485,7 @@ class ConnectionManager(threading.Thread):
                     headers
                 ) = ('', 404, 'Not Found', [])
                 
-            conn = peer_conn        
+            conn = self.compress(peer_conn, dict(headers).get(HEADER))
         
         elif peer and not peer.interface:   # Connect via peer control-line
                                             # and "callback".
@@ -412,16 +495,13 @@ class ConnectionManager(threading.Thread):
             self.add_tunnel(tunnel)
             
             try:                            # Send request for tunnel
-                messages.send_request(
+                messages.TUNNEL_CALLBACK_REQUEST.send(
                     peer.connection,
-                    type    = 'POST',
-                    url     = '/mifcho/tunnel_request',
-                    headers = [
-                        ('X-Mifcho-Id',         self.identifier),
-                        ('X-Mifcho-Tunnel-Id',  tunnel.id),                        
-                        ('X-Mifcho-Tunnel-EndpointHost', address[0]),
-                        ('X-Mifcho-Tunnel-EndpointPort', address[1])
-                    ]
+                    self.identifier,
+                    tunnel.id,
+                    address[0],
+                    address[1],
+                    self.offer()
                 )
             except:
                 logging.error('Error sending request to peer!', exc_info=3)
@@ -453,7 +533,7 @@ class ConnectionManager(threading.Thread):
                     tunnel.event.wait(1)
                     wait_for_tunnel = not tunnel.event.is_set()
                     
-                conn = tunnel.peer_connection
+                conn = self.compress(tunnel.peer_connection, tunnel.compression)
             
             else:
                 conn = None
@@ -465,8 +545,27 @@ class ConnectionManager(threading.Thread):
         else:                               
             logging.error('Invalid params.')
         
+        if conn is None:
+            CONNECT_FAILURES.inc(labels=(peer_id or 'direct',))
+
         return conn
 
+    def offer(self):
+        """Compression asked for in tunnel requests."""
+        return 'deflate' if self.compression else 'none'
+
+    def compress(self, conn, compression):
+        """The peer side of a tunnel, deflated when both peers agreed on it."""
+
+        if conn is None or compression != 'deflate':
+            return conn
+
+        return DeflateConnection(conn, self.compression_level)
+
+    def pick_reactor(self):
+        """Reactor to place a pipe on, None when piping in threads."""
+        return self.reactors.pick() if self.reactors else None
+
     def teardown(self, conn):
         """Tear down a socket properly and remove it from the connection-manager."""
 
@@ -557,6 +656,8 @@ class ConnectionManager(threading.Thread):
         self.running = False                # Tell listeners to stop
 
         self.performance_collector.stop()   # Tell performance collector to stop
+        self.traffic.stop()
+        self.broadcasts.stop()
 
         for w in self.listeners + \
                   self.connectors + \
@@ -564,5 +665,14 @@ class ConnectionManager(threading.Thread):
 
             w.stop()
 
+        for d in self.dispatchers:
+            d.stop()
+
+        if self.reactors:
+            self.reactors.stop()
+
+        if self.carrier_pool:
+            self.carrier_pool.stop()
+
         for opened_socket in self.bound + self.opened: # Tear down sockets
             self.teardown(opened_socket)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Compression - streaming deflate on the peer side of a tunnel.
+
+Each send() becomes a frame, a flag telling whether the payload is
+deflated and its length::
+
+    !BI payload
+
+Deflated payloads are flushed with Z_SYNC_FLUSH, so every frame can be
+inflated as soon as it arrives and interactive traffic is not delayed.
+Both directions share nothing but the connection, each keeps its own
+zlib stream.
+
+The sender watches the ratio of what it deflates. When a window of bytes
+did not shrink enough, e.g. already compressed or encrypted payloads, it
+sends raw frames until 'probe' bytes later it tries again.
+"""
+import logging
+import struct
+import socket
+import time
+import zlib
+
+import mifcholib.metrics as metrics
+
+RAW         = 0
+DEFLATED    = 1
+
+_FRAME = struct.Struct('!BI')
+
+BYTES = metrics.counter(
+    'mifcho_compression_bytes_total',
+    'Bytes of tunnels with compression, stage is "plain" or "wire".',
+    ('stage',)
+)
+CPU_TIME = metrics.counter(
+    'mifcho_compression_seconds_total',
+    'Time spent deflating and inflating tunnel payloads.'
+)
+
+HEADER = 'X-Mifcho-Tunnel-Compression'
+
+def negotiate(offered, enabled):
+    """Value answered to an offer, 'deflate' when both sides want it."""
+    return 'deflate' if enabled and offered == 'deflate' else 'none'
+
+class DeflateConnection:
+    """
+    Wraps a Connection with deflate framing, quacks like a Connection so it
+    can be handed to a Piper.
+    """
+
+    def __init__(self, conn, level=6, window=1048576, threshold=0.9, probe=16777216):
+
+        self.conn       = conn
+        self.use_tls    = conn.use_tls
+
+        self.deflater   = zlib.compressobj(int(level))
+        self.inflater   = zlib.decompressobj()
+
+        self.window     = window        # Bytes the ratio is judged over
+        self.threshold  = threshold     # Worst acceptable wire / plain ratio
+        self.probe      = probe         # Raw bytes before deflating is tried again
+
+        self.enabled    = True
+        self.judged     = [0, 0]        # plain, wire of deflated bytes in the current window
+        self.raw_sent   = 0             # Bytes sent raw since switching off
+
+        self.sent       = [0, 0]        # plain, wire
+        self.received   = [0, 0]        # plain, wire
+        self.cpu        = 0.0           # Seconds deflating and inflating
+        self.switched   = 0             # Times deflating was switched off
+
+    def _spent(self, seconds):
+        self.cpu += seconds
+        CPU_TIME.inc(seconds)
+
+    # Sending
+
+    def _frame(self, data):
+
+        if not self.enabled:
+            self.raw_sent += len(data)
+            if self.raw_sent >= self.probe:
+                self.enabled = True
+            return _FRAME.pack(RAW, len(data)) + data
+
+        start   = time.time()
+        payload = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self._spent(time.time() - start)
+
+        self.judged[0] += len(data)
+        self.judged[1] += len(payload)
+        if self.judged[0] >= self.window:
+            if self.judged[1] > self.threshold * self.judged[0]:
+                logging.debug('Poor compression ratio %.2f, sending raw.' % (float(self.judged[1]) / self.judged[0]))
+                self.enabled    = False
+                self.raw_sent   = 0
+                self.switched   += 1
+            self.judged = [0, 0]
+
+        return _FRAME.pack(DEFLATED, len(payload)) + payload
+
+    def sendall(self, data):
+
+        frame = self._frame(str(data))
+
+        self.sent[0] += len(data)
+        self.sent[1] += len(frame)
+        BYTES.inc(len(data), labels=('plain',))
+        BYTES.inc(len(frame), labels=('wire',))
+
+        self.conn.sendall(frame)
+
+    def send(self, data, flags=0):
+        """Sends all of data, a frame cannot be sent partially."""
+
+        self.sendall(data)
+        return len(data)
+
+    # Receiving
+
+    def recv(self, length):
+        """
+        Payload of the next frame, which can exceed length, '' on
+        end-of-file. Frames inflating to nothing are skipped.
+        """
+
+        while True:
+
+            head = self.conn.read_bytes(_FRAME.size)
+            if len(head) < _FRAME.size:
+                return ''
+
+            (flag, size) = _FRAME.unpack(head)
+            payload = self.conn.read_bytes(size)
+            if len(payload) < size:
+                return ''
+
+            if flag == DEFLATED:
+                start   = time.time()
+                data    = self.inflater.decompress(payload)
+                self._spent(time.time() - start)
+            elif flag == RAW:
+                data = payload
+            else:
+                raise socket.error('Invalid compression frame %d.' % flag)
+
+            self.received[0] += len(data)
+            self.received[1] += _FRAME.size + size
+
+            if data:
+                return data
+
+    def pending(self):
+        return self.conn.pending()
+
+    # The rest is the Connection's
+
+    def settimeout(self, value):
+        self.conn.settimeout(value)
+
+    def setblocking(self, flag):
+        self.conn.setblocking(flag)
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def shutdown(self):
+        self.conn.shutdown()
+
+    def close(self):
+        self.conn.close()
+
+    def getpeername(self):
+        return self.conn.getpeername()
+
+    def getsockname(self):
+        return self.conn.getsockname()
+
+    def report(self):
+
+        def ratio(plain, wire):
+            return float(wire) / plain if plain else None
+
+        return {
+            'enabled':  self.enabled,
+            'switched': self.switched,
+            'sent':     {'plain': self.sent[0], 'wire': self.sent[1], 'ratio': ratio(*self.sent)},
+            'received': {'plain': self.received[0], 'wire': self.received[1], 'ratio': ratio(*self.received)},
+            'cpu':      self.cpu
+        }
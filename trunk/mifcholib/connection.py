@@ -4,6 +4,24 @@ import socket
 import struct
 import ssl
 
+_client_context = None
+
+def client_context():
+    """
+    The SSLContext shared by all outgoing TLS connections, negotiating the
+    highest protocol version both sides support.
+    """
+
+    global _client_context
+
+    if _client_context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        context.verify_mode = ssl.CERT_NONE
+        _client_context = context
+
+    return _client_context
+
 class Connection:
     """Wrapper around socket and OpenSSL."""
 
@@ -12,6 +30,9 @@ class Connection:
         self.s          = s
         self.use_tls    = use_tls        
         self.buffer_size = 4096
+        self.rbuf       = bytearray()   # Read-ahead buffer, consumed before the socket
+        self.rpos       = 0             # Start of the unread bytes in rbuf
+        self.requests   = 0         # HTTP requests dispatched on the connection
         
         self.callback = None
 
@@ -28,11 +49,7 @@ class Connection:
             s.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT,        1)
         
         if use_tls:
-            sock = ssl.wrap_socket(
-                s,
-                cert_reqs   = ssl.CERT_NONE,
-                ssl_version = ssl.PROTOCOL_TLSv1
-            )
+            sock = client_context().wrap_socket(s)
         else:
             sock = s
         
@@ -40,49 +57,89 @@ class Connection:
 
         return cls(sock, use_tls)
 
+    def _fill(self):
+        """Read-ahead a chunk from the socket into the buffer, False on EOF."""
+
+        chunk = self.s.recv(self.buffer_size)
+        self.rbuf += chunk
+
+        return len(chunk) > 0
+
+    def _take(self, length):
+        """Consume up to 'length' buffered bytes."""
+
+        data        = str(self.rbuf[self.rpos:self.rpos+length])
+        self.rpos   += len(data)
+
+        if self.rpos == len(self.rbuf):             # Drained, start over
+            del self.rbuf[:]
+            self.rpos = 0
+        elif self.rpos > 65536 and self.rpos > len(self.rbuf) / 2:
+            del self.rbuf[:self.rpos]               # Compact once mostly consumed
+            self.rpos = 0
+
+        return data
+
+    def append(self, chunk):
+        """Add bytes read from the socket elsewhere to the read-ahead buffer."""
+        self.rbuf += chunk
+
+    def buffered(self):
+        """Amount of bytes in the read-ahead buffer."""
+        return len(self.rbuf) - self.rpos
+
+    def head(self):
+        """The buffered request-head, blank line included, None until it is in."""
+
+        end = self.rbuf.find('\r\n\r\n', self.rpos)
+        if end < 0:
+            return None
+
+        return str(self.rbuf[self.rpos:end+4])
+
     def readline(self, term='\r\n'):
         """Read until end-of-line is reached or 'term' is read."""
 
-        line = ''
-        c = ''
+        end = self.rbuf.find(term, self.rpos)
 
-        while not line.endswith(term):
+        while end < 0:
 
-            c = self.s.recv(1)
-
-            if c:
-                line += c
-            else:
+            start = max(self.rpos, len(self.rbuf)-len(term)+1)  # Don't search twice
+            if not self._fill():
+                end = len(self.rbuf)-len(term)          # EOF, hand out the rest
                 break
+            end = self.rbuf.find(term, start)
 
-        return line
+        return self._take(end + len(term) - self.rpos)
 
     def read_bytes(self, bytes_to_read):
         """Read 'bytes_to_read' amount of bytes."""
 
-        data = ''
-        bytes_read  = 0
-
-        while bytes_read < bytes_to_read:
-            chunk = self.s.recv(bytes_to_read-bytes_read)
-
-            if not chunk:
+        while self.buffered() < bytes_to_read:
+            if not self._fill():
                 break
 
-            data += chunk
-            bytes_read += len(chunk)
+        return self._take(bytes_to_read)
 
-        return data
-
-    def send(self, bytes):
+    def send(self, bytes, flags=0):
         """Send 'bytes'."""
-        return self.s.send(bytes)
+        return self.s.send(bytes, flags)
 
     def recv(self, length):
-        """Receive 'length' bytes."""
+        """Receive at most 'length' bytes, buffered bytes are handed out first."""
+
+        if self.buffered():
+            return self._take(length)
+
         return self.s.recv(length)
 
     def recv_into(self, buffer, nbytes=0, flags=0):
+
+        if self.buffered():
+            data = self._take(nbytes or len(buffer))
+            buffer[0:len(data)] = data
+            return len(data)
+
         return self.s.recv_into(buffer, nbytes, flags)
 
     def sendall(self, chunk):
@@ -97,6 +154,10 @@ class Connection:
     def fileno(self):
         return self.s.fileno()
 
+    def pending(self):
+        """Amount of bytes readable without waiting on the socket."""
+        return self.buffered() + (self.s.pending() if self.use_tls else 0)
+
     def shutdown(self):
 
         if self.callback:
@@ -2,19 +2,85 @@
 import urlparse
 import logging
 import pprint
+import socket
 import time
+import ssl
 
 import mifcholib.messages as messages
+import mifcholib.metrics as metrics
+from mifcholib.listener import Incoming
+from mifcholib.reactor import Reactor
+
+DISPATCH_TIME = metrics.histogram(
+    'mifcho_dispatch_seconds',
+    'Time from dispatching a request until a handler has it, reading the head included.',
+    ('port',)
+)
+
+def release(cm, env):
+    """Hand the connection of a served request back to its dispatcher."""
+
+    dispatcher = env.get('mifcho.dispatcher')
+    if dispatcher:
+        dispatcher.release(env)
+    else:
+        cm.teardown(env['mifcho.conn'])
+
+def read_body(cm, env):
+    """
+    Reads the rest of the request-body into wsgi.input, on the thread of
+    the handler, beyond MAX_BODY it is not read ahead on a reactor. False
+    when the client left, the connection is torn down then.
+    """
+
+    pending = env.get('mifcho.body_pending')
+    if not pending:
+        return True
+
+    conn = env['mifcho.conn']
+    try:
+        body = conn.read_bytes(pending)
+    except (socket.error, ssl.SSLError):
+        body = ''
+
+    if len(body) < pending:
+        logging.debug('Client left while sending the request-body.')
+        cm.teardown(conn)
+        return False
+
+    env['wsgi.input'] += body
+    env['mifcho.body_pending'] = 0
+    return True
+
+def connection_header(env):
+    """Response-header telling the client whether the connection persists."""
+
+    return ('Connection', 'keep-alive' if env.get('mifcho.keep_alive') else 'close')
 
 class Dispatcher:
     """Override dispatch() to implement the dispatching policy."""
 
+    reads_head = False          # Request-head is read before dispatching
+
     def __init__(self, cm):
+
         self.cm = cm
 
+        self.reactor = None     # TLS handshakes and request-heads when pipes are in threads
+        if not cm.reactors:
+            self.reactor = Reactor(self.__class__.__name__)
+
     def dispatch(self, conn, src_addr, dst_addr):
         raise NotImplementedError
 
+    def start(self):
+        if self.reactor is not None:
+            self.reactor.start()
+
+    def stop(self):
+        if self.reactor is not None:
+            self.reactor.stop()
+
 class TCPDispatcher(Dispatcher):
     """Spits the connection to the first available TCPHandler."""
 
@@ -126,6 +192,8 @@ class HTTPDispatcher(Dispatcher):
     implemented as WSGI middleware...    
     """
 
+    reads_head = True
+
     server_name = 'MIFCHO'
     server_ver  = '0.1'
 
@@ -164,15 +232,59 @@ class HTTPDispatcher(Dispatcher):
             'mifcho.conn':  None
 
         }
-        
+                                        # Persistent connections
+        self.keepalive_timeout  = getattr(cm.options, 'keepalive_timeout', 15)
+        self.keepalive_requests = getattr(cm.options, 'keepalive_requests', 100)
+
         Dispatcher.__init__(self, cm)
 
+    def keep_alive(self, conn, version, env):
+        """Whether the connection persists after the response."""
+
+        if self.keepalive_timeout <= 0 or conn.requests >= self.keepalive_requests:
+            return False
+
+        tokens = env.get('HTTP_CONNECTION', '').lower()
+        if version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+
+        return 'close' not in tokens
+
+    def release(self, env):
+        """
+        Called by handlers when the response is sent, wait for the next
+        request or tear the connection down.
+        """
+
+        conn = env['mifcho.conn']
+
+        if not env.get('mifcho.keep_alive'):
+            self.cm.teardown(conn)
+            return
+
+        try:
+            Incoming(
+                self.cm,
+                conn,
+                (env['REMOTE_ADDR'], env['REMOTE_PORT']),
+                timeout = self.keepalive_timeout
+            ).start()                       # Pipelined requests are dispatched at once
+
+        except ValueError:
+            logging.debug('Invalid pipelined request.', exc_info=3)
+            self.cm.teardown(conn)
+
+        except socket.error:
+            logging.debug('Connection closed by the client.', exc_info=3)
+            self.cm.teardown(conn)
+
     def start_response(self, status, response_headers, exc_info=None):
         pass
 
     def dispatch(self, conn, src_addr, dst_addr):
                 
         env = self.base_environ.copy()
+        dispatched = time.time()
         
         logging.debug('Dispatching...')
         try:
@@ -204,34 +316,40 @@ class HTTPDispatcher(Dispatcher):
                             
             env['wsgi.input'] = ''      # wsgi.input to read request content
             if 'CONTENT_LENGTH' in env and int(env['CONTENT_LENGTH']) > 0:
-                env['wsgi.input'] = conn.read_bytes(int(env['CONTENT_LENGTH']))
+                length = int(env['CONTENT_LENGTH'])
+                env['wsgi.input'] = conn.read_bytes(min(length, conn.buffered()))
+                env['mifcho.body_pending'] = length - len(env['wsgi.input'])   # See read_body()
             else:
                 logging.debug('No CONTENT-LENGTH header or CONTENT-LENGTH == 0')
             
+            conn.requests += 1
+            
             env['mifcho.conn']          = conn  # not WSGI compatible!
+            env['mifcho.dispatcher']    = self
+            env['mifcho.keep_alive']    = self.keep_alive(conn, version, env)
             env['mifcho.parsed_url']    = urlparse.urlparse(
                 url=uri,
                 scheme='http'
             )
             
-            passed = False                  # Find a handler
-            for handler_d in self.cm.routing_map[dst_addr[1]]['handlers']:
-
-                criteria  = handler_d['criteria']
-                handler_i = handler_d['instance']
-                
-                if env['PATH_INFO'][:len(criteria)] == criteria:
+                                            # Find a handler, longest prefix wins
+            handler_d = self.cm.routing_map[dst_addr[1]]['index'].lookup(env['PATH_INFO'])
 
-                    handler_i.order(env)
-                    passed = True
-                    break
+            if handler_d:
+                handler_d['instance'].order(env)
+                DISPATCH_TIME.observe(time.time() - dispatched, labels=(dst_addr[1],))
 
-            if not passed:
+            else:
                 logging.debug('No components!')
-                self.cm.teardown(conn)
+                messages.send_response(conn, 404, 'Not Found', self.http_ver, [
+                    ('Content-Length', '0'),
+                    connection_header(env)
+                ])
+                self.release(env)
 
         except:
             logging.debug('Error during dispatching...', exc_info=3)
+            self.cm.teardown(conn)
         
 
     def same_origin_sec(self, conn):
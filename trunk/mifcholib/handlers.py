@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import email.utils
+import collections
 import threading
 import mimetypes
 import urlparse
@@ -22,32 +24,51 @@ import os
 
 from binascii import hexlify
 
+import mifcholib.dispatchers as dispatchers
 import mifcholib.messages as messages
+import mifcholib.metrics as metrics
 import mifcholib.ws as websocket
+import mifcholib.zerocopy as zerocopy
+from mifcholib.longpoll import WaiterTable
+from mifcholib.accounting import route_name
+from mifcholib.compression import negotiate
 from mifcholib import rfb
 from mifcholib.threadutils import Worker, WorkerPool
 from mifcholib.peer_info import PeerInfo
-from mifcholib.piper import Piper, VncPiper, WebsocketPiper, WebsocketVncPiper, HobsPiper, HobsVncPiper
+from mifcholib.piper import Piper, VncPiper, WebsocketPiper, WebsocketVncPiper, WebsocketRFC6455VncPiper, HobsPiper, HobsVncPiper
 from mifcholib.tunnel import Tunnel
+from mifcholib.mux import Carrier, MUX_VERSION
+from mifcholib.listener import Incoming
+
+def _flag(value):
+  """Boolean handler-parameter, given as a string in the config."""
+  return str(value).lower() in ('1', 'yes', 'true', 'on')
 
 class ManagementHandler(WorkerPool):
   """
   Accepts jobs on the form:
 
       (conn, address, request_line)
+
+  Paths ending in /traffic get the traffic of the pipes, per pipe, route
+  and peer, everything else the overall status.
   """
 
-  def __init__(self, cm, workers=10):
+  def __init__(self, cm, workers=10, min_workers=1, idle_timeout=60, grow_wait=0):
 
     self.cm             = cm
     self.buffer_size    = 4096
 
-    WorkerPool.__init__(self, 'ManagementHandler', workers)
+    WorkerPool.__init__(self, 'ManagementHandler', workers, min_workers, idle_timeout, grow_wait)
 
   def work(self, env):
+
+    if not dispatchers.read_body(self.cm, env):   # The rest of a large request-body
+      return
       
-    conn = env['mifcho.conn']
-    
+    if env['mifcho.parsed_url'].path.rstrip('/').endswith('/traffic'):
+      return self.respond(env, self.cm.traffic.report())
+
     opened_sockets = []
     for bo in self.cm.opened:
       try:
@@ -59,21 +80,68 @@ class ManagementHandler(WorkerPool):
       'peers':          [repr(peer) for peer in self.cm.peers],
       'bound_sockets':  [{'sockname': bs.getsockname()} for bs in self.cm.bound],
       'opened_sockets': opened_sockets,
-      'perf_log':       [x for x in self.cm.performance_collector.log()]
+      'perf_log':       [x for x in self.cm.performance_collector.log()],
+      'metrics':        metrics.report(),
+      'recovery':       self.cm.recovery_budget.report(),
+      'broadcasts':     self.cm.broadcasts.report()
     }
 
+    if self.cm.carrier_pool:
+      serializable_perf['carrier_pool'] = self.cm.carrier_pool.report()
+
+    self.respond(env, serializable_perf)
+
+  def respond(self, env, serializable):
+
+    conn = env['mifcho.conn']
+
     try:
-      res_body = json.dumps(serializable_perf)
+      res_body = json.dumps(serializable)
       res_headers = [('Content-Length', len(res_body)),
                      ('Content-Type', 'text/html'),
-                     ('Access-Control-Allow-Origin', '*')]
+                     ('Access-Control-Allow-Origin', '*'),
+                     dispatchers.connection_header(env)]
 
-      messages.send_response(conn, 200, 'OK', 'HTTP/1.1', res_headers)
-      conn.sendall(res_body)
+      messages.send_response(conn, 200, 'OK', 'HTTP/1.1', res_headers, res_body)
 
+      dispatchers.release(self.cm, env)
+    except:
+      logging.debug('Something went wrong', exc_info=3)
       self.cm.teardown(conn)
+
+class MetricsHandler(WorkerPool):
+  """
+  Serves all metrics in the Prometheus text exposition format.
+
+  Metrics are aggregated when they are updated, so a scrape costs the
+  amount of metrics and not the amount of connections.
+  """
+
+  def __init__(self, cm, workers=2, min_workers=1, idle_timeout=60, grow_wait=0):
+
+    self.cm = cm
+
+    WorkerPool.__init__(self, 'MetricsHandler', workers, min_workers, idle_timeout, grow_wait)
+
+  def work(self, env):
+
+    if not dispatchers.read_body(self.cm, env):   # The rest of a large request-body
+      return
+
+    conn = env['mifcho.conn']
+
+    try:
+      res_body = metrics.exposition()
+      res_headers = [('Content-Length', len(res_body)),
+                     ('Content-Type', 'text/plain; version=0.0.4'),
+                     dispatchers.connection_header(env)]
+
+      messages.send_response(conn, 200, 'OK', 'HTTP/1.1', res_headers, res_body)
+
+      dispatchers.release(self.cm, env)
     except:
       logging.debug('Something went wrong', exc_info=3)
+      self.cm.teardown(conn)
 
 class StaticWebHandler(WorkerPool):
   """
@@ -83,59 +151,193 @@ class StaticWebHandler(WorkerPool):
 
       (conn, address, (method, uri, version))
 
+  Files up to cache_file_size bytes are kept in an LRU of cache_size bytes
+  and validated against their mtime, larger files are streamed with
+  sendfile(). Supports conditional GET, with ETag and Last-Modified, and
+  single byte-ranges.
   """
 
-  def __init__(self, cm, workers=10, path_prefix=''):
+  _RANGE = re.compile('^bytes=(\d*)-(\d*)$')
+
+  def __init__(self, cm, workers=10, path_prefix='', cache_size=16777216, cache_file_size=262144, min_workers=1, idle_timeout=60, grow_wait=0):
 
-    self.path_prefix = path_prefix
+    self.cm           = cm
+    self.path_prefix  = path_prefix
 
-    WorkerPool.__init__(self, 'StaticWebHandler', workers)
+    self.cache_size       = int(cache_size)       # Bytes of cached file contents
+    self.cache_file_size  = int(cache_file_size)  # Largest file cached
+    self.cache            = collections.OrderedDict() # path ---> (mtime, content)
+    self.cache_bytes      = 0
+    self.cache_lock       = threading.Lock()
+
+    WorkerPool.__init__(self, 'StaticWebHandler', workers, min_workers, idle_timeout, grow_wait)
+
+  def _cached(self, path, st):
+    """Content of a small file, read from disk only when it is not cached or modified."""
+
+    self.cache_lock.acquire()
+    entry = self.cache.pop(path, None)
+    if entry and entry[0] == st.st_mtime:
+      self.cache[path] = entry                  # Most recently used
+    elif entry:
+      self.cache_bytes -= len(entry[1])
+      entry = None
+    self.cache_lock.release()
+
+    if entry:
+      return entry[1]
+
+    fd = open(path, 'rb')
+    content = fd.read()
+    fd.close()
+
+    self.cache_lock.acquire()
+    if path not in self.cache:
+      self.cache[path] = (st.st_mtime, content)
+      self.cache_bytes += len(content)
+    while self.cache_bytes > self.cache_size:   # Evict least recently used
+      (_, (_, evicted)) = self.cache.popitem(last=False)
+      self.cache_bytes -= len(evicted)
+    self.cache_lock.release()
+
+    return content
+
+  def _not_modified(self, env, etag, mtime):
+    """Whether the conditional headers of the request match the file."""
+
+    if 'HTTP_IF_NONE_MATCH' in env:
+      tags = [t.strip().replace('W/', '', 1) for t in env['HTTP_IF_NONE_MATCH'].split(',')]
+      return etag in tags or '*' in tags
+
+    if 'HTTP_IF_MODIFIED_SINCE' in env:
+      since = email.utils.parsedate_tz(env['HTTP_IF_MODIFIED_SINCE'])
+      return since is not None and int(mtime) <= email.utils.mktime_tz(since)
+
+    return False
+
+  def _range(self, env, etag, size):
+    """
+    Requested (first, last) byte of the file, None for the whole file and
+    () when the range cannot be satisfied.
+    """
+
+    if 'HTTP_RANGE' not in env or env.get('HTTP_IF_RANGE', etag) != etag:
+      return None
+
+    match = StaticWebHandler._RANGE.match(env['HTTP_RANGE'].strip())
+    if not match or match.groups() == ('', ''):   # Multiple or invalid ranges
+      return None
+
+    (first, last) = match.groups()
+    if first == '':                               # Suffix, the last bytes
+      first = max(0, size - int(last))
+      last  = size - 1
+    else:
+      first = int(first)
+      last  = min(int(last), size - 1) if last else size - 1
+
+    if first > last:
+      return ()
+
+    return (first, last)
+
+  def _serve_file(self, conn, env, path, headers):
+
+    st    = os.stat(path)
+    etag  = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+
+    headers = headers + [
+      ('Content-Type',  mimetypes.guess_type(path)[0] or 'application/octet-stream'),
+      ('Last-Modified', email.utils.formatdate(st.st_mtime, usegmt=True)),
+      ('ETag',          etag),
+      ('Accept-Ranges', 'bytes')
+    ]
+
+    if self._not_modified(env, etag, st.st_mtime):
+      messages.send_response(conn, 304, 'Not Modified', 'HTTP/1.1', headers)
+      return
+
+    content = None
+    size    = st.st_size
+    if size <= self.cache_file_size:
+      content = self._cached(path, st)
+      size    = len(content)
+
+    status      = 200
+    status_msg  = 'OK'
+    (first, last) = (0, size - 1)
+
+    byte_range = self._range(env, etag, size)
+    if byte_range == ():
+      messages.send_response(conn, 416, 'Requested Range Not Satisfiable', 'HTTP/1.1', headers + [
+        ('Content-Range',   'bytes */%d' % size),
+        ('Content-Length',  '0')
+      ])
+      return
+
+    elif byte_range:
+      status      = 206
+      status_msg  = 'Partial Content'
+      (first, last) = byte_range
+      headers.append(('Content-Range', 'bytes %d-%d/%d' % (first, last, size)))
+
+    length = last - first + 1
+    headers.append(('Content-Length', length))
+
+    if env['REQUEST_METHOD'] == 'HEAD':
+      messages.send_response(conn, status, status_msg, 'HTTP/1.1', headers)
+
+    elif content is not None:
+      messages.send_response(conn, status, status_msg, 'HTTP/1.1', headers, content[first:last+1])
+
+    else:                                         # Stream large files
+      fd = open(path, 'rb')
+      try:
+        messages.send_response(conn, status, status_msg, 'HTTP/1.1', headers)
+        zerocopy.sendfile(conn, fd, first, length)
+      finally:
+        fd.close()
 
   def work(self, env):
 
+    if not dispatchers.read_body(self.cm, env):   # The rest of a large request-body
+      return
+
     conn = env['mifcho.conn']
 
     path = self.path_prefix + os.sep + "/".join(env['PATH_INFO'].split('?')[0].split('/')[2:])
 
-    status      = 404
-    status_msg  = 'File Not Found'
-    res_body    = '404 - File Not Found'
-    content_type = ('Content-Type', 'text/plain')
+    headers = [
+      ('Access-Control-Allow-Origin', '*'),
+      dispatchers.connection_header(env)
+    ]
+
+    try:
+      root = os.path.realpath(self.path_prefix)
+      real = os.path.realpath(path)
+      inside = real == root or real.startswith(root + os.sep)
 
-    if os.path.exists(path):
+      if not inside or not os.path.exists(path):
+        res_body = '404 - File Not Found'
+        messages.send_response(conn, 404, 'File Not Found', 'HTTP/1.1', headers + [
+          ('Content-Type',    'text/plain'),
+          ('Content-Length',  len(res_body))
+        ], res_body)
 
-      status      = 200
-      status_msg  = 'OK'
-      
-      if os.path.isdir(path):
+      elif os.path.isdir(path):
         res_body = pprint.pformat(os.listdir(path))
-      else:
-        fd = open(path)
-        res_body = fd.read()
-        fd.close()
+        messages.send_response(conn, 200, 'OK', 'HTTP/1.1', headers + [
+          ('Content-Type',    'text/plain'),
+          ('Content-Length',  len(res_body))
+        ], res_body)
 
-      content_type    = ('Content-Type', mimetypes.guess_type(path)[0])
-    
-    res_headers = [
-      ('Content-Length', len(res_body)),
-      content_type,
-      ('Access-Control-Allow-Origin', '*')
-    ]
+      else:
+        self._serve_file(conn, env, path, headers)
 
-    messages.send_response(
-      conn,
-      status,
-      status_msg,
-      'HTTP/1.1',
-      res_headers
-    )
-    if res_body:
-      conn.sendall(res_body)
-    
-    try:
-      conn.close()
+      dispatchers.release(self.cm, env)
     except:
-      logging.debug('Something went wrong when trying to close socket.', exc_info=3)
+      logging.debug('Something went wrong when sending the response.', exc_info=3)
+      self.cm.teardown(conn)
 
 class HobsHandler(WorkerPool):
   """
@@ -149,13 +351,26 @@ class HobsHandler(WorkerPool):
   _HOBS_SESSION_SEND  = re.compile('session/(\d+)/(\d+)')
   _HOBS_SESSION_RECV  = re.compile('session/(\d+)')
 
-  def __init__(self, cm, workers=10):
+  def __init__(self, cm, workers=10, poll_timeout=30, max_pending=4194304, broadcast='false', control='shared', backlog=4194304, min_workers=1, idle_timeout=60, grow_wait=0):
 
     self.cm = cm
-    WorkerPool.__init__(self, 'HobsHandler', workers)
+    self.poll_timeout = int(poll_timeout)     # Seconds a poll waits for data
+    self.broadcast    = _flag(broadcast)      # Viewers of an endpoint share one session
+    self.exclusive    = control == 'exclusive'
+    self.backlog      = int(backlog)
+                                              # Polls are parked here, not in workers
+    self.waiters = WaiterTable('HobsHandler', self.order, int(max_pending))
+    WorkerPool.__init__(self, 'HobsHandler', workers, min_workers, idle_timeout, grow_wait)
+
+  def start(self):
+
+    self.waiters.start()
+    WorkerPool.start(self)
 
   def deallocate(self):        
 
+    self.waiters.stop()
+
     for hsession in HobsHandler.hobs_sessions:
       try:
         HobsHandler.hobs_sessions[hsession]['queue'].put('')
@@ -163,6 +378,9 @@ class HobsHandler(WorkerPool):
         logging.debug('Error when trying to put "end-job" into Hobs-session queue.', exc_info=3)
 
   def work(self, env):
+
+    if not dispatchers.read_body(self.cm, env):   # The rest of a large request-body
+      return
       
     conn = env['mifcho.conn']
 
@@ -202,7 +420,10 @@ class HobsHandler(WorkerPool):
 
         # Try and connect to end-point
         try:
-          vnc_conn = self.cm.connect(ep_address, peer_id)
+          if self.broadcast:
+            vnc_conn = self.cm.broadcasts.viewer(ep_address, peer_id, self.exclusive, self.backlog)
+          else:
+            vnc_conn = self.cm.connect(ep_address, peer_id)
 
           if not vnc_conn:
             logging.error('Could not connect to endpoint!')
@@ -211,7 +432,14 @@ class HobsHandler(WorkerPool):
           ep_status = 200
           ep_status_msg = 'OK'
           
-          pipe = HobsVncPiper(self.cm, None, vnc_conn, sink_recovery=(ep_address, peer_id))
+          if self.broadcast:
+            pipe = HobsVncPiper(self.cm, None, vnc_conn, route=route_name(ep_address), peer=peer_id)
+          else:
+            pipe = HobsVncPiper(self.cm, None, vnc_conn, sink_recovery=(ep_address, peer_id))
+          
+          pipe.hobs_waiters   = self.waiters
+          pipe.hobs_sid       = sid
+          pipe.hobs_sessions  = HobsHandler.hobs_sessions
           
           HobsHandler.hobs_sessions[sid] = {'rid': rid, 'wait': wait, 'pipe':pipe}
           pipe.start()
@@ -221,10 +449,10 @@ class HobsHandler(WorkerPool):
 
         headers = [
           ('Content-Length', len(sid)),
-          ('Access-Control-Allow-Origin', '*')
+          ('Access-Control-Allow-Origin', '*'),
+          dispatchers.connection_header(env)
         ]
-        messages.send_response(conn, ep_status, ep_status_msg, 'HTTP/1.1', headers)
-        conn.sendall(sid)
+        messages.send_response(conn, ep_status, ep_status_msg, 'HTTP/1.1', headers, sid)
 
       # Receive data that should be forwarded
       elif env['REQUEST_METHOD'] == 'POST' and string.find(env['PATH_INFO'], 'session') > -1:
@@ -248,82 +476,95 @@ class HobsHandler(WorkerPool):
         
         headers = [
           ('Content-Length',  '0'),
-          ('Access-Control-Allow-Origin', '*')
+          ('Access-Control-Allow-Origin', '*'),
+          dispatchers.connection_header(env)
         ]
 
         messages.send_response(conn, 200, 'OK', 'HTTP/1.1', headers)
 
-      # GET, hang on to this until we have something to send...
+      # GET, park it until we have something to send...
       elif env['REQUEST_METHOD'] == 'GET' and string.find(env['PATH_INFO'], 'session') > -1:
 
         hobs  = HobsHandler._HOBS_SESSION_RECV.search(env['PATH_INFO'])
         sid   = hobs.group(1)
 
-        data = []
-        q = HobsHandler.hobs_sessions[sid]['pipe'].hobs_out_queue
-
-        # Grab data until buffer is empty
-        block   = False
-        timeout = 0
-
-        while self.running:
-
-          # This is so far the best strategy... but it seems way too inefficient... severe latency issues..
-          try:
-            # Get from piper queue
-            data.append(q.get(block, timeout)) # NOTE: This blocking halt delays the exit of mifcho
-            q.task_done()
-
-            if len(data) > 0 and block: # Data arrived while blocking, timeout is "reset"
-              block   = False
-              timeout = 0
-
-          except Queue.Empty:
-
-            if len(data)>0: # Buffer has been sucked dry
-              break
+        if sid not in HobsHandler.hobs_sessions:
+          raise KeyError('No Hobs-session %s.' % sid)
+        
+        if 'mifcho.parked' not in env:        # Woken or expired polls are ordered again
+          env['mifcho.parked'] = True
+          if self.waiters.park(sid, env, self.poll_timeout):
+            return
 
-            elif block:     # No data and we have already blocked and timed out
-              break
+        data = self.waiters.take(sid)
 
-            else:       # No data so block until data is available or timeout exceeds
-              block = True
-              timeout = 30
-    
-        buf = base64.b64encode(''.join(data))
+        buf = base64.b64encode(data)
         headers = [
           ('Content-Length', str(len(buf))),
           ('Content-Type',    'text/plain'),
-          ('Access-Control-Allow-Origin', '*')
+          ('Access-Control-Allow-Origin', '*'),
+          dispatchers.connection_header(env)
         ]
         
-        messages.send_response(conn, 200, 'OK', 'HTTP/1.1', headers)
-        conn.sendall(buf)
+        messages.send_response(conn, 200, 'OK', 'HTTP/1.1', headers, buf)
+        self.waiters.observe(env)
       else:
         logging.error('Unsupported HOBS request! %s.' % (repr(req_uri)))
+        self.cm.teardown(conn)
+        return
 
     except:
       logging.debug('Something went terribly wrong in the Hobs-handling...', exc_info=3)
+      self.cm.teardown(conn)
+      return
     
     i += 1
 
-    self.cm.teardown(conn)
+    dispatchers.release(self.cm, env)
 
 class WebsocketHandler(WorkerPool):
   """    
   Handles (conn, address, data) jobs.
-  Parses the communication based on the websocket draft 76 / hixie.
+  Parses the communication based on RFC 6455, or on the websocket draft
+  76 / hixie for clients not sending a Sec-WebSocket-Version.
   """
   
-  def __init__(self, cm, workers=10):
+  def __init__(self, cm, workers=10, broadcast='false', control='shared', backlog=4194304, min_workers=1, idle_timeout=60, grow_wait=0):
       
     self.cm = cm
     self.buffer_size = 4096
+    self.broadcast  = _flag(broadcast)        # Viewers of an endpoint share one session
+    self.exclusive  = control == 'exclusive'
+    self.backlog    = int(backlog)
     
-    WorkerPool.__init__(self, 'WebsocketHandler', workers)
-      
-  def _ws_handshake(self, env):
-      
+    WorkerPool.__init__(self, 'WebsocketHandler', workers, min_workers, idle_timeout, grow_wait)
+
+  def _rfc6455_handshake(self, env):
+
+    conn = env['mifcho.conn']
+
+    if env['HTTP_SEC_WEBSOCKET_VERSION'].strip() != websocket.VERSION:
+      messages.send_response(conn, 426, 'Upgrade Required', 'HTTP/1.1', [
+        ('Sec-WebSocket-Version', websocket.VERSION),
+        ('Content-Length',        '0')
+      ])
+      return False
+
+    headers = [
+      ('Upgrade',               'websocket'),
+      ('Connection',            'Upgrade'),
+      ('Sec-WebSocket-Accept',  websocket.accept_key(env['HTTP_SEC_WEBSOCKET_KEY']))
+    ]
+                                          # Only binary frames are sent
+    protocols = [p.strip() for p in env.get('HTTP_SEC_WEBSOCKET_PROTOCOL', '').split(',')]
+    if 'binary' in protocols:
+      headers.append(('Sec-WebSocket-Protocol', 'binary'))
+
+    messages.send_response(conn, 101, 'Switching Protocols', 'HTTP/1.1', headers)
+    return True
+
+  def _hixie_handshake(self, env):
+
     conn = env['mifcho.conn']
     
     headers = [
@@ -336,7 +577,7 @@ class WebsocketHandler(WorkerPool):
     
     key1 = env['HTTP_SEC_WEBSOCKET_KEY1']
     key2 = env['HTTP_SEC_WEBSOCKET_KEY2'],
-    key3 = conn.recv(8)
+    key3 = conn.read_bytes(8)
     
     server_key = websocket.keys_to_md5(key1, key2, key3)
     
@@ -345,9 +586,28 @@ class WebsocketHandler(WorkerPool):
       101,
       'Web Socket Protocol Handshake',
       'HTTP/1.1',
-      headers
+      headers,
+      server_key
     )
-    conn.send(server_key)
+    return True
+
+  def _ws_handshake(self, env):
+    """
+    Returns (conn, endpoint connection, sink recovery, piper class), the
+    endpoint connection is None when the handshake or the connect failed.
+    """
+
+    conn = env['mifcho.conn']
+
+    if 'HTTP_SEC_WEBSOCKET_VERSION' in env:     # RFC 6455 and its drafts
+      piper_class = WebsocketRFC6455VncPiper
+      shaken      = self._rfc6455_handshake(env)
+    else:
+      piper_class = WebsocketVncPiper
+      shaken      = self._hixie_handshake(env)
+
+    if not shaken:
+      return (conn, None, None, piper_class)
 
     # Grab connection parameters
     
@@ -361,25 +621,32 @@ class WebsocketHandler(WorkerPool):
     elif len(req_path) == 5: # Via Peer
       ep_stuff = (_, _, ep_host, ep_port, peer_id) = req_path
     else:
-      logging.error('Invalid path! %s' % repr(data))
+      logging.error('Invalid path! %s' % env['PATH_INFO'])
+      return (conn, None, None, piper_class)
 
-    if ep_stuff:
-      ep_address = (ep_host, int(ep_port))
-  
-      # Initiate endpoint connection
-      vnc_conn = self.cm.connect(ep_address, peer_id)
+    ep_address = (ep_host, int(ep_port))
+
+    if self.broadcast:      # Join the session, the broadcast recovers nothing
+      vnc_conn = self.cm.broadcasts.viewer(ep_address, peer_id, self.exclusive, self.backlog)
+      return (conn, vnc_conn, None, piper_class)
+
+    # Initiate endpoint connection
+    vnc_conn = self.cm.connect(ep_address, peer_id)
         
     sink_recovery = (ep_address, peer_id)
-    return (conn, vnc_conn, sink_recovery)
+    return (conn, vnc_conn, sink_recovery, piper_class)
 
   def work(self, env):
 
+    if not dispatchers.read_body(self.cm, env):   # The rest of a large request-body
+      return
+
     conn = env['mifcho.conn']
 
-    (ws, s, sink_r) = self._ws_handshake(env)
+    (ws, s, sink_r, piper_class) = self._ws_handshake(env)
     if s:
     
-      pipe = WebsocketVncPiper(self.cm, ws, s, sink_recovery=sink_r)
+      pipe = piper_class(self.cm, ws, s, sink_recovery=sink_r)
       pipe.start()
       
       while self.running:
@@ -389,20 +656,24 @@ class WebsocketHandler(WorkerPool):
 
 class PeerHandler(WorkerPool):
 
-  def __init__(self, cm, workers=10):
+  def __init__(self, cm, workers=10, min_workers=1, idle_timeout=60, grow_wait=0):
 
     self.cm = cm
 
-    WorkerPool.__init__(self, 'PeerHandler', workers)
+    WorkerPool.__init__(self, 'PeerHandler', workers, min_workers, idle_timeout, grow_wait)
 
   def work(self, env):
 
+    if not dispatchers.read_body(self.cm, env):   # The rest of a large request-body
+      return
+
     conn = env['mifcho.conn']
     
     request_mapping = {
       'HANDSHAKE':        self.handshake,
       'TUNNEL':           self.tunnel,
-      'TUNNEL_REQUEST':   self.tunnel_request
+      'TUNNEL_REQUEST':   self.tunnel_request,
+      'PARK':             self.park
     }
     
     (_,
@@ -425,6 +696,9 @@ class PeerHandler(WorkerPool):
     ]
                                                 # "Reversed" connection
     reverse = env.get('HTTP_UPGRADE') == 'mifcho-reverse/0.1'
+                                                # Tunnels multiplexed on conn
+    multiplex = reverse and self.cm.multiplex and \
+                env.get('HTTP_X_MIFCHO_MUX') == MUX_VERSION
 
     if reverse:
       res_status      = 101
@@ -432,6 +706,9 @@ class PeerHandler(WorkerPool):
 
       res_headers.append(('Upgrade', env['HTTP_UPGRADE']))
 
+    if multiplex:
+      res_headers.append(('X-Mifcho-Mux', MUX_VERSION))
+
     try:                                      # Inform peer
 
       messages.send_response(
@@ -446,9 +723,30 @@ class PeerHandler(WorkerPool):
       logging.error('Failed sending response to "handshake".')
       raise
 
-    if reverse: # Store for later use (tunnel requests)
+    if multiplex: # Carrier of tunnels
+      peer = PeerInfo(peer_id, conn)
+      peer.carrier = Carrier(self.cm, conn, peer, False)
+      self.cm.add_peer(peer)
+      peer.carrier.start()
+
+    elif reverse: # Store for later use (tunnel requests)
       self.cm.add_peer(PeerInfo(peer_id, conn))
 
+  def park(self, conn, env):
+    """
+    A peer establishes connections ahead of time, wait for the tunnel
+    request on a reactor, without a timeout, and dispatch it as any other
+    request.
+    """
+
+    try:
+      messages.PARKED.send(conn, self.cm.identifier)
+      Incoming(self.cm, conn, (env['REMOTE_ADDR'], env['REMOTE_PORT'])).start()
+
+    except (ValueError, socket.error):
+      logging.debug('Parked connection closed or sent an invalid request.', exc_info=3)
+      self.cm.teardown(conn)
+
   def tunnel_request(self, conn, env):
       
     logging.debug('TUNNEL_REQUEST')
@@ -466,20 +764,15 @@ class PeerHandler(WorkerPool):
     
     # Connect to peer, with the carrier-connection
     peer_conn   = self.cm.connect((peer.interface[0], peer.interface[1]))
-    messages.send_request(
-      peer_conn,
-      type        = 'POST',
-      url         = '/mifcho/tunnel',
-      headers=[
-        ('X-Mifcho-Id',         self.cm.identifier),
-        ('X-Mifcho-Tunnel-Id',  tunnel_id),
-      ]
-    )
+    compression = negotiate(env.get('HTTP_X_MIFCHO_TUNNEL_COMPRESSION'), self.cm.compression)
+    messages.TUNNEL_CALLBACK.send(peer_conn, self.cm.identifier, tunnel_id, compression)
+    messages.get_response(peer_conn)
 
     # Connect to end-point        
     ep_conn = self.cm.connect(ep_address)        
     
     if peer_conn and ep_conn:   # All is good
+      peer_conn = self.cm.compress(peer_conn, compression)
       pipe = Piper(self.cm, peer_conn, ep_conn, 4096, sink_recovery=(ep_address, peer_id))
       pipe.start()
       self.cm.pipes.append(pipe)
@@ -500,14 +793,9 @@ class PeerHandler(WorkerPool):
       
       tunnel = self.cm.tunnels[env['HTTP_X_MIFCHO_TUNNEL_ID']]
       tunnel.peer_connection = conn
+      tunnel.compression = env.get('HTTP_X_MIFCHO_TUNNEL_COMPRESSION', 'none')
       
-      messages.send_response(conn,
-        code      = 101,
-        message   = 'Switching Protocols',
-        headers   = [
-          ('X-Mifcho-Id', env['mifcho.id'])
-        ]
-      )
+      messages.SWITCHING_PROTOCOLS.send(conn, env['mifcho.id'], tunnel.compression)
       
       tunnel.event.set()
         
@@ -529,15 +817,10 @@ class PeerHandler(WorkerPool):
         
         self.cm.add_tunnel(tunnel)
         
-        messages.send_response(conn,
-          code      = 101,
-          message   = 'Switching Protocols',
-          headers   = [
-            ('X-Mifcho-Id', self.cm.identifier)
-          ]
-        )            
+        compression = negotiate(env.get('HTTP_X_MIFCHO_TUNNEL_COMPRESSION'), self.cm.compression)
+        messages.SWITCHING_PROTOCOLS.send(conn, self.cm.identifier, compression)
     
-        pipe = Piper(self.cm, conn, ep_conn, 4096, sink_recovery=(ep_address, None))
+        pipe = Piper(self.cm, self.cm.compress(conn, compression), ep_conn, 4096, sink_recovery=(ep_address, None), peer=env.get('HTTP_X_MIFCHO_ID'))
         pipe.start()
         self.cm.pipes.append(pipe)
       else:
@@ -549,16 +832,16 @@ class MiGISH(WorkerPool):
   MiG interactive session handler.
   """
   
-  def __init__(self, cm, workers=10):
+  def __init__(self, cm, workers=10, min_workers=1, idle_timeout=60, grow_wait=0):
     
     self.cm = cm
-    WorkerPool.__init__(self, 'MIGSession')
+    WorkerPool.__init__(self, 'MIGSession', workers, min_workers, idle_timeout, grow_wait)
   
   def work(self, job):
     
     (cli_conn, address, data) = job
     srv_conn = self.cm.connect(('localhost', 5900), '2222')
-    pipe = VncPiper(self.cm, cli_conn, srv_conn, buffer_size=4096)
+    pipe = VncPiper(self.cm, cli_conn, srv_conn, buffer_size=4096, route='localhost:5900', peer='2222')
     pipe.start()
 
 class TCPTunnelingHandler(WorkerPool):
@@ -571,12 +854,12 @@ class TCPTunnelingHandler(WorkerPool):
   peer identified by peer_id.
   """
 
-  def __init__(self, cm, workers=10):
+  def __init__(self, cm, workers=10, min_workers=1, idle_timeout=60, grow_wait=0):
 
     self.cm = cm
     self.buffer_size  = 4096
 
-    WorkerPool.__init__(self, 'TCPTunnelingHandler', workers)
+    WorkerPool.__init__(self, 'TCPTunnelingHandler', workers, min_workers, idle_timeout, grow_wait)
 
   def work(self, job):
 
@@ -591,7 +874,7 @@ class TCPTunnelingHandler(WorkerPool):
       ep_conn = self.cm.connect(address, peer_id, False) # TODO: tls should be optional
 
       if ep_conn:
-        pipe = Piper(self.cm, conn, ep_conn, self.buffer_size)
+        pipe = Piper(self.cm, conn, ep_conn, self.buffer_size, route=route_name(address), peer=peer_id)
         pipe.start()
         self.cm.pipes.append(pipe)
       else:
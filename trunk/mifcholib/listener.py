@@ -1,19 +1,96 @@
 #!/usr/bin/env python
 import logging
 import socket
+import errno
 import time
 import ssl
+import re
 import os
 
+import mifcholib.metrics as metrics
 from mifcholib.connection import Connection
+from mifcholib.reactor import READ, WRITE, ERROR
 from mifcholib.threadutils import Worker
 
+MAX_HEAD = 65536            # Largest request-head read on a reactor
+MAX_BODY = 1048576          # Of a request-body read ahead on a reactor, the handler reads the rest
+
+ACCEPTS = metrics.counter(
+    'mifcho_accepts_total',
+    'Connections accepted by a listener.',
+    ('port',)
+)
+ACCEPT_TO_DISPATCH = metrics.histogram(
+    'mifcho_accept_to_dispatch_seconds',
+    'Time from accepting a connection until it is dispatched.',
+    ('port',)
+)
+HTTP_TIMEOUTS = metrics.counter(
+    'mifcho_http_timeouts_total',
+    'Connections dropped while waiting for a request, stage is "head" or "idle".',
+    ('port', 'stage')
+)
+
+TLS_HANDSHAKES = metrics.counter(
+    'mifcho_tls_handshakes_total',
+    'Server-side TLS handshakes, result is "ok" or "failed".',
+    ('port', 'result')
+)
+TLS_HANDSHAKE_TIME = metrics.histogram(
+    'mifcho_tls_handshake_seconds',
+    'Time from accept until the TLS handshake is done.',
+    ('port',)
+)
+TLS_SESSIONS = metrics.gauge(
+    'mifcho_tls_sessions',
+    'Session statistics of the server SSLContext, "hits" are resumed sessions.',
+    ('stat',)
+)
+
+content_length_regex = re.compile('^content-length:\\s*(\\d+)\\s*$', re.I | re.M)
+
+_server_context = None
+
+def server_context():
+    """
+    The SSLContext shared by all TLS listeners.
+
+    Certificate and key are loaded once, and since sessions are cached in
+    the context, returning clients can resume their session with a
+    session-id or session-ticket instead of doing a full handshake.
+    """
+
+    global _server_context
+
+    if _server_context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        context.verify_mode = ssl.CERT_NONE
+        context.load_cert_chain(
+            certfile    = 'certs'+os.sep+'m3.crt',
+            keyfile     = 'certs'+os.sep+'m3.key'
+        )
+        _server_context = context
+
+    return _server_context
+
+def tls_wrap(sock):
+    """Wrap an accepted socket in ssl, the handshake is done later by Incoming."""
+
+    return server_context().wrap_socket(
+        sock,
+        server_side             = True,
+        do_handshake_on_connect = False
+    )
+
 class Listener(Worker):
     """
     TCP Socket bind/listen/accept on `address`.
 
     Wrap an accepted socket into a Connection and pass the connection
-    off to a dispatcher based on matching in the routing map.
+    off to a dispatcher based on matching in the routing map. The TLS
+    handshake and reading the request-head is left to a reactor, so a
+    slow client does not hold up accepting.
     """
 
     def __init__(self, cm, address, use_tls):
@@ -25,10 +102,13 @@ class Listener(Worker):
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.s.bind(self.address)
-        self.s.listen(5)
+        self.s.listen(128)
 
         self.cm.bound.append(Connection(self.s, self.use_tls))     # Add to list of bound sockets
 
+        if self.use_tls:                            # Load certificate now
+            server_context()
+
         logging.debug('Listening on %s.' % repr(self.s.getsockname()))
 
         Worker.__init__(self, name='Listener')
@@ -37,19 +117,13 @@ class Listener(Worker):
 
         try:
             new_sock, src_addr = self.s.accept()            # Accept a connection
+            accepted = time.time()
+            ACCEPTS.inc(labels=(self.address[1],))
                         
-            if self.use_tls:                        # Wrap it in ssl
-                sock = ssl.wrap_socket(
-                    new_sock,
-                    server_side = True,
-                    cert_reqs   = ssl.CERT_NONE,
-                    ca_certs    = 'certs'+os.sep+'m3.crt',
-                    certfile    = 'certs'+os.sep+'m3.crt',
-                    keyfile     = 'certs'+os.sep+'m3.key',
-                    #ssl_version = ssl.PROTOCOL_TLSv1
-                    ssl_version = ssl.PROTOCOL_SSLv23
-                )
-                
+            if self.use_tls:                        # Wrap it in ssl, handshake later
+                new_sock.setblocking(False)
+                sock = tls_wrap(new_sock)
+
             else:
                 sock = new_sock                     # Dont wrap it in ssl
             
@@ -66,9 +140,270 @@ class Listener(Worker):
             )
             logging.debug('New connection! [%s]' % conn_str)
 
-                                                      # Add to dispatcher
-            self.cm.routing_map[dest_addr[1]]['dispatcher'].dispatch(conn, src_addr, dest_addr)
+            Incoming(                               # Add to dispatcher
+                self.cm,
+                conn,
+                src_addr,
+                handshaken  = not self.use_tls,
+                timeout     = self.cm.head_timeout,
+                accepted    = accepted
+            ).start()
 
         except socket.error:
             logging.debug("Socket barf... I give up...", exc_info=3)
-            #self.stop()
\ No newline at end of file
+            #self.stop()
+
+class ReactiveListener:
+    """
+    Listener of the reactor runtime, accepts on a reactor instead of in a
+    thread of its own.
+
+    Accepted connections are placed on the least loaded reactor which does
+    the TLS handshake and, for dispatchers reading a request-head, reads
+    the head without blocking. The dispatcher is called when the
+    connection is ready, so idle connections never occupy a thread.
+    """
+
+    def __init__(self, cm, address, use_tls, reactor):
+
+        self.cm       = cm
+        self.use_tls  = use_tls
+        self.address  = address
+        self.reactor  = reactor
+        self.running  = False
+
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.s.bind(self.address)
+        self.s.listen(128)
+        self.s.setblocking(False)
+
+        self.cm.bound.append(Connection(self.s, self.use_tls))     # Add to list of bound sockets
+
+        if self.use_tls:                            # Load certificate now
+            server_context()
+
+        logging.debug('Listening on %s.' % repr(self.s.getsockname()))
+
+    def start(self):
+
+        self.running = True
+        self.reactor.call_soon(self.reactor.register, self.s.fileno(), READ, self._on_accept)
+
+    def stop(self):
+
+        self.running = False
+        self.reactor.call_soon(self.reactor.unregister, self.s.fileno())
+
+    def join(self):
+        pass                                        # Nothing to wait for
+
+    def _on_accept(self, fd, events):
+        """Accept all pending connections."""
+
+        while self.running:
+
+            try:
+                new_sock, src_addr = self.s.accept()
+                accepted = time.time()
+                ACCEPTS.inc(labels=(self.address[1],))
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logging.error('Failed accepting: %s.' % e)
+                break
+
+            new_sock.setblocking(False)
+
+            logging.debug('New connection! [FROM=%s:%s]' % src_addr)
+
+            if self.use_tls:                        # Handshake on the reactor
+                conn = Connection(tls_wrap(new_sock), True)
+            else:
+                conn = Connection(new_sock)
+            self.cm.opened.append(conn)
+
+            Incoming(
+                self.cm,
+                conn,
+                src_addr,
+                handshaken  = not self.use_tls,
+                timeout     = self.cm.head_timeout,
+                accepted    = accepted
+            ).start()
+
+class Incoming:
+    """
+    A connection waiting, on a reactor, for its TLS handshake and for a
+    request-head, and the body it announces, to be read into its buffer.
+
+    Used for new connections, 'accepted' is the time of accept, and for
+    persistent connections waiting for their next request. The connection
+    is dropped when it is not ready within 'timeout' seconds.
+    """
+
+    def __init__(self, cm, conn, src_addr, handshaken=True, timeout=None, accepted=None):
+
+        self.cm         = cm
+        self.conn       = conn
+        self.src_addr   = src_addr
+        self.handshaken = handshaken
+        self.timeout    = timeout
+        self.accepted   = accepted
+        self.reactor    = None
+        self.timer      = None              # Of expire(), cancelled once done
+        self.done       = False             # Dispatched or dropped
+
+        self.dest_addr  = conn.getsockname()
+        self.dispatcher = self.cm.routing_map[self.dest_addr[1]]['dispatcher']
+
+        self.needed = None                  # Length of head and body once the head is read
+        self._scan()                        # Pipelined requests are buffered already
+
+    def ready(self):
+        """True when the connection can be dispatched."""
+
+        if not self.handshaken:
+            return False
+
+        if not getattr(self.dispatcher, 'reads_head', False):
+            return True
+
+        return self.needed is not None and self.conn.buffered() >= self.needed
+
+    def start(self):
+        """Dispatch when ready, otherwise wait on a reactor."""
+
+        if self.ready():
+            self.dispatch()
+            return
+
+        reactor = self.cm.pick_reactor()
+        if reactor is None:                 # Pipes are not on reactors
+            reactor = self.dispatcher.reactor
+        reactor.call_soon(self.attach, reactor)
+
+    def attach(self, reactor):
+
+        self.reactor = reactor
+        self.conn.setblocking(False)
+        reactor.register(self.conn.fileno(), READ | ERROR, self.on_event)
+
+        if self.timeout:
+            self.timer = reactor.call_later(self.timeout, self.expire)
+
+        if self.handshaken and self.conn.use_tls and self.conn.s.pending():
+            self.on_event(self.conn.fileno(), READ)     # Decrypted bytes are not signaled
+
+    def expire(self):
+
+        if not self.done:
+            logging.debug('Dropping %s:%s, timed out.' % self.src_addr)
+            stage = 'head' if self.accepted or self.conn.buffered() else 'idle'
+            HTTP_TIMEOUTS.inc(labels=(self.dest_addr[1], stage))
+            self.drop()
+
+    def drop(self):
+
+        self.done = True
+        if self.timer:
+            self.timer.cancel()
+        self.reactor.unregister(self.conn.fileno())
+        self.cm.teardown(self.conn)
+
+    def on_event(self, fd, events):
+
+        if self.done:
+            return
+
+        try:
+            if not self.handshaken:
+                self._handshake()
+            if self.handshaken:
+                self._read()
+
+        except (socket.error, ssl.SSLError, EOFError, ValueError):
+            logging.debug('Dropping %s:%s before dispatching.' % self.src_addr, exc_info=3)
+            if not self.handshaken:
+                TLS_HANDSHAKES.inc(labels=(self.dest_addr[1], 'failed'))
+            self.drop()
+            return
+
+        if self.ready():
+            self.done = True
+            if self.timer:
+                self.timer.cancel()
+            self.reactor.unregister(fd)
+            self.dispatch()
+
+    def _handshake(self):
+
+        try:
+            self.conn.s.do_handshake()
+            self.handshaken = True
+            self.reactor.modify(self.conn.fileno(), READ | ERROR)
+
+            port = self.dest_addr[1]
+            TLS_HANDSHAKES.inc(labels=(port, 'ok'))
+            if self.accepted:
+                TLS_HANDSHAKE_TIME.observe(time.time() - self.accepted, labels=(port,))
+            for (stat, value) in server_context().session_stats().items():
+                TLS_SESSIONS.set(value, labels=(stat,))
+
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.reactor.modify(self.conn.fileno(), READ | ERROR)
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.reactor.modify(self.conn.fileno(), WRITE | ERROR)
+            else:
+                raise
+
+    def _read(self):
+        """Read what is available until the head, and the body it announces, is in."""
+
+        while not self.ready():
+
+            try:
+                chunk = self.conn.s.recv(4096)
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    break
+                raise
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+            if not chunk:
+                raise EOFError
+
+            self.conn.append(chunk)
+            self._scan()
+
+    def _scan(self):
+        """Determine the length of the request once its head is buffered."""
+
+        if self.needed is not None:
+            return
+
+        head = self.conn.head()
+        if head is not None:
+            match = content_length_regex.search(head)
+            body = int(match.group(1)) if match else 0
+            self.needed = len(head) + min(body, MAX_BODY)
+
+        elif self.conn.buffered() > MAX_HEAD:
+            raise ValueError('Request-head too large.')
+
+    def dispatch(self):
+        """Hand the connection, and what was read ahead, to the dispatcher."""
+
+        self.conn.setblocking(True)
+
+        if self.accepted:
+            ACCEPT_TO_DISPATCH.observe(time.time() - self.accepted, labels=(self.dest_addr[1],))
+
+        try:
+            self.dispatcher.dispatch(self.conn, self.src_addr, self.dest_addr)
+        except:
+            logging.error('Failed dispatching.', exc_info=3)
+            self.cm.teardown(self.conn)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Long-polling - requests parked until there is data for them.
+
+A parked poll holds no thread, it is a request in a table. Data put for a
+key wakes the poll parked on it, a single thread expires polls which are
+not woken in time. Woken and expired polls are handed to a callback,
+usually the order() of the handler which then responds.
+
+Keys are discarded when their session ends, and a key whose data is not
+polled beyond max_pending bytes is refused more.
+"""
+import threading
+import logging
+import time
+
+import mifcholib.metrics as metrics
+from mifcholib.threadutils import Worker
+
+PARKED = metrics.gauge(
+    'mifcho_longpoll_parked',
+    'Long-polls waiting for data.',
+    ('table',)
+)
+WAKE_LATENCY = metrics.histogram(
+    'mifcho_longpoll_wake_seconds',
+    'Time from data arriving for a parked poll until it is answered.',
+    ('table',)
+)
+
+class WaiterTable(Worker):
+    """
+    Data pending per key and the polls parked on them.
+
+    Polls are parked and woken under one Condition, which the expiry
+    thread waits on until the earliest deadline, so data can never arrive
+    unnoticed between a poll finding nothing and parking.
+    """
+
+    def __init__(self, name, wake, max_pending=4194304):
+
+        self.table      = name
+        self.wake       = wake                  # Called with woken and expired polls
+        self.max_pending = max_pending          # Bytes pending per key, None for no limit
+
+        self.cond       = threading.Condition()
+        self.pending    = {}                    # key ---> list of data
+        self.sizes      = {}                    # key ---> bytes pending
+        self.parked     = {}                    # key ---> (poll, deadline)
+
+        Worker.__init__(self, 'WaiterTable-%s' % name)
+
+    def put(self, key, data):
+        """
+        Add data for key, waking the poll parked on it. Returns False, and
+        drops the data, when more than max_pending bytes would be pending.
+        """
+
+        self.cond.acquire()
+
+        size = self.sizes.get(key, 0) + len(data)
+        if self.max_pending is not None and size > self.max_pending:
+            self.cond.release()
+            return False
+
+        self.pending.setdefault(key, []).append(data)
+        self.sizes[key] = size
+        woken = self._unpark(key)
+        self.cond.release()
+
+        if woken is not None:
+            woken['mifcho.woken'] = time.time()
+            self.wake(woken)
+
+        return True
+
+    def take(self, key):
+        """All data pending for key."""
+
+        self.cond.acquire()
+        data = ''.join(self.pending.pop(key, []))
+        self.sizes.pop(key, None)
+        self.cond.release()
+
+        return data
+
+    def park(self, key, poll, timeout):
+        """
+        Park poll until data is put for key or timeout seconds passed.
+        Returns False, without parking, when data is already pending.
+        """
+
+        self.cond.acquire()
+
+        if self.pending.get(key):
+            self.cond.release()
+            return False
+
+        superseded = self._unpark(key)          # A client polls once at a time
+        self.parked[key] = (poll, time.time() + timeout)
+        PARKED.set(len(self.parked), labels=(self.table,))
+
+        self.cond.notify()                      # Deadline might be the earliest
+        self.cond.release()
+
+        if superseded is not None:
+            self.wake(superseded)
+
+        return True
+
+    def discard(self, key):
+        """Forget key, the poll parked on it is woken."""
+
+        self.cond.acquire()
+        self.pending.pop(key, None)
+        self.sizes.pop(key, None)
+        woken = self._unpark(key)
+        self.cond.release()
+
+        if woken is not None:
+            self.wake(woken)
+
+    def _unpark(self, key):
+        """Remove the poll parked on key, the condition must be held."""
+
+        entry = self.parked.pop(key, None)
+        if entry is None:
+            return None
+
+        PARKED.set(len(self.parked), labels=(self.table,))
+        return entry[0]
+
+    def observe(self, poll):
+        """Record the wake latency of a poll that was woken by data."""
+
+        if 'mifcho.woken' in poll:
+            WAKE_LATENCY.observe(time.time() - poll['mifcho.woken'], labels=(self.table,))
+
+    def work(self):
+        """Wait until the earliest deadline and wake the polls which expired."""
+
+        self.cond.acquire()
+
+        now = time.time()
+        expired = [key for (key, (_, deadline)) in self.parked.items() if deadline <= now]
+        polls = [self._unpark(key) for key in expired]
+
+        if not polls and self.running:
+            deadlines = [deadline for (_, deadline) in self.parked.values()]
+            self.cond.wait(min(deadlines) - now if deadlines else None)
+
+        self.cond.release()
+
+        for poll in polls:
+            try:
+                self.wake(poll)
+            except:
+                logging.error('Failed waking an expired poll.', exc_info=3)
+
+    def deallocate(self):
+        """Wake the expiry thread and every parked poll."""
+
+        self.cond.acquire()
+        polls = [self._unpark(key) for key in self.parked.keys()]
+        self.cond.notify()
+        self.cond.release()
+
+        for poll in polls:
+            self.wake(poll)
@@ -22,6 +22,8 @@ methods       = 'OPTIONS|GET|HEAD|POST|PUT|DELETE|TRACE|CONNECT'
 request_regex_pattern = '('+methods+')\s(.+)\s('+http_version+')'+crlf
 request_regex = re.compile(request_regex_pattern)
 
+inline_body = 65536     # Bodies up to this size are sent with the head
+
 # Groups: protocol-version, status-code, reason-text.
 response_regex_pattern = '('+http_version+')\s('+status_code+')\s(.+)'+crlf
 response_regex = re.compile(response_regex_pattern)
@@ -82,20 +84,42 @@ def get_request(c):
 
     return (method, uri, version, headers)
 
+def format_response(code, message=None, version='HTTP/1.1', headers=[], body=''):
+    """Response-head, and optionally a body, as a single string."""
+
+    return ''.join(
+        ["%s %d %s%s" % (version, code, message, crlf)] +
+        ["%s: %s%s" % (h[0], str(h[1]), crlf) for h in headers] +
+        [crlf, body]
+    )
+
 def send_response_line(c, code, message=None, version='HTTP/1.1'):
 
     response = "%s %d %s%s" % (version, code, message, crlf)
     c.sendall(response)
 
-def send_response(c, code, message=None, version='HTTP/1.1', headers=[]):
+def send_response(c, code, message=None, version='HTTP/1.1', headers=[], body=''):
     """
-    Send a response without body
+    Send a response, the head and a small body are sent with a single write
 
-    e.g. send_reponse(200, 'OK', 'HTTP/1.1') => "HTTP/1.1 200 OK\r\n"
+    e.g. send_reponse(200, 'OK', 'HTTP/1.1') => "HTTP/1.1 200 OK\r\n\r\n"
     """
 
-    send_response_line(c, code, message, version)
-    send_headers(c, headers)
+    if len(body) > inline_body:     # Don't copy large bodies
+        c.sendall(format_response(code, message, version, headers))
+        c.sendall(body)
+    else:
+        c.sendall(format_response(code, message, version, headers, body))
+
+def format_request(type="GET", url='/', version='HTTP/1.1', address=('localhost', 8080), headers=[], body=''):
+    """Request-head, and optionally a body, as a single string."""
+
+    return ''.join(
+        ['%s %s %s%s' % (type, url, version, crlf),
+         'Host: %s:%d%s' % (address[0], address[1], crlf)] +
+        ["%s: %s%s" % (h[0], str(h[1]), crlf) for h in headers] +
+        [crlf, body]
+    )
 
 def send_request_line(c, type="GET", url='/', version='HTTP/1.1', address=('localhost', 8080)):
 
@@ -104,15 +128,18 @@ def send_request_line(c, type="GET", url='/', version='HTTP/1.1', address=('loca
 
     c.sendall(request)
 
-def send_request(c, type="GET", url='/', version='HTTP/1.1', address=('localhost', 8080), headers=[]):
+def send_request(c, type="GET", url='/', version='HTTP/1.1', address=('localhost', 8080), headers=[], body=''):
     """
-    Sends the request-line of a request and the obligatory host header
+    Sends the request-line, the obligatory host header, headers and body with a single write
 
     e.g. send_request(c, 'GET', '/', 'HTTP/1.1', ('localhost', 8080))
     """
 
-    send_request_line(c, type, url, version, address)
-    send_headers(c, headers)
+    if len(body) > inline_body:     # Don't copy large bodies
+        c.sendall(format_request(type, url, version, address, headers))
+        c.sendall(body)
+    else:
+        c.sendall(format_request(type, url, version, address, headers, body))
 
 def get_headers(c):
     """
@@ -135,9 +162,7 @@ def get_headers(c):
 
 def send_headers(c, headers=[]):
 
-    for h in headers:
-        send_header(c, h[0], h[1])
-    end_headers(c)
+    c.sendall(''.join(["%s: %s%s" % (h[0], str(h[1]), crlf) for h in headers] + [crlf]))
 
 def send_header(c, keyword, value):
     """
@@ -153,10 +178,37 @@ def end_headers(c):
     """
     Sends the carriage-return + line-feed to indicate end of headers.
 
-    Any send_request or send_response must be eventually followed by end_headers()
+    Only needed after send_request_line/send_response_line and send_header,
+    send_request and send_response end the headers themselves.
     """
     c.sendall(crlf)
 
+class Template:
+    """
+    Precompiled head of a message where only the header-values vary::
+
+        PARK.send(c, 'my-id') => "POST /mifcho/park HTTP/1.1\r\n...X-Mifcho-Id: my-id\r\n\r\n"
+    """
+
+    def __init__(self, line, keywords):
+
+        self.keywords   = keywords
+        self.head       = line.replace('%', '%%') + ''.join(
+            ['%s: %%s%s' % (k, crlf) for k in keywords] + [crlf]
+        )
+
+    def format(self, *values):
+        return self.head % tuple(str(v) for v in values)
+
+    def send(self, c, *values):
+        c.sendall(self.format(*values))
+
+def request_template(type, url, keywords, version='HTTP/1.1', address=('localhost', 8080)):
+    return Template(format_request(type, url, version, address)[:-len(crlf)], keywords)
+
+def response_template(code, message, keywords, version='HTTP/1.1'):
+    return Template(format_response(code, message, version)[:-len(crlf)], keywords)
+
 def path_to_fun(path):
 
     model_fun_args = path.split('/')
@@ -173,3 +225,28 @@ def path_to_fun(path):
 #
 def tunneling_request(tunnel_id, address):
     return '/peer/tunnel/%s/%s/%d' % (tunnel_id, address[0], address[1])
+
+                                # Tunnel via the interface of a peer
+TUNNEL_REQUEST = request_template('POST', '/mifcho/tunnel', [
+    'X-Mifcho-Id', 'X-Mifcho-Tunnel-EndpointHost', 'X-Mifcho-Tunnel-EndpointPort',
+    'X-Mifcho-Tunnel-Compression'
+])
+                                # Tunnel via the control-line of a peer
+TUNNEL_CALLBACK_REQUEST = request_template('POST', '/mifcho/tunnel_request', [
+    'X-Mifcho-Id', 'X-Mifcho-Tunnel-Id',
+    'X-Mifcho-Tunnel-EndpointHost', 'X-Mifcho-Tunnel-EndpointPort',
+    'X-Mifcho-Tunnel-Compression'
+])
+                                # Connection calling back for a tunnel
+TUNNEL_CALLBACK = request_template('POST', '/mifcho/tunnel', [
+    'X-Mifcho-Id', 'X-Mifcho-Tunnel-Id', 'X-Mifcho-Tunnel-Compression'
+])
+
+PARK = request_template('POST', '/mifcho/park', ['X-Mifcho-Id'])
+
+TUNNEL_OK           = response_template(200, 'OK', [])
+TUNNEL_NOT_FOUND    = response_template(404, 'Not Found', [])
+SWITCHING_PROTOCOLS = response_template(101, 'Switching Protocols', [
+    'X-Mifcho-Id', 'X-Mifcho-Tunnel-Compression'
+])
+PARKED              = response_template(200, 'OK', ['X-Mifcho-Id'])
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Metrics - counters, gauges and histograms updated where things happen.
+
+Metrics are registered once, by name, and aggregated on update so reading
+them is cheap. Each metric can be split by label-values::
+
+    ACCEPTS = metrics.counter('mifcho_accepts_total', 'Accepted connections.', ('port',))
+    ACCEPTS.inc(labels=(8000,))
+
+report() gives the metrics as JSON-serializable dicts and exposition()
+in the Prometheus text format.
+"""
+import collections
+import threading
+import bisect
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+_registry       = collections.OrderedDict()     # name ---> metric
+_registry_lock  = threading.Lock()
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+
+        self.lock   = threading.Lock()
+        self.values = {}                        # label-values ---> value
+
+    def samples(self):
+        """List of (label-values, value)."""
+
+        self.lock.acquire()
+        samples = sorted(self.values.items())
+        self.lock.release()
+
+        return samples
+
+    def report(self):
+
+        return {
+            'type':     self.kind,
+            'help':     self.help,
+            'samples':  [
+                {'labels': dict(zip(self.labels, lv)), 'value': v} for (lv, v) in self.samples()
+            ]
+        }
+
+    def exposition(self):
+        """Lines of the metric in the Prometheus text format."""
+
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for (lv, v) in self.samples():
+            lines.append('%s%s %s' % (self.name, _labels(self.labels, lv), _value(v)))
+
+        return lines
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+
+        self.lock.acquire()
+        self.values[labels] = self.values.get(labels, 0) + amount
+        self.lock.release()
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+
+        self.lock.acquire()
+        self.values[labels] = value
+        self.lock.release()
+
+    def inc(self, amount=1, labels=()):
+
+        self.lock.acquire()
+        self.values[labels] = self.values.get(labels, 0) + amount
+        self.lock.release()
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def remove(self, labels=()):
+
+        self.lock.acquire()
+        self.values.pop(labels, None)
+        self.lock.release()
+
+class Histogram(Metric):
+    """Counts observations in buckets, value of a sample is (counts, sum, count)."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+
+        self.buckets = tuple(buckets)
+
+        Metric.__init__(self, name, help, labels)
+
+    def observe(self, value, labels=()):
+
+        i = bisect.bisect_left(self.buckets, value)
+
+        self.lock.acquire()
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets)+1), 0.0, 0]
+        state[0][i] += 1
+        state[1]    += value
+        state[2]    += 1
+        self.lock.release()
+
+    def samples(self):
+
+        self.lock.acquire()
+        samples = sorted(
+            (lv, (list(counts), total, count)) for (lv, (counts, total, count)) in self.values.items()
+        )
+        self.lock.release()
+
+        return samples
+
+    def quantile(self, q, counts):
+        """Estimate the q-quantile from bucket counts, interpolating within the bucket."""
+
+        count = sum(counts)
+        if not count:
+            return 0.0
+
+        rank = q * count
+        seen = 0
+        for (i, n) in enumerate(counts):
+
+            if seen + n >= rank and n:
+                lower = self.buckets[i-1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper-lower) * (rank-seen) / n
+
+            seen += n
+
+        return self.buckets[-1]
+
+    def report(self):
+
+        report = Metric.report(self)
+        for sample in report['samples']:
+
+            (counts, total, count) = sample.pop('value')
+            sample.update({
+                'count':    count,
+                'avg':      total / count if count else 0.0,
+                'p50':      self.quantile(0.50, counts),
+                'p99':      self.quantile(0.99, counts)
+            })
+
+        return report
+
+    def exposition(self):
+        """Cumulative buckets, sum and count of each sample."""
+
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for (lv, (counts, total, count)) in self.samples():
+
+            cumulative = 0
+            for (le, n) in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels + ('le',), lv + (_value(le),)), cumulative))
+
+            lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, lv), _value(total)))
+            lines.append('%s_count%s %d' % (self.name, _labels(self.labels, lv), count))
+
+        return lines
+
+def _value(value):
+    """A sample-value or bucket-bound as text."""
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _labels(names, values):
+    """Label-set in the Prometheus text format, empty without labels."""
+
+    if not names:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+        for (n, v) in zip(names, values)
+    )
+
+def _register(cls, name, *args, **kwargs):
+    """Get the metric registered as name, register a new one when missing."""
+
+    _registry_lock.acquire()
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = cls(name, *args, **kwargs)
+    _registry_lock.release()
+
+    return metric
+
+def counter(name, help, labels=()):
+    return _register(Counter, name, help, labels)
+
+def gauge(name, help, labels=()):
+    return _register(Gauge, name, help, labels)
+
+def histogram(name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return _register(Histogram, name, help, labels, buckets)
+
+def registered():
+    """All registered metrics, in order of registration."""
+
+    _registry_lock.acquire()
+    metrics = _registry.values()
+    _registry_lock.release()
+
+    return metrics
+
+def report():
+    """JSON-serializable state of all metrics."""
+    return dict((m.name, m.report()) for m in registered())
+
+def exposition():
+    """All metrics in the Prometheus text exposition format."""
+
+    lines = []
+    for m in registered():
+        lines.extend(m.exposition())
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""
+Multiplexing of many tunnels over a single carrier connection between peers.
+
+Negotiated during the "/mifcho/handshake" with the X-Mifcho-Mux header, the
+handshaken connection is afterwards used as a carrier of frames::
+
+  type "u8", stream-id "u32", length "u32", payload
+
+Streams opened by the side which sent the handshake have odd ids, streams
+opened by the other side even ids. Each stream has its own send-window,
+the receiver grants more window as the bytes are consumed.
+"""
+import collections
+import threading
+import logging
+import socket
+import struct
+import time
+
+from mifcholib.threadutils import Worker
+from mifcholib.piper import Piper
+
+MUX_VERSION = '0.1'
+
+OPEN        = 1     # payload: "host:port"
+OPEN_OK     = 2
+OPEN_FAIL   = 3
+DATA        = 4     # payload: bytes
+WINDOW      = 5     # payload: "u32" window increment
+CLOSE       = 6
+
+HEADER      = struct.Struct('!BII')
+INCREMENT   = struct.Struct('!I')
+
+WINDOW_SIZE = 262144    # Initial send-window of a stream
+MAX_FRAME   = 16384     # Largest payload of a DATA frame
+
+class Stream:
+    """
+    A logical tunnel on a carrier, quacks like a Connection so it can be
+    handed to a Piper.
+    """
+
+    def __init__(self, carrier, id, address):
+
+        self.carrier    = carrier
+        self.id         = id
+        self.address    = address
+
+        self.use_tls    = False
+        self.callback   = None
+        self.timeout    = None
+
+        self.cond       = threading.Condition()
+        self.chunks     = collections.deque()   # Received, not yet consumed
+        self.received   = 0                     # Bytes in chunks
+        self.consumed   = 0                     # Consumed, not yet granted
+
+        self.window     = WINDOW_SIZE           # Bytes we may send
+        self.opened     = threading.Event()
+        self.accepted   = False                 # Peer connected to endpoint
+        self.closed     = False                 # CLOSE sent or received
+        self.broken     = False                 # Carrier died
+
+    # Called by the carrier
+
+    def feed(self, data):
+
+        self.cond.acquire()
+        self.chunks.append(data)
+        self.received += len(data)
+        self.cond.notify_all()
+        self.cond.release()
+
+    def grant(self, increment):
+
+        self.cond.acquire()
+        self.window += increment
+        self.cond.notify_all()
+        self.cond.release()
+
+    def terminate(self, broken=False):
+
+        self.cond.acquire()
+        self.closed = True
+        self.broken = self.broken or broken
+        self.cond.notify_all()
+        self.cond.release()
+
+        self.opened.set()
+
+    # Connection interface
+
+    def _wait(self, predicate):
+        """Wait on the condition for predicate(), honoring the timeout."""
+
+        deadline = None if self.timeout is None else time.time() + self.timeout
+
+        while not predicate():
+
+            if deadline is None:
+                self.cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('timed out')
+                self.cond.wait(remaining)
+
+    def recv(self, length):
+
+        self.cond.acquire()
+        try:
+            self._wait(lambda: self.chunks or self.closed)
+
+            if not self.chunks:
+                if self.broken:
+                    raise socket.error('Carrier connection lost.')
+                return ''
+
+            data = self.chunks.popleft()
+            if len(data) > length:
+                self.chunks.appendleft(data[length:])
+                data = data[:length]
+
+            self.received -= len(data)
+            self.consumed += len(data)
+
+            grant = self.consumed if self.consumed >= WINDOW_SIZE/2 else 0
+            if grant:
+                self.consumed = 0
+
+        finally:
+            self.cond.release()
+
+        if grant and not self.closed:
+            self.carrier.send_frame(WINDOW, self.id, INCREMENT.pack(grant))
+
+        return data
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+
+        data = self.recv(nbytes or len(buffer))
+        buffer[0:len(data)] = data
+
+        return len(data)
+
+    def read_bytes(self, bytes_to_read):
+
+        data = ''
+        while len(data) < bytes_to_read:
+            chunk = self.recv(bytes_to_read-len(data))
+            if not chunk:
+                break
+            data += chunk
+
+        return data
+
+    def send(self, data, flags=0):
+
+        self.cond.acquire()
+        try:
+            self._wait(lambda: self.window > 0 or self.closed)
+
+            if self.closed:
+                raise socket.error('Stream %d is closed.' % self.id)
+
+            n = min(len(data), self.window, MAX_FRAME)
+            self.window -= n
+
+        finally:
+            self.cond.release()
+
+        self.carrier.send_frame(DATA, self.id, data[:n])
+
+        return n
+
+    def sendall(self, data):
+
+        sent = 0
+        while sent < len(data):
+            sent += self.send(data[sent:])
+
+    def pending(self):
+        return self.received
+
+    def settimeout(self, value):
+        self.timeout = value
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0.0
+
+    def fileno(self):
+        """Streams have no descriptor, they cannot be placed on a reactor."""
+        return None
+
+    def shutdown(self):
+
+        if self.callback:
+            self.callback.set()
+
+        self.cond.acquire()
+        closed = self.closed
+        self.closed = True
+        self.cond.notify_all()
+        self.cond.release()
+
+        if not closed:
+            try:
+                self.carrier.send_frame(CLOSE, self.id)
+            except:
+                logging.debug('Failed sending CLOSE of stream %d.' % self.id)
+
+        self.carrier.remove(self)
+
+    def close(self):
+        pass
+
+    def getpeername(self):
+        return self.address
+
+    def getsockname(self):
+        return self.carrier.conn.getsockname()
+
+    def __str__(self):
+        return 'Stream-%d%s' % (self.id, repr(self.address))
+
+class Carrier(Worker):
+    """
+    Reads frames from the carrier connection and dispatches them to streams.
+
+    Streams are opened with open(address), streams opened by the peer are
+    connected to their endpoint and piped.
+    """
+
+    def __init__(self, cm, conn, peer, initiator):
+
+        self.cm     = cm
+        self.conn   = conn
+        self.peer   = peer
+
+        self.streams        = {}            # id ---> Stream
+        self.streams_lock   = threading.Lock()
+        self.write_lock     = threading.Lock()
+
+        self.next_id    = 1 if initiator else 2
+
+        Worker.__init__(self, name='Carrier')
+
+    def send_frame(self, type, id, payload=''):
+
+        self.write_lock.acquire()
+        try:
+            self.conn.sendall(HEADER.pack(type, id, len(payload)) + payload)
+        finally:
+            self.write_lock.release()
+
+    def open(self, address, timeout=30):
+        """Open a stream to address on the other side, None on failure."""
+
+        self.streams_lock.acquire()
+        stream = Stream(self, self.next_id, address)
+        self.streams[stream.id] = stream
+        self.next_id += 2
+        self.streams_lock.release()
+
+        try:
+            self.send_frame(OPEN, stream.id, '%s:%d' % (address[0], int(address[1])))
+        except:
+            logging.error('Failed sending OPEN of stream %d.' % stream.id, exc_info=3)
+            stream.terminate(True)
+
+        stream.opened.wait(timeout)
+
+        if not stream.accepted:
+            logging.error('Peer failed connecting stream %d to %s.' % (stream.id, repr(address)))
+            self.remove(stream)
+            stream = None
+
+        return stream
+
+    def remove(self, stream):
+
+        self.streams_lock.acquire()
+        self.streams.pop(stream.id, None)
+        self.streams_lock.release()
+
+    def _accept(self, stream):
+        """Connect a stream opened by the peer to its endpoint."""
+
+        ep_conn = self.cm.connect(stream.address)
+
+        if ep_conn:
+            stream.accepted = True
+            self.send_frame(OPEN_OK, stream.id)
+
+            pipe = Piper(self.cm, stream, ep_conn, 4096, sink_recovery=(stream.address, None), peer=self.peer.id)
+            pipe.start()
+            self.cm.pipes.append(pipe)
+
+        else:
+            self.remove(stream)
+            self.send_frame(OPEN_FAIL, stream.id)
+
+    def work(self):
+
+        try:
+            header = self.conn.read_bytes(HEADER.size)
+            if len(header) < HEADER.size:
+                raise EOFError
+            (type, id, length) = HEADER.unpack(header)
+
+            payload = self.conn.read_bytes(length) if length else ''
+            if len(payload) < length:       # Cut short, not a frame
+                raise EOFError
+
+            self.handle(type, id, payload)
+
+        except (socket.error, EOFError):
+            logging.debug('Carrier connection closed.', exc_info=3)
+            self.stop()
+
+        except (struct.error, ValueError):
+            logging.error('Bad frame from peer %s, dropping the carrier.' % self.peer.id, exc_info=3)
+            self.stop()
+
+    def handle(self, type, id, payload):
+        """A frame from the peer, struct.error or ValueError when it is malformed."""
+
+        self.streams_lock.acquire()
+        stream = self.streams.get(id)
+        self.streams_lock.release()
+
+        if type == DATA and stream:
+            stream.feed(payload)
+
+        elif type == WINDOW and stream:
+            stream.grant(INCREMENT.unpack(payload)[0])
+
+        elif type == CLOSE and stream:
+            self.remove(stream)
+            stream.terminate()
+
+        elif type == OPEN:
+            (host, port) = payload.rsplit(':', 1)
+            stream = Stream(self, id, (host, int(port)))
+
+            self.streams_lock.acquire()
+            self.streams[id] = stream
+            self.streams_lock.release()
+
+            t = threading.Thread(target=self._accept, name='Carrier-accept', args=(stream,))
+            t.daemon = True
+            t.start()
+
+        elif type in (OPEN_OK, OPEN_FAIL) and stream:
+            stream.accepted = type == OPEN_OK
+            stream.opened.set()
+
+        else:
+            logging.debug('Ignoring frame %d of stream %d.' % (type, id))
+
+    def stop(self):
+
+        Worker.stop(self)
+
+        if self.peer.carrier is self:
+            self.peer.carrier = None
+
+        self.streams_lock.acquire()
+        streams = self.streams.values()
+        self.streams = {}
+        self.streams_lock.release()
+
+        for stream in streams:
+            stream.terminate(True)
+
+        self.cm.teardown(self.conn)
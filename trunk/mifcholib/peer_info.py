@@ -18,5 +18,6 @@ class PeerInfo:
         self.id           = id
         self.connection   = connection
         self.lock         = threading.Lock()
+        self.carrier      = None      # mux.Carrier when tunnels are multiplexed
 
         self.interface = interface
@@ -4,8 +4,20 @@ import logging
 import time
 import os
 
+import mifcholib.metrics as metrics
 from mifcholib.threadutils import Worker
 
+CPU_SECONDS = metrics.counter(
+    'mifcho_cpu_seconds_total',
+    'CPU time used by the process, mode is "user" or "system".',
+    ('mode',)
+)
+CPU_UTILIZATION = metrics.gauge(
+    'mifcho_cpu_utilization_percent',
+    'CPU utilization over the last sample, mode is "user" or "system".',
+    ('mode',)
+)
+
 class PerformanceCollector(Worker):
     """Collects performance measurements each 'sample_rate' seconds."""
 
@@ -43,6 +55,11 @@ class PerformanceCollector(Worker):
         cpu_util_user   = (user / elapsed)      * 100
         cpu_util_system = (system / elapsed)    * 100
 
+        CPU_SECONDS.inc(user, labels=('user',))
+        CPU_SECONDS.inc(system, labels=('system',))
+        CPU_UTILIZATION.set(cpu_util_user, labels=('user',))
+        CPU_UTILIZATION.set(cpu_util_system, labels=('system',))
+
         self.perf_log.append((            # Add to performance log
           clock,
           cpu_util,
@@ -12,6 +12,13 @@ import ssl
 
 import mifcholib.ws as websocket
 from mifcholib import rfb
+from mifcholib.reactor import Flow, READ, WRITE, ERROR
+from mifcholib.zerocopy import Relay
+from mifcholib.connection import Connection
+from mifcholib.accounting import PipeStats, route_name
+from mifcholib.spool import Spool, SpoolFull
+from mifcholib.compression import DeflateConnection
+from mifcholib.broadcast import Viewer
 
 class Websocket:
     """Piping strategy for websocket protocol translation."""
@@ -23,12 +30,28 @@ class Websocket:
         websocket.send_frame(conn, data)
         return len(data)
 
+class WebsocketRFC6455:
+    """Piping strategy for RFC 6455 websockets, payloads go in binary frames."""
+
+    def on_start(self, source, sink):
+        self.ws_stream = websocket.FrameStream(source)
+
+    def readsource(self, conn):
+        return self.ws_stream.receive_message()
+
+    def writesource(self, conn, data):
+        self.ws_stream.send(data)
+        return len(data)
+
 class Hobs:
     """Piping strategy for Hobs protocol translation."""
     
+    hobs_waiters    = None              # WaiterTable the data for the client is put in
+    hobs_sid        = None              # Session-id, the key in hobs_waiters
+    hobs_sessions   = None              # Sessions of the handler, sid ---> session
+
     def on_start(self, source, sink):
         self.hobs_in_queue  = Queue.Queue() # Contains data read from the socket
-        self.hobs_out_queue = Queue.Queue() # Contains data that will be written to the socket
     
     def readsource(self, conn):
         
@@ -41,21 +64,27 @@ class Hobs:
         return data
     
     def writesource(self, conn, data):
-        
-        try:
-            self.hobs_out_queue.put_nowait(data)
-            written = len(data)
-        except:
-            logging.debug('Error during pseudo-write to queue...')
-            written = 0
-            
-        return written
+                                        # Wakes the poll of the client
+        if not self.hobs_waiters.put(self.hobs_sid, data):
+            logging.error('Hobs-session %s is not polled, dropping it.' % self.hobs_sid)
+            self.running = False
+
+        return len(data)
+
+    def on_stop(self):
+
+        self.hobs_in_queue.put('')      # Wakes the reading of the client-direction
+
+        if self.hobs_sessions is not None:
+            self.hobs_sessions.pop(self.hobs_sid, None)
+        self.hobs_waiters.discard(self.hobs_sid)
 
 class Vnc:
     """Binding of RFBStatemachine to the flow of data of a Pipe."""
     
     def on_start(self, source, sink):
-        self.rfb_state  = rfb.RFBStatemachine()
+                                # Mirror the screen to replay it on recovery
+        self.rfb_state  = rfb.RFBStatemachine(stream_rectangles=True, mirror=bool(self.sink_recovery))
         
     def on_readsource(self, data, data_l):
         return self.rfb_state.from_cli(data, data_l)
@@ -70,7 +99,9 @@ class BasePiper(threading.Thread):
 
     piper_count = 0
 
-    def __init__(self, cm, source, sink, buffer_size = 4096, source_recovery=None, sink_recovery=None):
+    relay_size  = 65536     # Chunk size when relaying without inspection
+
+    def __init__(self, cm, source, sink, buffer_size = 4096, source_recovery=None, sink_recovery=None, route=None, peer=None):
 
         self.cm     = cm
         self.source = source
@@ -79,6 +110,14 @@ class BasePiper(threading.Thread):
         
         self.source_recovery = source_recovery
         self.sink_recovery   = sink_recovery
+
+        if sink_recovery:       # Route and peer of the recoverable sink
+            route   = route or route_name(sink_recovery[0])
+            peer    = peer or sink_recovery[1]
+        self.stats = PipeStats(route, peer)
+        self.stats.compression = self.deflated()
+
+        self.reactor = None     # Set when piping on a reactor
         
         count = Piper.piper_count # Set the object counter
         Piper.piper_count += 1
@@ -89,12 +128,12 @@ class BasePiper(threading.Thread):
         self.sink_wait = threading.Event()
         
         self.threads.append(threading.Thread(
-            target=self.pipe,
+            target=self.pipe_direction,
             name=thread_name+'-source-to-sink',
             args=(source, sink, 'source_to_sink')
         ))
         self.threads.append(threading.Thread(
-            target=self.pipe,
+            target=self.pipe_direction,
             name=thread_name+'-sink-to-source',
             args=(sink, source,'sink_to_source')
         ))
@@ -105,10 +144,188 @@ class BasePiper(threading.Thread):
         threading.Thread.__init__(self, name=thread_name)
         self.daemon = True      
 
+    def start(self):
+        """
+        Start piping, on a reactor when the connection-manager runs the
+        reactor engine and the pipe allows it, otherwise in threads.
+        """
+
+        reactor = self.cm.pick_reactor() if self.reactive() else None
+
+        self.cm.traffic.open(self.stats)
+
+        if reactor is not None:
+            self.reactor = reactor
+            reactor.call_soon(self._attach)
+        else:
+            threading.Thread.start(self)
+
+    def deflated(self):
+        """The end of the pipe with deflate framing, None without."""
+
+        for end in [self.source, self.sink]:
+            if isinstance(end, DeflateConnection):
+                return end
+
+        return None
+
+    def reactive(self):
+        """
+        Both ends must be sockets, mux streams have no descriptor to wait on,
+        and VNC sink-recovery must not be needed, since recovery blocks while
+        waiting for the peer to return. Nor can websockets or deflated ends,
+        which block until a whole frame is read, or TLS ends, whose reads and
+        writes want the other direction.
+        """
+        return  self.source is not None and \
+                self.sink is not None and \
+                not self.source.use_tls and \
+                not self.sink.use_tls and \
+                not isinstance(self.sink, Viewer) and \
+                isinstance(self.source.fileno(), (int, long)) and \
+                isinstance(self.sink.fileno(), (int, long)) and \
+                not (isinstance(self, Vnc) and self.sink_recovery) and \
+                not isinstance(self, (Websocket, WebsocketRFC6455)) and \
+                self.deflated() is None
+
+    def relayable(self):
+        """
+        True for plain TCP pipes, no strategy-hook is overridden and no end
+        uses TLS, the bytes can then be relayed without entering Python.
+        """
+
+        for hook in ['readsource', 'readsink', 'writesource', 'writesink', 'on_readsource', 'on_readsink']:
+            if getattr(self, hook).im_func is not getattr(BasePiper, hook).im_func:
+                return False
+
+        return  isinstance(self.source, Connection) and not self.source.use_tls and \
+                isinstance(self.sink, Connection) and not self.sink.use_tls
+
+    def relay(self, input_socket, output_socket, direction):
+        """Threaded piping of a relayable pipe."""
+
+        relay = Relay(input_socket, output_socket, self.relay_size, stats=getattr(self.stats, direction))
+
+        try:
+            relay.run(lambda: self.running)
+        except:
+            logging.debug('Relay error...', exc_info=3)
+
+        relay.close()
+        self.running = False
+
+        self.cm.teardown(input_socket)
+        self.cm.teardown(output_socket)
+
+    def _attach(self):
+        """Register the pipe with its reactor, called on the reactor thread."""
+
+        logging.debug('STARTING %s <--> %s on %s', str(self.source), str(self.sink), self.reactor.name)
+        self.on_start(self.source, self.sink)
+
+        self.running    = True
+        self.flow_in    = {}    # fd ---> Flow reading from fd
+        self.flow_out   = {}    # fd ---> Flow writing to fd
+        self.interest   = {}    # fd ---> registered events
+
+        relay = self.relayable()
+        if relay:                       # Relays never block the reactor
+            self.source.setblocking(0)
+            self.sink.setblocking(0)
+
+        for (input_conn, output_conn, read_input, on_read_input, write_output, default_write, stats) in [
+            (self.source, self.sink, self.readsource, self.on_readsource, self.writesink, BasePiper.writesink, self.stats.source_to_sink),
+            (self.sink, self.source, self.readsink, self.on_readsink, self.writesource, BasePiper.writesource, self.stats.sink_to_source)
+        ]:
+            plain_write = write_output.im_func is default_write.im_func and \
+                          not output_conn.use_tls
+
+            if relay:
+                flow = Relay(input_conn, output_conn, self.relay_size, stats=stats)
+            else:
+                flow = Flow(self, input_conn, output_conn, read_input, on_read_input, write_output, plain_write, stats)
+            self.flow_in[input_conn.fileno()]   = flow
+            self.flow_out[output_conn.fileno()] = flow
+
+        for fd in self.flow_in:
+            self.interest[fd] = READ
+            self.reactor.register(fd, READ, self._on_event)
+
+        for fd in self.flow_in:         # Bytes which are already buffered
+            if self.flow_in[fd].input_conn.pending():
+                self._on_event(fd, READ)
+
+    def _on_event(self, fd, events):
+
+        if not self.running:
+            return
+
+        try:
+            if events & WRITE:                          # Output drained
+                self.flow_out[fd].flush()
+
+            if events & READ and not self.flow_in[fd].paused:
+                self.flow_in[fd].on_readable()
+
+            elif events & ERROR:
+                raise EOFError
+
+        except EOFError:
+            logging.debug('Connection closed.')
+            self.stop()
+            return
+
+        except websocket.ConnectionTerminatedException:
+            logging.debug('CLIENT LEFT!, just go home...')
+            self.stop()
+            return
+
+        except:
+            logging.debug('Error while piping.', exc_info=3)
+            self.stop()
+            return
+
+        for fd in self.interest:                        # Pause / resume
+            events = 0
+            if not self.flow_in[fd].paused:
+                events |= READ
+            if self.flow_out[fd].paused:
+                events |= WRITE
+
+            if events != self.interest[fd]:
+                self.interest[fd] = events
+                self.reactor.modify(fd, events)
+
+    def _detach(self):
+        """Unregister the pipe from its reactor, called on the reactor thread."""
+
+        for fd in self.interest:
+            self.reactor.unregister(fd)
+            self.flow_in[fd].close()
+        self.interest = {}
+
+        self.cm.traffic.close(self.stats)
+        logging.debug('STOPPED %s <--> %s', str(self.source), str(self.sink))
+
     def on_start(self, source, sink):
         """Override this to do something before the actual piping starts."""
         pass
 
+    def on_stop(self):
+        """
+        Override this to release what the other direction might block on,
+        called by each direction of a threaded pipe when it stops.
+        """
+        pass
+
+    def pipe_direction(self, input_socket, output_socket, direction):
+        """Thread of one direction, on_stop() is called however piping ends."""
+
+        try:
+            self.pipe(input_socket, output_socket, direction)
+        finally:
+            self.on_stop()
+
     def readsource(self, conn):
         """Override this to handle reading data from the source differently."""
         return conn.recv(self.buffer_size)
@@ -155,6 +372,10 @@ class BasePiper(threading.Thread):
             # TODO: raise an expection...
             logging.error('Unsupported direction: %s.' % repr(direction))
         
+        if self.relayable():                        # No inspection needed
+            return self.relay(input_socket, output_socket, direction)
+        
+        stats   = getattr(self.stats, direction)
         buff    = bytearray()                                   # Buffer
         buff_l  = len(buff)         
         
@@ -179,6 +400,8 @@ class BasePiper(threading.Thread):
                         )
                     else:
                             del buff[:to_send]  # Remove bytes sent from buffer                            
+                    
+                    stats.record(len(data), len(buff))
                                                 
                 else:
                     logging.debug('ERROR receiving, data == None!')
@@ -216,12 +439,20 @@ class BasePiper(threading.Thread):
         for t in self.threads:
             t.join()
 
+        self.cm.traffic.close(self.stats)
         logging.debug('STOPPED %s <--> %s', source_name, sink_name)
 
     def stop(self):
 
+        if self.reactor is not None and threading.current_thread() is not self.reactor:
+            self.reactor.call_soon(self.stop)   # Descriptors are owned by the reactor
+            return
+
         self.running = False        # End while-condition
 
+        if self.reactor is not None:
+            self._detach()
+
         self.cm.teardown(self.source)
         self.cm.teardown(self.sink)
 
@@ -251,6 +482,10 @@ class Piper(BasePiper):
             # TODO: raise an expection...
             logging.error('Unsupported direction: %s.' % repr(direction))
         
+        if self.relayable():                        # No inspection needed
+            return self.relay(input_socket, output_socket, direction)
+        
+        stats   = getattr(self.stats, direction)
         buff    = bytearray()                       # Buffer
         buff_l  = len(buff)        
         
@@ -260,6 +495,7 @@ class Piper(BasePiper):
         # For attempting to shield an error.
         attempting_recovery = False
         giveup = 5
+        spool = None                                # Source bytes read during recovery
         
         while self.running:                         # Piping loop
             
@@ -287,17 +523,14 @@ class Piper(BasePiper):
                 self.cm.register_callback(e, self.sink_recovery[1])
                 
                 # Send data to the client which it might need
-                if self.rfb_state.state == 110:
+                if self.rfb_state.state in (rfb.SRV_FBUFFER_ENC_RAW, rfb.SRV_FBUFFER_ENC_CURSOR):
                     logging.debug('Send pseudo rectangle of these dimensions: %s.' % pprint.pformat(self.rfb_state.rectangle))
                     
-                    fb_size = (
-                        self.rfb_state.rectangle['w'] * \
-                        self.rfb_state.rectangle['h'] * \
-                        (self.rfb_state.server['bpp'] / 8 )
-                    )
-                    fake_fb = struct.pack('!B',100)*fb_size
+                    # Complete the payload, part of it is sent already
+                    fake_fb = struct.pack('!B',100)*self.rfb_state.payload_left()
                     write_output(output_socket, fake_fb)
                     
+                    self.rfb_state.srv_payload_read = 0
                     self.rfb_state.nor -= 1
                     
                     fake_fb = struct.pack('!B', 100)*10*10*4
@@ -319,7 +552,11 @@ class Piper(BasePiper):
                 x_pos = int(abs((self.rfb_state.server['w']/2)-int(400/2)))
                 y_pos = int(abs((self.rfb_state.server['h']/2))-int(100/2))
                 
-                fake_fb         = rfb.fb_from_file(x_pos, y_pos, 400, 100, 'mifchomedia/please_wait.bmp')
+                overlay = rfb.Rectangle(x_pos, y_pos, 400, 100, rfb.image_from_file('mifchomedia/please_wait.bmp'))
+                if self.rfb_state.framebuffer is not None:  # Last known screen, overlay on top
+                    fake_fb = self.rfb_state.framebuffer.update(overlay)
+                else:
+                    fake_fb = rfb.framebufferUpdate([overlay])
                 fake_fb_sent    = write_output(output_socket, fake_fb)
                 logging.debug('Sending f_fb done.')
                 
@@ -327,6 +564,7 @@ class Piper(BasePiper):
                 e.wait()
                 
                 input_socket = self.sink = self.cm.connect(self.sink_recovery[0], self.sink_recovery[1])
+                self.stats.compression = self.deflated()
                                     
                 rfb.faked_client(input_socket)      # Do vnc-handshake
                 del buff[0:len(buff)]               # Empty the old buffer
@@ -338,21 +576,42 @@ class Piper(BasePiper):
             
             elif attempting_recovery and direction == 'source_to_sink' and 'rfb_state' in dir(self):
                 
-                # NOTE: Trying to keep on reading from source...
-                # buffering it until output_socket comes back online...
-                # this could exhaust memory...
-                logging.debug('Buffering during recovery... buff_l %d.' % len(buff))
-                start   = time.time()
-                self.sink_wait.wait(1.0)
-                elapsed = time.time() - start
+                # Keep on reading from source, spooling it until
+                # output_socket comes back online, within the limits of
+                # recovery buffering.
+                if spool is None:
+                    spool = Spool(self.cm.recovery_budget, self.cm.recovery_memory, self.cm.recovery_disk)
+                
+                logging.debug('Buffering during recovery... spooled %d.' % len(spool))
+                if not spool:                       # Give the sink a moment, then keep reading
+                    self.sink_wait.wait(1.0)
                 
-                if elapsed < 1.0:                    
+                if self.sink_wait.is_set():
                     output_socket   = self.sink
                     
                     giveup              -= 1                    
                     attempting_recovery = False
                     self.sink_wait.clear()
                     
+                    try:                            # Replay, in order
+                        for data in spool.drain():
+                            
+                            buff.extend(data)
+                            to_send     = on_read_input(buff, len(buff))
+                            bytes_sent  = 0
+                            while bytes_sent < to_send:
+                                bytes_sent += write_output(
+                                    output_socket, str(buff[bytes_sent:to_send])
+                                )
+                            del buff[:to_send]
+                    except:
+                        logging.debug('ERROR replaying spooled bytes.', exc_info=3)
+                        self.running = False
+                    
+                    spool.close()
+                    spool           = None
+                    stats.spooled   = 0
+                    
                 else:
                 
                     try:
@@ -366,8 +625,15 @@ class Piper(BasePiper):
                    
                     if data:
                         
-                        buff.extend(data)               # Buffer it
-                        buff_l  = len(buff)
+                        try:
+                            spool.write(data)           # Buffer it
+                        except SpoolFull:
+                            logging.error('Recovery buffer is full, dropping the session.')
+                            self.running = False
+                            break
+                        
+                        stats.record(len(data), len(buff))
+                        stats.spooled = len(spool)
                         
                     else:
                         logging.debug('ERROR receiving, data == None!')
@@ -403,6 +669,8 @@ class Piper(BasePiper):
                                 )
                             else:
                                 del buff[:to_send]  # Remove bytes sent from buffer                            
+                            
+                            stats.record(len(data), len(buff))
                                 
                         except:
                             logging.debug('ERROR sending bytes, bytes_sent %d, to_send %d.' % (bytes_sent, to_send))
@@ -411,7 +679,7 @@ class Piper(BasePiper):
                     else:
                         logging.debug('ERROR receiving, data == None!')
                         
-                        if 'rfb_state' in dir(self):
+                        if 'rfb_state' in dir(self) and self.sink_recovery:
                             if giveup < 1:
                                 self.running = False
                                 logging.debug('Giving up...')
@@ -426,7 +694,7 @@ class Piper(BasePiper):
                 except socket.timeout:
                     logging.debug('Socket timeout...')
                     #pass
-                    if 'rfb_state' in dir(self):
+                    if 'rfb_state' in dir(self) and self.sink_recovery:
                         if giveup < 1:
                             self.running = False
                             logging.debug('Giving up...')
@@ -440,7 +708,7 @@ class Piper(BasePiper):
                 except socket.error:
                     logging.debug('Socket error...', exc_info=3)
                     
-                    if 'rfb_state' in dir(self):
+                    if 'rfb_state' in dir(self) and self.sink_recovery:
                         if giveup < 1:
                             self.running = False
                             logging.debug('Giving up...')
@@ -455,14 +723,19 @@ class Piper(BasePiper):
                     self.running = False
                     
                 except:
-                    #self.running = False
-                    if 'rfb_state' in dir(self):
+                    if 'rfb_state' in dir(self) and self.sink_recovery:
                         if giveup < 1:
                             self.running = False
                             logging.debug('Giving up...')
                         else:
                             attempting_recovery = True
                             logging.debug("Will attempt recovery.")
+                    else:
+                        logging.debug('Error piping.', exc_info=3)
+                        self.running = False
+
+        if spool is not None:
+            spool.close()
 
         self.cm.teardown(input_socket)
         self.cm.teardown(output_socket)
@@ -485,14 +758,9 @@ class Piper(BasePiper):
         for t in self.threads:
             t.join()
 
+        self.cm.traffic.close(self.stats)
         logging.debug('STOPPED %s <--> %s', source_name, sink_name)
 
-    def stop(self):
-
-        self.running = False        # End while-condition
-
-        self.cm.teardown(self.source)
-        self.cm.teardown(self.sink)
 
 class VncPiper(Vnc, Piper):
     """Piper with VNC inspection."""
@@ -515,4 +783,15 @@ class WebsocketPiper(Websocket, Piper):
 
 class WebsocketVncPiper(Vnc, Websocket, Piper):
     """Piper with translation of websockets to sockets and VNC inspection."""
-    pass
\ No newline at end of file
+    pass
+
+class WebsocketRFC6455Piper(WebsocketRFC6455, Piper):
+    """Piper with translation from RFC 6455 websockets to sockets."""
+    pass
+
+class WebsocketRFC6455VncPiper(Vnc, WebsocketRFC6455, Piper):
+    """Piper with translation of RFC 6455 websockets to sockets and VNC inspection."""
+
+    def on_start(self, source, sink):
+        Vnc.on_start(self, source, sink)
+        WebsocketRFC6455.on_start(self, source, sink)
\ No newline at end of file
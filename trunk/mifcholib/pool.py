@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Warm pool of connections to the interfaces of peers.
+
+Tunnelling via a peer needs a connection to the peer interface before the
+tunnel-request can be sent, with TLS that is several round-trips. The pool
+keeps such connections established ahead of time. Each pooled connection
+has sent a "/mifcho/park" request, so the peer waits for the tunnel
+request without holding up its listener.
+"""
+import collections
+import threading
+import logging
+import select
+import socket
+import time
+
+import mifcholib.messages as messages
+from mifcholib.connection import Connection
+from mifcholib.threadutils import Worker
+
+class CarrierPool(Worker):
+    """
+    Keeps between min_size and max_size idle connections per peer interface.
+
+    The amount kept grows towards max_size when take() misses and shrinks
+    towards min_size when connections expire after idle_timeout seconds.
+    An interface refusing to park is tried again after 'backoff' seconds,
+    doubling up to max_backoff while it keeps refusing.
+    """
+
+    def __init__(self, cm, min_size=2, max_size=8, idle_timeout=60, interval=1.0, backoff=30, max_backoff=600):
+
+        self.cm             = cm
+        self.min_size       = int(min_size)
+        self.max_size       = max(int(max_size), self.min_size)
+        self.idle_timeout   = float(idle_timeout)
+        self.interval       = interval
+        self.backoff        = backoff
+        self.max_backoff    = max_backoff
+
+        self.cond   = threading.Condition()
+        self.idle   = {}            # interface ---> deque of (conn, established)
+        self.target = {}            # interface ---> amount to keep
+        self.broken = {}            # interface ---> (retry at, backoff) when refusing to park
+
+        self.stats  = collections.defaultdict(lambda: {
+            'hits':             0,
+            'misses':           0,
+            'refills':          0,
+            'refill_failures':  0,
+            'refill_time':      0.0,    # Sum of refill latencies
+            'refill_max':       0.0,
+            'expired':          0
+        })
+
+        Worker.__init__(self, name='CarrierPool')
+
+    def take(self, peer):
+        """Get an established connection to the interface of peer, None on miss."""
+
+        key = peer.interface[:2] + (peer.interface[3],)
+        conn = None
+
+        self.cond.acquire()
+        idle = self.idle.get(key)
+        while idle and not conn:
+
+            (candidate, established) = idle.pop()       # Newest first
+            if self._alive(candidate):
+                conn = candidate
+            else:
+                self.cm.teardown(candidate)
+
+        if conn:
+            self.stats[key]['hits'] += 1
+        else:
+            self.stats[key]['misses'] += 1
+            self.target[key] = min(self.max_size, self.target.get(key, self.min_size)+1)
+
+        self.cond.notify()                              # Refill
+        self.cond.release()
+
+        return conn
+
+    def _alive(self, conn):
+        """A parked connection must not be readable, that would be EOF or garbage."""
+
+        try:
+            (r, _, _) = select.select([conn], [], [], 0)
+        except (select.error, socket.error):
+            return False
+
+        return not r and not conn.pending()
+
+    def _dial(self, key):
+        """Establish a connection and park it at the peer."""
+
+        conn = None
+        begin = time.time()
+
+        try:
+            conn = Connection.fromaddress(key[:2], key[2])
+            self.cm.opened.append(conn)
+
+            conn.settimeout(10)                     # Older peers never answer
+            messages.PARK.send(conn, self.cm.identifier)
+            (version, status, reason, headers) = messages.get_response(conn)
+            conn.settimeout(None)
+
+            if int(status) != 200:
+                raise ValueError('Peer refused parking: %s %s' % (status, reason))
+
+            self.broken.pop(key, None)
+
+        except ValueError:
+            backoff = min(self.max_backoff, self.broken[key][1]*2) if key in self.broken else self.backoff
+            logging.error('Peer %s does not support pooling, retrying in %gs.' % (repr(key), backoff), exc_info=3)
+            self.broken[key] = (time.time() + backoff, backoff)
+            if conn:
+                self.cm.teardown(conn)
+            conn = None
+
+        except:
+            logging.debug('Failed refilling pool for %s.' % repr(key), exc_info=3)
+            if conn:
+                self.cm.teardown(conn)
+            conn = None
+
+        return (conn, time.time() - begin)
+
+    def work(self):
+
+        self.cm.peer_lock.acquire()
+        keys = [p.interface[:2] + (p.interface[3],) for p in self.cm.peers.values() if p.interface]
+        self.cm.peer_lock.release()
+
+        now = time.time()
+        for key in (k for k in keys if k not in self.broken or self.broken[k][0] <= now):
+
+            self.cond.acquire()
+            idle = self.idle.setdefault(key, collections.deque())
+            target = self.target.setdefault(key, self.min_size)
+
+            while idle and now - idle[0][1] > self.idle_timeout:
+                (conn, established) = idle.popleft()        # Expire oldest
+                self.cm.teardown(conn)
+                self.stats[key]['expired'] += 1
+                self.target[key] = target = max(self.min_size, target-1)
+
+            missing = target - len(idle)
+            self.cond.release()
+
+            for _ in xrange(missing):                       # Dial outside the lock
+
+                (conn, latency) = self._dial(key)
+
+                self.cond.acquire()
+                stats = self.stats[key]
+                if conn:
+                    idle.append((conn, time.time()))
+                    stats['refills']     += 1
+                    stats['refill_time'] += latency
+                    stats['refill_max']   = max(stats['refill_max'], latency)
+                else:
+                    stats['refill_failures'] += 1
+                self.cond.release()
+
+                if not conn:
+                    break
+
+        self.cond.acquire()
+        if self.running:
+            self.cond.wait(self.interval)
+        self.cond.release()
+
+    def deallocate(self):
+
+        self.cond.acquire()
+        self.cond.notify()
+        for idle in self.idle.values():
+            for (conn, established) in idle:
+                self.cm.teardown(conn)
+            idle.clear()
+        self.cond.release()
+
+    def report(self):
+        """Per interface: idle connections, hit-rate and refill latency."""
+
+        report = []
+
+        self.cond.acquire()
+        for (key, stats) in self.stats.items():
+
+            takes = stats['hits'] + stats['misses']
+            report.append({
+                'interface':        '%s:%d' % key[:2],
+                'tls':              key[2],
+                'broken':           key in self.broken,
+                'idle':             len(self.idle.get(key, [])),
+                'target':           self.target.get(key, self.min_size),
+                'hits':             stats['hits'],
+                'misses':           stats['misses'],
+                'hit_rate':         float(stats['hits']) / takes if takes else 0.0,
+                'refills':          stats['refills'],
+                'refill_failures':  stats['refill_failures'],
+                'refill_avg':       stats['refill_time'] / stats['refills'] if stats['refills'] else 0.0,
+                'refill_max':       stats['refill_max'],
+                'expired':          stats['expired']
+            })
+        self.cond.release()
+
+        return report
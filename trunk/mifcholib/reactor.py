@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+Reactor - event-loop multiplexing many connections in a single thread.
+
+Uses epoll when available and falls back to select() elsewhere.
+"""
+import multiprocessing
+import collections
+import threading
+import logging
+import select
+import socket
+import errno
+import fcntl
+import heapq
+import time
+import os
+
+from mifcholib.threadutils import Worker
+
+READ    = 0x001                         # Same values as select.EPOLLIN etc.
+WRITE   = 0x004
+ERROR   = 0x008 | 0x010
+
+class _EpollPoller:
+    """Thin wrapper around select.epoll."""
+
+    def __init__(self):
+        self.ep = select.epoll()
+
+    def register(self, fd, events):
+        self.ep.register(fd, events)
+
+    def modify(self, fd, events):
+        self.ep.modify(fd, events)
+
+    def unregister(self, fd):
+        self.ep.unregister(fd)
+
+    def poll(self, timeout):
+        return self.ep.poll(timeout)
+
+class _SelectPoller:
+    """Poller with the epoll interface on top of select()."""
+
+    def __init__(self):
+        self.fds = {}
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+
+    def modify(self, fd, events):
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        self.fds.pop(fd, None)
+
+    def poll(self, timeout):
+
+        rlist = [fd for (fd, ev) in self.fds.items() if ev & READ]
+        wlist = [fd for (fd, ev) in self.fds.items() if ev & WRITE]
+
+        (r, w, x) = select.select(rlist, wlist, rlist+wlist, None if timeout < 0 else timeout)
+
+        events = collections.defaultdict(int)
+        for fd in r:
+            events[fd] |= READ
+        for fd in w:
+            events[fd] |= WRITE
+        for fd in x:
+            events[fd] |= ERROR
+
+        return events.items()
+
+class Timer:
+    """A call placed with call_later(), cancel() drops it unless it ran."""
+
+    def __init__(self, reactor, fun, args):
+
+        self.reactor    = reactor
+        self.fun        = fun
+        self.args       = args
+
+    def cancel(self):
+        self.reactor._cancel(self)
+
+class Reactor(Worker):
+    """
+    Waits for readiness of registered file-descriptors and calls back.
+
+    register/modify/unregister must be called from the reactor thread, use
+    call_soon() to get there from any other thread.
+    """
+
+    def __init__(self, name='Reactor'):
+
+        self.poller     = _EpollPoller() if hasattr(select, 'epoll') else _SelectPoller()
+        self.callbacks  = {}                        # fd ---> callback(fd, events)
+
+        self.pending    = collections.deque()       # Calls from other threads
+        self.timers     = []                        # Heap of (deadline, seq, Timer)
+        self.timer_seq  = 0
+        self.cancelled  = 0                         # Timers in the heap which will not run
+        self.lock       = threading.Lock()
+
+        (self.wake_r, self.wake_w) = os.pipe()      # Self-pipe for wake-ups
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wake_r, READ)
+
+        Worker.__init__(self, name=name)
+
+    def __len__(self):
+        """Amount of registered file-descriptors, used for balancing."""
+        return len(self.callbacks)
+
+    def register(self, fd, events, callback):
+        self.callbacks[fd] = callback
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+
+        if self.callbacks.pop(fd, None):
+            try:
+                self.poller.unregister(fd)
+            except (IOError, OSError, ValueError):    # Already closed
+                pass
+
+    def call_soon(self, fun, *args):
+        """Thread-safe: run fun(*args) on the reactor thread."""
+
+        self.pending.append((fun, args))
+        self.wake()
+
+    def call_later(self, delay, fun, *args):
+        """Run fun(*args) on the reactor thread in 'delay' seconds, returns a Timer."""
+
+        timer = Timer(self, fun, args)
+
+        self.lock.acquire()
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.time()+delay, self.timer_seq, timer))
+        self.lock.release()
+
+        self.wake()
+        return timer
+
+    def _cancel(self, timer):
+        """
+        Thread-safe, the timer stays in the heap until it is due. Once most
+        of the heap is cancelled it is rebuilt without them.
+        """
+
+        self.lock.acquire()
+        if timer.fun is not None:
+            timer.fun = timer.args = None       # Drop what it holds on to
+            self.cancelled += 1
+
+            if self.cancelled > 64 and self.cancelled * 2 > len(self.timers):
+                self.timers = [t for t in self.timers if t[2].fun is not None]
+                heapq.heapify(self.timers)
+                self.cancelled = 0
+        self.lock.release()
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError:                             # Pipe is full, so it is awake
+            pass
+
+    def work(self):
+
+        timeout = -1                                # Block until something happens
+        if self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+
+        try:
+            events = self.poller.poll(timeout)
+        except (IOError, OSError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for (fd, ev) in events:
+
+            if fd == self.wake_r:
+                try:
+                    while os.read(self.wake_r, 4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+
+            callback = self.callbacks.get(fd)
+            if callback:
+                self._run(callback, (fd, ev))
+
+        now = time.time()                           # Expired timers
+        while self.timers and self.timers[0][0] <= now:
+            self.lock.acquire()
+            (_, _, timer) = heapq.heappop(self.timers)
+            (fun, args) = (timer.fun, timer.args)
+            if fun is None:
+                self.cancelled -= 1
+            timer.fun = timer.args = None
+            self.lock.release()
+
+            if fun is not None:
+                self._run(fun, args)
+
+        while self.pending:                         # Calls from other threads
+            (fun, args) = self.pending.popleft()
+            self._run(fun, args)
+
+    def _run(self, fun, args):
+
+        try:
+            fun(*args)
+        except:
+            logging.error('Unhandled error in reactor callback.', exc_info=3)
+
+    def deallocate(self):
+        self.wake()
+
+class ReactorPool:
+    """A small set of reactors, pipes are placed on the least loaded one."""
+
+    def __init__(self, count=1):
+
+        count = int(count) or multiprocessing.cpu_count()   # 0 = one per core
+        self.reactors = [Reactor('Reactor-%d' % i) for i in xrange(count)]
+
+    def pick(self):
+        return min(self.reactors, key=len)
+
+    def start(self):
+        for r in self.reactors:
+            r.start()
+
+    def stop(self):
+        for r in self.reactors:
+            r.stop()
+
+    def join(self):
+        for r in self.reactors:
+            r.join()
+
+class Flow:
+    """
+    One direction of a pipe driven by a reactor.
+
+    Reads through the strategy-hook read_input when the input is readable,
+    inspects with on_read_input and writes with write_output. When the
+    write-hook is a plain send the write is done without blocking the
+    reactor, in that case the input is paused until the output drains.
+    """
+
+    def __init__(self, piper, input_conn, output_conn, read_input, on_read_input, write_output, plain_write, stats=None):
+
+        self.piper          = piper
+        self.input_conn     = input_conn
+        self.output_conn    = output_conn
+        self.read_input     = read_input
+        self.on_read_input  = on_read_input
+        self.write_output   = write_output
+        self.plain_write    = plain_write
+        self.stats          = stats         # FlowStats counting what is read
+
+        self.buff       = bytearray()
+        self.to_send    = 0         # Bytes of buff released by inspection
+        self.paused     = False     # Input paused while output is blocked
+
+    def on_readable(self):
+        """Read, inspect and forward as long as data is immediately available."""
+
+        while not self.paused:
+
+            data = self.read_input(self.input_conn)
+            if not data:
+                raise EOFError
+
+            self.buff.extend(data)
+            self.to_send = self.on_read_input(self.buff, len(self.buff))
+            self.flush()
+
+            if self.stats is not None:
+                self.stats.record(len(data), len(self.buff))
+
+            if not self.input_conn.pending():
+                break
+
+    def flush(self):
+        """Write what inspection has released, returns True when all was written."""
+
+        bytes_sent = 0
+
+        try:
+            while bytes_sent < self.to_send:
+
+                chunk = str(self.buff[bytes_sent:self.to_send])
+                if self.plain_write:
+                    bytes_sent += self.output_conn.send(chunk, socket.MSG_DONTWAIT)
+                else:
+                    bytes_sent += self.write_output(self.output_conn, chunk)
+
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        del self.buff[:bytes_sent]
+        self.to_send -= bytes_sent
+
+        self.paused = self.to_send > 0
+        return not self.paused
+
+    def close(self):
+        pass
@@ -39,7 +39,6 @@ import binascii
 import logging
 import pprint
 import struct
-import math
 
 # Various states
 READ_VERSION    = 0
@@ -403,13 +402,22 @@ def produce_framebuffer(w, h):
     r = Rectangle(0,0,w,h, test*w*h*4)
     return framebufferUpdate([r])
 
-def fb_from_file(x, y, w, h, file):
+_IMAGES = {}    # Pixels of image files, by path
 
-    fd      = open(file,'rb')   # Grab image for FB
-    buff    = fd.read()[71:]+struct.pack('B', 0)            # Add pseudo-alpha
-    fd.close()
-    
-    return framebufferUpdate([Rectangle(x, y, w, h, buff)])
+def image_from_file(file):
+    """Pixels of a bitmap, read once and kept in memory."""
+
+    if file not in _IMAGES:
+        fd      = open(file,'rb')   # Grab image for FB
+        buff    = fd.read()[71:]+struct.pack('B', 0)        # Add pseudo-alpha
+        fd.close()
+
+        _IMAGES[file] = buff
+
+    return _IMAGES[file]
+
+def fb_from_file(x, y, w, h, file):
+    return framebufferUpdate([Rectangle(x, y, w, h, image_from_file(file))])
 
 def faked_server(conn):
     """
@@ -456,12 +464,24 @@ def faked_server(conn):
     r = Rectangle(0, 0, 400, 100, buff)    
     conn.send(framebufferUpdate([r]))
 
+def _recv_bytes(conn, length):
+    """Receive exactly 'length' bytes, recv() may hand out less."""
+    
+    data = ''
+    while len(data) < length:
+        chunk = conn.recv(length-len(data))
+        if not chunk:
+            break
+        data += chunk
+    
+    return data
+
 def faked_client(conn):
     
     secType = 1 # AuthentificationType = None
           
     # Receive protocol version, send protocol version
-    srv_ver = conn.recv(12)
+    srv_ver = _recv_bytes(conn, 12)
     logging.debug('Received protocol [%s] from vncserver ' %  srv_ver)
     
     if srv_ver == protocolVersion():
@@ -471,23 +491,23 @@ def faked_client(conn):
       logging.debug('Closed connection due to invalid version.')
     
     # Receive security type count, choose one and send it back  
-    srv_sec_count =  struct.unpack('!B', conn.recv(1))
+    srv_sec_count =  struct.unpack('!B', _recv_bytes(conn, 1))
     
     if (srv_sec_count > 0):
-      srv_sec_types = conn.recv(srv_sec_count[0])
+      srv_sec_types = _recv_bytes(conn, srv_sec_count[0])
       logging.debug('Received security types [%s] from vncserver ' % binascii.hexlify(srv_sec_types))
       logging.debug('Sending choice [%s] to vncserver ' % binascii.hexlify(securityType(secType)))
       
       conn.sendall(securityType(secType))
         
-    srv_sec_res = conn.recv(4)      # Receive security result
+    srv_sec_res = _recv_bytes(conn, 4)      # Receive security result
     
     conn.sendall(clientInit(1))    
-    srv_init    = unpServerInit(conn.recv(24))
+    srv_init    = unpServerInit(_recv_bytes(conn, 24))
     #logging.debug('ServerInit %s.' % pprint.pformat(srv_init))
     pprint.pprint(srv_init)
     
-    srv_name    = conn.recv(srv_init[-1])
+    srv_name    = _recv_bytes(conn, srv_init[-1])
     #logging.debug('ServerName %s.' % srv_name)
     pprint.pprint(srv_name)
             
@@ -497,6 +517,110 @@ def faked_client(conn):
     
     conn.send(framebufferUpdateRequest(0,0,0,800,600))
 
+_U32            = struct.Struct('!I')
+_PAD_U16        = struct.Struct('!xH')      # Padding and u16
+_PAD_U16_U16    = struct.Struct('!xHH')
+_PAD3_U32       = struct.Struct('!xxxI')
+_U16_U16        = struct.Struct('!HH')
+_SRV_INIT       = struct.Struct('!HHBBBBHHHBBBBBBI')
+_RECTANGLE      = struct.Struct('!HHHHi')
+_PIX_FORMAT     = struct.Struct('!BBBBBBBHHHBBBBBB')
+_FBUFFER_REQ    = struct.Struct('!BHHHH')
+_KEY_EVT        = struct.Struct('!BBBI')
+_POINTER_EVT    = struct.Struct('!BHH')
+
+_SRV_MSG_STATES = {0: SRV_FBUFFER, 1: SRV_COLMAP, 2: SRV_BELL, 3: SRV_TEXT}
+
+_CLI_MSG_STATES = {
+    0: CLI_PIX_FORMAT, 2: CLI_ENCODINGS, 3: CLI_FBUFFER_REQ,
+    4: CLI_KEY_EVT, 5: CLI_POINTER_EVT, 6: CLI_CUT_TEXT
+}
+
+_ENC_STATES = {
+    0:      SRV_FBUFFER_ENC_RAW,
+    1:      SRV_FBUFFER_ENC_COPYRECT,
+    -223:   SRV_FBUFFER_ENC_DSIZE,
+    -232:   SRV_FBUFFER_ENC_POINTER_POS,
+    -240:   SRV_FBUFFER_ENC_X11CURSOR,
+    -239:   SRV_FBUFFER_ENC_CURSOR
+}
+
+_ANON_NAME = 'MiG Desktop'
+
+class Framebuffer:
+    """
+    Mirror of the framebuffer of a server, the pixels in its format row by
+    row. Areas which were never painted are grey.
+    """
+
+    def __init__(self, w, h, bpp, fill=100):
+
+        self.w      = w
+        self.h      = h
+        self.bypp   = bpp/8             # Bytes per pixel
+        self.stride = w * self.bypp
+
+        self.pixels = bytearray(chr(fill)) * (self.stride * h)
+
+    def _inside(self, x, y, w, h):
+        return x+w <= self.w and y+h <= self.h
+
+    def paint(self, x, y, w, h, offset, data, start, end, pixels=None):
+        """
+        Bytes start:end of data are the payload of a raw rectangle, from
+        byte offset of it on. Painted on pixels instead when given.
+        """
+
+        row = w * self.bypp
+        if not row or not self._inside(x, y, w, h):
+            return
+
+        if pixels is None:
+            pixels = self.pixels
+
+        left = x * self.bypp
+        while start < end:
+            (r, c)  = divmod(offset, row)
+            n       = min(row - c, end - start)
+            pos     = (y+r) * self.stride + left + c
+
+            pixels[pos:pos+n] = data[start:start+n]
+            start   += n
+            offset  += n
+
+    def copy(self, src_x, src_y, x, y, w, h):
+        """Copy-rect, the source is read before anything is written."""
+
+        if not self._inside(src_x, src_y, w, h) or not self._inside(x, y, w, h):
+            return
+
+        pixels  = self.pixels
+        row     = w * self.bypp
+        src     = src_y * self.stride + src_x * self.bypp
+        rows    = [pixels[src + r*self.stride:src + r*self.stride + row] for r in xrange(h)]
+
+        dst = y * self.stride + x * self.bypp
+        for (r, data) in enumerate(rows):
+            pixels[dst + r*self.stride:dst + r*self.stride + row] = data
+
+    def update(self, overlay=None):
+        """
+        Framebuffer update of the whole screen as one raw rectangle, with
+        the Rectangle overlay painted on top of it when in the same format.
+        """
+
+        pixels = bytearray(self.pixels)
+
+        if overlay:
+            size = overlay.width * overlay.height * self.bypp
+            if len(overlay.pixelData) >= size:
+                self.paint(
+                    overlay.x, overlay.y, overlay.width, overlay.height,
+                    0, overlay.pixelData, 0, size, pixels
+                )
+
+        return framebufferUpdate([Rectangle(0, 0, self.w, self.h, str(pixels))])
+
 class RFBStatemachine:
     """
     Monitors the state of a RFB session based on the bytes sent between
@@ -506,19 +630,43 @@ class RFBStatemachine:
     
     from_srv(buffer) - Data from the server to the client
     from_cli(buffer) - Data from the client to the server
-    
+
+    With stream_rectangles the payload of raw and cursor rectangles is
+    released as it arrives, instead of when the whole rectangle is
+    buffered, payload_left() is what remains of the current one.
+
+    With mirror, framebuffer is a Framebuffer kept up to date with the
+    raw and copy-rect rectangles sent to the client.
+
+    pixel_format is the format of the pixels the server sends, the one of
+    the server-init until the client sets another one. Raw rectangles are
+    sized by it and the mirror is rebuilt in it when it changes.
+
+    Both parse every message in the buffer in a loop, each state has a
+    step in a dispatch table which returns the new cursor, or None when
+    the message is not buffered yet. Fields are unpacked in place with
+    precompiled structs and nothing is formatted for logging unless
+    debugging is enabled.
     """
     
-    def __init__(self):
+    def __init__(self, stream_rectangles=False, mirror=False):
         
+        self.stream_rectangles = stream_rectangles
+        self.mirror            = mirror
+        self.framebuffer       = None   # Framebuffer, once the size is known
+        self.pixel_format      = None   # (bpp, depth, big_endian, true_color, r/g/b max, r/g/b shift)
+
         # State manipulations for server
         self.state              = READ_VERSION
         self.prev_state         = READ_VERSION
         self.srv_bytes_read     = 0
         self.srv_cur_msg_bytes  = 0
+        self.srv_delay          = 0     # Bytes held back during from_srv()
+        self.srv_payload_read   = 0     # Bytes released of the current rectangle-payload
         
         self.nost       = 0     # Number Of Security Types
         self.nor        = 0     # Number of rectangles
+        self.updates    = 0     # Framebuffer updates read
         
         self.noc        = 0     # Number of colors
         self.fc         = 0     # First Color
@@ -558,581 +706,591 @@ class RFBStatemachine:
         self.noe = 0        # Number of encodings
         self.cli_text_l = 0 # Client cut text length
 
-    def from_cli(self, buff, buff_l, cursor=0):
-        
-        deeper          = True
-        delay_bytes     = 0
-        current_state   = self.cli_state
-        
-        # Handshaking
-        if self.cli_state == READ_VERSION and buff_l >= cursor+12:
-            
-            logging.debug('Reading version...')
-            self.client['protocol'] = str(buff[cursor:cursor+12])
-            logging.debug('Version %s.' % pprint.pformat(self.client))
-            
-            cursor += 12
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_SEC_TYPE            
-        
-        elif self.cli_state == CLI_SEC_TYPE and buff_l >= cursor+1:
-            
-            logging.debug('Reading chosen security type...')
-            
-            sec_type = buff[cursor+0]
-            logging.debug('SecType: %d.' % sec_type)
-            
-            cursor += 1
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_SHARED
-            
-        elif self.cli_state == CLI_SHARED and buff_l >= cursor+1:
-            
-            logging.debug('Reading shared flag...')
-            
-            shared_flag = buff[cursor+0]
-            logging.debug('Shared=%d.' % shared_flag)
-            
-            cursor += 1
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_MSG
-            
-        elif self.cli_state == CLI_MSG and buff_l >= cursor+1:
-            
-            logging.debug('Reading client message type...')
-            
-            msg_type = buff[cursor+0]
-            logging.debug('MSG_TYPE %d.' % msg_type)
-                        
-            cursor += 1
-            self.cli_prev_state = self.cli_state
-            if msg_type == 0:
-                self.cli_state = CLI_PIX_FORMAT
-            
-            elif msg_type == 2:
-                self.cli_state = CLI_ENCODINGS
-                # MiG Specific, we want to restrict the encodings!
-                delay_bytes += 1
-                
-            elif msg_type == 3:
-                self.cli_state = CLI_FBUFFER_REQ
-                
-            elif msg_type == 4:
-                self.cli_state = CLI_KEY_EVT
-            
-            elif msg_type == 5:
-                self.cli_state = CLI_POINTER_EVT
-                
-            elif msg_type == 6:
-                self.cli_state = CLI_CUT_TEXT
-            else:
-                self.cli_state = CLI_UNKNOWN
-            
-        elif self.cli_state == CLI_PIX_FORMAT and buff_l >= cursor+19:
-            
-            logging.debug('Reading set_pixel_format...')
-            
-            pixel_format = struct.unpack('!BBBBBBBHHHBBBBBB', str(buff[cursor:cursor+19]))
+        self.debug = False
+
+    def from_cli(self, buff, buff_l):
+        """Parse the client messages in buff, returns the number of bytes which can be sent."""
+
+        self.debug  = logging.root.isEnabledFor(logging.DEBUG)
+        steps       = self._CLI_STEPS
+        cursor      = 0
+
+        while True:
+
+            state   = self.cli_state
+            step    = steps.get(state)
+            moved   = step(self, buff, buff_l, cursor) if step else None
+
+            if moved is None:                   # Waiting for the rest of a message
+                self.cli_cur_msg_bytes += cursor
+                break
+
+            self.cli_prev_state = state
+            cursor = moved
+            buff_l = len(buff)
+
+            if buff_l <= cursor:                # Every message in the buffer is read
+                self.cli_cur_msg_bytes = 0
+                break
+
+        if self.debug:
+            logging.debug('Bytes read on the current message %d.' % self.cli_cur_msg_bytes)
+
+        return cursor
+
+    def from_srv(self, buff, buff_l):
+        """Parse the server messages in buff, returns the number of bytes which can be sent."""
+
+        self.debug      = logging.root.isEnabledFor(logging.DEBUG)
+        self.srv_delay  = 0
+        steps           = self._SRV_STEPS
+        cursor          = 0
+
+        while True:
+
+            state   = self.state
+            step    = steps.get(state)
+            moved   = step(self, buff, buff_l, cursor) if step else None
+
+            if moved is None:                   # Waiting for the rest of a message
+                self.srv_cur_msg_bytes += cursor - self.srv_delay
+                break
+
+            self.prev_state = state
+            cursor = moved
+            buff_l = len(buff)
+
+            if buff_l <= cursor:                # Every message in the buffer is read
+                self.srv_cur_msg_bytes = self.srv_payload_read
+                break
+
+        if self.debug:
+            logging.debug('Bytes read on the current message %d, cursor %d, buff_l %d.' % (
+                self.srv_cur_msg_bytes, cursor, buff_l
+            ))
+
+        return cursor - self.srv_delay
+
+    # Client steps
+
+    def _cli_version(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+12:
+            return None
+
+        self.client['protocol'] = str(buff[cursor:cursor+12])
+        if self.debug:
+            logging.debug('Client version %s.' % self.client['protocol'])
+
+        self.cli_state = CLI_SEC_TYPE
+        return cursor+12
+
+    def _cli_sec_type(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+1:
+            return None
+
+        if self.debug:
+            logging.debug('SecType: %d.' % buff[cursor])
+
+        self.cli_state = CLI_SHARED
+        return cursor+1
+
+    def _cli_shared(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+1:
+            return None
+
+        if self.debug:
+            logging.debug('Shared=%d.' % buff[cursor])
+
+        self.cli_state = CLI_MSG
+        return cursor+1
+
+    def _cli_msg(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+1:
+            return None
+
+        self.cli_state = _CLI_MSG_STATES.get(buff[cursor], CLI_UNKNOWN)
+        if self.debug:
+            logging.debug('Client message type %d.' % buff[cursor])
+
+        return cursor+1
+
+    def _cli_pix_format(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+19:
+            return None
+
+        pixel_format = _PIX_FORMAT.unpack_from(buff, cursor)[3:13]
+        if self.debug:
             logging.debug('pixel_format %s.' % pprint.pformat(pixel_format))
-                        
-            cursor += 19
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_MSG
-        
-        elif self.cli_state == CLI_ENCODINGS and buff_l >= cursor+3:
-            
-            logging.debug('Reading NOE...')
-            
-            (self.noe, ) = struct.unpack('!H', str(buff[cursor+1:cursor+3]))
+
+        self.set_pixel_format(pixel_format)
+
+        self.cli_state = CLI_MSG
+        return cursor+19
+
+    def set_pixel_format(self, pixel_format):
+        """The server sends pixels in pixel_format from now on, a new mirror is grey."""
+
+        if pixel_format == self.pixel_format:
+            return
+
+        self.pixel_format = tuple(pixel_format)
+        if self.framebuffer is not None:
+            self.framebuffer = Framebuffer(self.server['w'], self.server['h'], pixel_format[0])
+
+    def _cli_encodings(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+3:
+            return None
+
+        (self.noe,) = _PAD_U16.unpack_from(buff, cursor)
+        if self.debug:
             logging.debug('NOE %d.' % self.noe)
-            
-            cursor      += 3
-            delay_bytes += 3
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_ENCODINGS + 1
-        
-        elif self.cli_state == (CLI_ENCODINGS +1) and buff_l >= cursor+(self.noe*4):
-            
-            logging.debug('Reading encodings...')
-            
-            encodings = struct.unpack('!%s' % ('i'*self.noe), str(buff[cursor:cursor+self.noe*4]))
-            logging.debug('Encodings %s.' % pprint.pformat(encodings))
-            
-            # MiG specific, remove encodings that this statemachine cannot handle.
-            delay_bytes     = 4
-            msg_start       = cursor - delay_bytes
-            msg_end         = cursor + (self.noe*4)
-            del buff[msg_start:msg_end]
-                    
-            new_encodings   = setEncodings([0, 1])
-            i = 0
-            for c in new_encodings:
-                buff.insert(msg_start+i, c)
-                i += 1
-            
-            cursor = msg_start + len(new_encodings)
-            
-            delay_bytes     = 0
-            self.cli_prev_state = self.cli_state
-            self.cli_state  = CLI_MSG
-            
-        elif self.cli_state == CLI_FBUFFER_REQ and buff_l >= cursor+9:
-            
-            logging.debug('Reading FBUFFER Req...')
-            
-            fbuffer_req = struct.unpack('!BHHHH', str(buff[cursor:cursor+9]))
-            logging.debug('Request %s.' % pprint.pformat(fbuffer_req))
-                        
-            cursor += 9
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_MSG
-            
-        elif self.cli_state == CLI_KEY_EVT and buff_l >= cursor+7:
-            
-            logging.debug('Reading KeyEvent...')
-            
-            key_event = struct.unpack('!BBBI', str(buff[cursor:cursor+7]))
-            logging.debug('KeyEvent %s.' % pprint.pformat(key_event))
-                        
-            cursor += 7
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_MSG
-            
-        elif self.cli_state == CLI_POINTER_EVT and buff_l >= cursor+5:
-            
-            logging.debug('Reading PointerEvent...')
-            
-            pointer_event = struct.unpack('!BHH', str(buff[cursor:cursor+5]))
-            logging.debug('PointerEvent %s.' % pprint.pformat(pointer_event))
-                        
-            cursor += 5
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_MSG
-            
-        elif self.cli_state == CLI_CUT_TEXT and buff_l >= cursor+7:
-            
-            logging.debug('Reading ClientCutText Headers...')
-            
-            (self.cli_text_l,) = struct.unpack('!I', str(buff[cursor+3:cursor+7]))
+
+        self.cli_state = CLI_ENCODINGS + 1
+        return cursor+3
+
+    def _cli_encodings_list(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+(self.noe*4):
+            return None
+
+        if self.debug:
+            logging.debug('Encodings %s.' % pprint.pformat(
+                struct.unpack_from('!%di' % self.noe, buff, cursor)
+            ))
+
+        # MiG specific, remove encodings that this statemachine cannot handle.
+        msg_start       = cursor - 4
+        msg_end         = cursor + (self.noe*4)
+        del buff[msg_start:msg_end]
+
+        new_encodings   = setEncodings([0, 1])
+        i = 0
+        for c in new_encodings:
+            buff.insert(msg_start+i, c)
+            i += 1
+
+        self.cli_state = CLI_MSG
+        return msg_start + len(new_encodings)
+
+    def _cli_fbuffer_req(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+9:
+            return None
+
+        if self.debug:
+            logging.debug('Request %s.' % pprint.pformat(_FBUFFER_REQ.unpack_from(buff, cursor)))
+
+        self.cli_state = CLI_MSG
+        return cursor+9
+
+    def _cli_key_evt(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+7:
+            return None
+
+        if self.debug:
+            logging.debug('KeyEvent %s.' % pprint.pformat(_KEY_EVT.unpack_from(buff, cursor)))
+
+        self.cli_state = CLI_MSG
+        return cursor+7
+
+    def _cli_pointer_evt(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+5:
+            return None
+
+        if self.debug:
+            logging.debug('PointerEvent %s.' % pprint.pformat(_POINTER_EVT.unpack_from(buff, cursor)))
+
+        self.cli_state = CLI_MSG
+        return cursor+5
+
+    def _cli_cut_text(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+7:
+            return None
+
+        (self.cli_text_l,) = _PAD3_U32.unpack_from(buff, cursor)
+        if self.debug:
             logging.debug('CCT headers %d.' % self.cli_text_l)
-            
-            cursor += 7
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_CUT_TEXT + 1
-        
-        elif self.cli_state == CLI_CUT_TEXT + 1 and buff_l >= cursor+self.cli_text_l:
-        
-            logging.debug('Reading ClientCutText...')
-            cct = buff[cursor:cursor+self.cli_text_l]
-            logging.debug('ClientCutText %s.' % cct)
-                        
-            cursor += self.cli_text_l
-            self.cli_prev_state = self.cli_state
-            self.cli_state = CLI_MSG
-        
-        elif self.cli_state == CLI_UNKNOWN:
-            deeper = False
-        
-        # No matching states with satisfying buffers, returning to receive data.
-        else:
-            deeper = False
-            logging.debug('%d, %d' % (self.cli_state, buff_l))        
-        
-        if deeper and len(buff) > cursor:    # Investigate the remaining buffer
-            
-            #logging.debug('Going deeper buff_l B=%d, C=%d.' % (len(buff), cursor))
-            return self.from_cli(buff, len(buff), cursor)
-            
-        else:
-            if current_state == self.cli_state:
-                self.cli_cur_msg_bytes += cursor-delay_bytes
-            else:
-                self.cli_cur_msg_bytes = 0
-            logging.debug('Bytes read on the current message %d.' % self.cli_cur_msg_bytes)
-            return cursor
-    
-    def from_srv(self, buff, buff_l, cursor=0, delay_bytes=0):
-        
-        deeper          = True
-        current_state   = self.state
-        
-        # Handshaking
-        if self.state == READ_VERSION and buff_l >= cursor+12:
-            
-            logging.debug('Reading version...')
-            self.server['protocol'] = str(buff[cursor:cursor+12])
-            logging.debug('Version %s.' % pprint.pformat(self.server))
-                        
-            cursor += 12
-            self.prev_state = self.state
-            self.state      = READ_NOST
-            
-        elif self.state == READ_NOST and buff_l >= cursor+1:
-            
-            logging.debug('Reading NOST...')
-            
-            self.nost = buff[cursor]
-            logging.debug('NOST = %s.' % pprint.pformat(self.nost))
-                        
-            cursor += 1
-            self.prev_state = self.state
-            self.state = READ_SEC_TYPES
-            
-        elif self.state == READ_SEC_TYPES and buff_l >= cursor+self.nost:
-            
-            logging.debug('Reading %d security types...' % self.nost)
-            self.sec_types = struct.unpack('!%s' % ('B'*self.nost), str(buff[cursor:cursor+self.nost]))
+
+        self.cli_state = CLI_CUT_TEXT + 1
+        return cursor+7
+
+    def _cli_cut_text_data(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+self.cli_text_l:
+            return None
+
+        if self.debug:
+            logging.debug('ClientCutText %s.' % buff[cursor:cursor+self.cli_text_l])
+
+        self.cli_state = CLI_MSG
+        return cursor+self.cli_text_l
+
+    # Server steps
+
+    def _srv_version(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+12:
+            return None
+
+        self.server['protocol'] = str(buff[cursor:cursor+12])
+        if self.debug:
+            logging.debug('Server version %s.' % self.server['protocol'])
+
+        self.state = READ_NOST
+        return cursor+12
+
+    def _srv_nost(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+1:
+            return None
+
+        self.nost = buff[cursor]
+        if self.debug:
+            logging.debug('NOST = %d.' % self.nost)
+
+        self.state = READ_SEC_TYPES
+        return cursor+1
+
+    def _srv_sec_types(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+self.nost:
+            return None
+
+        self.sec_types = tuple(buff[cursor:cursor+self.nost])
+        if self.debug:
             logging.debug('sec_types %s.' % pprint.pformat(self.sec_types))
-            
-            cursor += self.nost
-            
-            self.prev_state = self.state
-            if len(self.sec_types) > 0:
-                
-                self.state = READ_SEC_RESULT
-                
-                # TODO: Handle states of various auth-methods
-                
-            else:                   # No security types => unsupported version
-                self.state = READ_ERR
-            
-        elif self.state == READ_SEC_RESULT and buff_l >= cursor+4:
-            
-            logging.debug('Reading security result...')
-            
-            (self.sec_result,) = struct.unpack('!I', str(buff[cursor:cursor+4]))
+
+        if len(self.sec_types) > 0:
+            self.state = READ_SEC_RESULT    # TODO: Handle states of various auth-methods
+        else:                               # No security types => unsupported version
+            self.state = READ_ERR
+
+        return cursor+self.nost
+
+    def _srv_sec_result(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+4:
+            return None
+
+        (self.sec_result,) = _U32.unpack_from(buff, cursor)
+        if self.debug:
             logging.debug('sec_result %d' % self.sec_result)
-                        
-            cursor += 4
-            self.prev_state = self.state
-            self.state = READ_SRV_INIT
-        
-        # Initialization
-        elif self.state == READ_SRV_INIT and buff_l >= cursor+24:
-            
-            logging.debug('Reading server init...')
-            
-            srv_init = struct.unpack('!HHBBBBHHHBBBBBBI', str(buff[cursor:cursor+24]))
-            
-            self.server['w']            = srv_init[0]
-            self.server['h']            = srv_init[1]
-            self.server['bpp']          = srv_init[2]
-            self.server['depth']        = srv_init[3]
-            self.server['true_color']   = srv_init[4]
-            self.server['big_endian']   = srv_init[5]
-            self.server['rgb_max']      = (srv_init[6], srv_init[7], srv_init[8])
-            self.server['rgb_shift']    = (srv_init[9], srv_init[10], srv_init[11])            
-            
-            self.snl = srv_init[-1]
+
+        self.state = READ_SRV_INIT
+        return cursor+4
+
+    def _srv_init(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+24:
+            return None
+
+        srv_init = _SRV_INIT.unpack_from(buff, cursor)
+
+        self.server['w']            = srv_init[0]
+        self.server['h']            = srv_init[1]
+        self.server['bpp']          = srv_init[2]
+        self.server['depth']        = srv_init[3]
+        self.server['true_color']   = srv_init[4]
+        self.server['big_endian']   = srv_init[5]
+        self.server['rgb_max']      = (srv_init[6], srv_init[7], srv_init[8])
+        self.server['rgb_shift']    = (srv_init[9], srv_init[10], srv_init[11])
+
+        self.snl = srv_init[-1]
+        if self.debug:
             logging.debug('ServerInit: %s.' % pprint.pformat(self.server))
-            
-            cursor      += 24
-            
-            # MiG-Specific!
-            #
-            # Delay bytes to be able to send a the server-name-length
-            # header with a different name for anonymization purposes.
-            delay_bytes += 4
-            self.prev_state = self.state
-            self.state = READ_SRV_NAME
-            
-        elif self.state  == READ_SRV_NAME and buff_l >= cursor+self.snl:
-        
-            logging.debug('Reading servername...')
-            self.server['name'] = str(buff[cursor:cursor+self.snl])
-            logging.debug('ServerName %s.' % pprint.pformat(self.server))
-            
-            # MiG-Specific!
-            #
-            # Anonymization of server-name, for use with MiG.
-                
-            name        = 'MiG Desktop'
-            name_l      = len(name)            
-            anon_msg    = struct.pack('!I', name_l) + name
-            
-            msg_start   = cursor - delay_bytes
-            msg_end     = cursor + self.snl
-            
-            del buff[msg_start:msg_end]         # Delete old server-name            
-            
-            i = 0                               # Insert "MiG Desktop"
-            for c in anon_msg:
-                buff.insert(msg_start+i, c)
-                i += 1
-            
-            cursor      = msg_start + len(anon_msg)
-            
-            delay_bytes = 0
-            self.prev_state = self.state
-            self.state = SRV_MSG
-        
-        # Server Message
-        elif self.state == SRV_MSG and buff_l >= cursor+1:
-            
-            logging.debug('Reading server message type...')
-            
-            msg_type = buff[cursor]
-            logging.debug('Server message type %d.' % msg_type)
-            
-            cursor += 1
-            
-            self.prev_state = self.state
-            if msg_type == 0:
-                self.state = SRV_FBUFFER
-            elif msg_type == 1:
-                self.state = SRV_COLMAP
-            elif msg_type == 2:
-                self.state = SRV_BELL
-            elif msg_type == 3:
-                self.state = SRV_TEXT
-            else:
-                self.state = SRV_UNKNOWN
-        
-        # Server Message, framebuffer update
-        elif self.state == SRV_FBUFFER and buff_l >= cursor+3:
-            
-            logging.debug('Reading NOR...')
-            (self.nor,) = struct.unpack('!H', str(buff[cursor+1:cursor+3]))
+
+        self.pixel_format = srv_init[2:12]
+        if self.mirror:
+            self.framebuffer = Framebuffer(self.server['w'], self.server['h'], self.server['bpp'])
+
+        # MiG-Specific!
+        #
+        # Delay bytes to be able to send a the server-name-length
+        # header with a different name for anonymization purposes.
+        self.srv_delay += 4
+
+        self.state = READ_SRV_NAME
+        return cursor+24
+
+    def _srv_name(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+self.snl:
+            return None
+
+        self.server['name'] = str(buff[cursor:cursor+self.snl])
+        if self.debug:
+            logging.debug('ServerName %s.' % self.server['name'])
+
+        # MiG-Specific!
+        #
+        # Anonymization of server-name, for use with MiG.
+        anon_msg    = _U32.pack(len(_ANON_NAME)) + _ANON_NAME
+
+        msg_start   = cursor - self.srv_delay
+        msg_end     = cursor + self.snl
+
+        del buff[msg_start:msg_end]         # Delete old server-name
+
+        i = 0                               # Insert "MiG Desktop"
+        for c in anon_msg:
+            buff.insert(msg_start+i, c)
+            i += 1
+
+        self.srv_delay = 0
+        self.state = SRV_MSG
+        return msg_start + len(anon_msg)
+
+    def _srv_msg(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+1:
+            return None
+
+        self.state = _SRV_MSG_STATES.get(buff[cursor], SRV_UNKNOWN)
+        if self.debug:
+            logging.debug('Server message type %d.' % buff[cursor])
+
+        return cursor+1
+
+    def _srv_fbuffer(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+3:
+            return None
+
+        (self.nor,) = _PAD_U16.unpack_from(buff, cursor)
+        if self.debug:
             logging.debug('NOR %d.' % self.nor)
-                        
-            cursor += 3
-            
-            self.prev_state = self.state
-            if self.nor > 0:                
-                self.state = SRV_FBUFFER_RECT
-            else:
-                self.state = SRV_MSG
-        
-        # Server Message, framebuffer update, rectangle
-        elif self.state == SRV_FBUFFER_RECT and buff_l >=cursor+12:
-            
-            logging.debug('Reading Rectangle...')
-            
-            rectangle       = struct.unpack('!HHHHi', str(buff[cursor:cursor+12]))
-            self.rectangle  = {
-                'x':    rectangle[0],
-                'y':    rectangle[1],
-                'w':    rectangle[2],
-                'h':    rectangle[3],
-                'enc':  rectangle[4]
-            }
-            
-            logging.debug('Rectangle: %s.' % pprint.pformat(self.rectangle))
-                        
-            cursor += 12
-            self.prev_state = self.state
-            if self.rectangle['enc'] == 0:
-                self.state = SRV_FBUFFER_ENC_RAW
-                
-            elif self.rectangle['enc'] == 1:                
-                self.state = SRV_FBUFFER_ENC_COPYRECT
-                
-            elif self.rectangle['enc'] == -223:
-                self.state = SRV_FBUFFER_ENC_DSIZE
-                
-            elif self.rectangle['enc'] == -232:
-                self.state = SRV_FBUFFER_ENC_POINTER_POS
-            
-            elif self.rectangle['enc'] == -240:
-                self.state = SRV_FBUFFER_ENC_X11CURSOR
-                
-            elif self.rectangle['enc'] == -239:
-                self.state = SRV_FBUFFER_ENC_CURSOR
-            
-            else:
-                self.state = SRV_UNKNOWN
-        
-        elif self.state == SRV_FBUFFER_ENC_RAW:
-            # Waiting for framebuffer-data.
-            
-            required_bytes = (
-                self.rectangle['w'] * \
-                self.rectangle['h'] * \
-                (self.server['bpp'] / 8 )
-            )
-            if buff_l >= cursor+required_bytes:
-                
-                self.nor -= 1
-                
-                cursor += required_bytes
-                self.prev_state = self.state
-                if self.nor > 0:
-                    self.state = SRV_FBUFFER_RECT
-                else:
-                    self.state = SRV_MSG
-                    
-            else:
-                deeper = False
-        
-        elif self.state == SRV_FBUFFER_ENC_COPYRECT:
-            
-            logging.debug('Reading COPY_RECT...')
-            
-            coord = struct.unpack('!HH', str(buff[cursor:cursor+4]))
-            logging.debug('Coord %s.' % pprint.pformat(coord))
-            
-            cursor += 4
-            self.nor -= 1
-            self.prev_state = self.state
-            if self.nor > 0:
-                self.state = SRV_FBUFFER_RECT
-            else:
-                self.state = SRV_MSG            
-        
-        elif self.state == SRV_FBUFFER_ENC_POINTER_POS:
-            logging.debug('Reading pointer pos...')
-            logging.debug('PointerPos.')
-            
-            self.nor -= 1
-            self.prev_state = self.state
-            if self.nor > 0:
-                self.state = SRV_FBUFFER_RECT
-            else:
-                self.state = SRV_MSG
-            
-        elif self.state == SRV_FBUFFER_ENC_X11CURSOR:
-            logging.debug('Reading X11 cursor...')
-            logging.debug('X11Cursor.')
-            
-            self.nor -= 1
-            self.prev_state = self.state
-            if self.nor > 0:
-                self.state = SRV_FBUFFER_RECT
-            else:
-                self.state = SRV_MSG
-        
-        elif self.state == SRV_FBUFFER_ENC_CURSOR:
-            
-            cursor_pixel_bytes =    int(
-                self.rectangle['w'] * \
-                self.rectangle['h'] * \
-                (self.server['bpp']/8)
-            )
-            
-            cursor_bitmask_bytes =  int(
-                math.floor( (self.rectangle['w']+7)/8 ) * self.rectangle['h']
-            )
-            
-            required_bytes = (cursor_pixel_bytes + cursor_bitmask_bytes)
-            
-            if buff_l >= cursor+required_bytes:
-                logging.debug('Reading cursor pseudo-encoding pixel-bytes=%d bitmask-bytes: %d.' % (
-                        cursor_pixel_bytes,
-                        cursor_bitmask_bytes
-                    )
-                )
-                
-                self.nor -= 1
-                
-                cursor += required_bytes
-                
-                self.prev_state = self.state
-                if self.nor > 0:
-                    self.state = SRV_FBUFFER_RECT
-                else:
-                    self.state = SRV_MSG
-                
-            else:
-                deeper = False
-        
-        # Server Message - Server Cut Text
-        elif self.state == SRV_TEXT and buff_l >= cursor+7:
-            
-            logging.debug('Reading server-text-header...')
-            
-            (self.text_l,) = struct.unpack('!I', str(buff[cursor+3:cursor+7]))
+
+        self.state = SRV_FBUFFER_RECT if self.nor > 0 else SRV_MSG
+        if self.nor == 0:
+            self.updates += 1
+        return cursor+3
+
+    def _srv_rectangle(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+12:
+            return None
+
+        rectangle = self.rectangle
+        (rectangle['x'], rectangle['y'], rectangle['w'], rectangle['h'], rectangle['enc']) = \
+            _RECTANGLE.unpack_from(buff, cursor)
+        if self.debug:
+            logging.debug('Rectangle: %s.' % pprint.pformat(rectangle))
+
+        self.state = _ENC_STATES.get(rectangle['enc'], SRV_UNKNOWN)
+        return cursor+12
+
+    def _next_rectangle(self):
+        """A rectangle is read, continue with the next one or the next message."""
+
+        self.nor -= 1
+        self.state = SRV_FBUFFER_RECT if self.nor > 0 else SRV_MSG
+        if self.nor == 0:
+            self.updates += 1
+
+    def _payload_size(self):
+        """Bytes of payload of the current raw or cursor rectangle."""
+
+        w = self.rectangle['w']
+        h = self.rectangle['h']
+
+        bpp = self.pixel_format[0] if self.pixel_format else self.server['bpp']
+        pixel_bytes = w * h * (bpp/8)
+        if self.state == SRV_FBUFFER_ENC_CURSOR:
+            return pixel_bytes + ((w+7)/8) * h      # Pixels and bitmask
+
+        return pixel_bytes
+
+    def payload_left(self):
+        """Bytes of the current rectangle-payload which are not released yet."""
+
+        if self.state not in (SRV_FBUFFER_ENC_RAW, SRV_FBUFFER_ENC_CURSOR):
+            return 0
+
+        return self._payload_size() - self.srv_payload_read
+
+    def _srv_payload(self, buff, buff_l, cursor):
+        """
+        Raw and cursor rectangles, the payload is opaque. When streaming,
+        what is buffered of it is read and the rest awaited.
+        """
+
+        required_bytes = self._payload_size() - self.srv_payload_read
+
+        if buff_l < cursor+required_bytes:
+
+            if not self.stream_rectangles or buff_l <= cursor:
+                return None
+
+            self._mirror(buff, cursor, buff_l)
+            self.srv_payload_read += buff_l - cursor
+            return buff_l
+
+        self._mirror(buff, cursor, cursor+required_bytes)
+
+        if self.debug:
+            logging.debug('Read rectangle-payload of %d bytes.' % (self.srv_payload_read + required_bytes))
+
+        self.srv_payload_read = 0
+        self._next_rectangle()
+        return cursor+required_bytes
+
+    def _mirror(self, buff, start, end):
+        """Paint payload of a raw rectangle on the framebuffer."""
+
+        if self.framebuffer is None or self.state != SRV_FBUFFER_ENC_RAW:
+            return
+
+        r = self.rectangle
+        self.framebuffer.paint(r['x'], r['y'], r['w'], r['h'], self.srv_payload_read, buff, start, end)
+
+    def _srv_copyrect(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+4:
+            return None
+
+        if self.debug:
+            logging.debug('Coord %s.' % pprint.pformat(_U16_U16.unpack_from(buff, cursor)))
+
+        if self.framebuffer is not None:
+            (src_x, src_y) = _U16_U16.unpack_from(buff, cursor)
+            r = self.rectangle
+            self.framebuffer.copy(src_x, src_y, r['x'], r['y'], r['w'], r['h'])
+
+        self._next_rectangle()
+        return cursor+4
+
+    def _srv_pseudo(self, buff, buff_l, cursor):
+        """Pointer position and X11 cursor, nothing is read."""
+
+        if self.debug:
+            logging.debug('Pseudo-rectangle %d.' % self.rectangle['enc'])
+
+        self._next_rectangle()
+        return cursor
+
+    def _srv_text(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+7:
+            return None
+
+        (self.text_l,) = _PAD3_U32.unpack_from(buff, cursor)
+        if self.debug:
             logging.debug('Text_l %d.' % self.text_l)
-                        
-            cursor += 7
-            self.prev_state = self.state
-            self.state = SRV_TEXT + 1
-        
-        # Server Message - Server Cut Text, continued
-        elif self.state == (SRV_TEXT + 1) and buff_l >= cursor+self.text_l:
-            
-            logging.debug('Reading server-text...')
-            text = str(buff[cursor:cursor+self.text_l])
-            logging.debug('Text %s.' % text)
-            
-            cursor += self.text_l
-            self.prev_state = self.state
-            self.state = SRV_MSG
-        
-        # Server Message - Color Map
-        elif self.state == SRV_COLMAP and buff_l >= cursor+5: # TODO: implement handling of color-map
-            
-            logging.debug('Reading color-map headers...')
-            
-            (self.fc, self.noc) = struct.unpack('!HH', str(buff[cursor+1:cursor+5]))
-            logging.debug('FC = %d, NC= %d.' % (fc, self.noc))
-            
-            cursor += 5
-            self.prev_state = self.state
-            if self.noc > 0:
-                self.state = SRV_COLMAP + 1
-            else:
-                self.state = SRV_MSG
-        
-        # Server Message - Color Map, continued
-        elif self.state == SRV_COLMAP + 1 and buff_l >= cursor+(self.noc * 6):
-            
-            logging.debug('Reading color-map colors...')
-            color_map = struct.unpack('!%s' % ('HHH'*self.noc), str(buff[cursor:cursor+self.noc*6]))
-            logging.debug('ColorMap %s.' % pprint.pformat(color_map))
-            
-            cursor += self.noc*6
-            self.prev_state = self.state
-            self.state = SRV_MSG
-        
-        # Server Message - Bell
-        elif self.state == SRV_BELL:
-            
-            logging.debug('Reading server-bell...')
+
+        self.state = SRV_TEXT + 1
+        return cursor+7
+
+    def _srv_text_data(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+self.text_l:
+            return None
+
+        if self.debug:
+            logging.debug('Text %s.' % buff[cursor:cursor+self.text_l])
+
+        self.state = SRV_MSG
+        return cursor+self.text_l
+
+    def _srv_colmap(self, buff, buff_l, cursor):    # TODO: implement handling of color-map
+
+        if buff_l < cursor+5:
+            return None
+
+        (self.fc, self.noc) = _PAD_U16_U16.unpack_from(buff, cursor)
+        if self.debug:
+            logging.debug('FC = %d, NC= %d.' % (self.fc, self.noc))
+
+        self.state = SRV_COLMAP + 1 if self.noc > 0 else SRV_MSG
+        return cursor+5
+
+    def _srv_colmap_colors(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+(self.noc * 6):
+            return None
+
+        if self.debug:
+            logging.debug('ColorMap %s.' % pprint.pformat(
+                struct.unpack_from('!%dH' % (self.noc*3), buff, cursor)
+            ))
+
+        self.state = SRV_MSG
+        return cursor+(self.noc * 6)
+
+    def _srv_bell(self, buff, buff_l, cursor):
+
+        if self.debug:
             logging.debug('Bell.')
-            
-            self.prev_state = self.state
-            self.state = SRV_MSG
-        
-        # Error
-        elif self.state == READ_ERR and buff_l >= cursor+4:
-            
-            logging.debug('Reading EML...')
-            (self.eml,) = struct.unpack('!I', str(buff[cursor:cursor+4]))
+
+        self.state = SRV_MSG
+        return cursor
+
+    def _srv_err(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+4:
+            return None
+
+        (self.eml,) = _U32.unpack_from(buff, cursor)
+        if self.debug:
             logging.debug('EML = %d...' % self.eml)
-            
-            cursor += 4
-            self.prev_state = self.state
-            self.state = READ_ERR_MSG
-        
-        # Error, continued
-        elif self.state == READ_ERR_MSG and buff_l >= cursor+self.eml:
-            
-            logging.debug('Reading err-msg...')
-            
-            error_msg = str(buff[cursor:cursor+self.eml])
-            logging.debug('Msg [%s]' % error_msg)
-            
-            cursor += self.eml
-            self.prev_state = self.state
-            self.state = DISCONNECTED
-        
-        elif self.state == SRV_UNKNOWN:
-            deeper = False
-        
-        # No matching states with satisfying buffers, returning to receive data.
-        else:
-            deeper = False
-            logging.debug('%d, %d' % (self.state, buff_l))        
-        
-        if deeper and len(buff) > cursor:    # Investigate the remaining buffer
-            
-            #logging.debug('Going deeper buff_l B=%d, C=%d' % (len(buff), cursor))            
-            return self.from_srv(buff, len(buff), cursor, delay_bytes)
-            
-        else:
-            if current_state == self.state:
-                self.srv_cur_msg_bytes += cursor-delay_bytes
-            else:
-                self.srv_cur_msg_bytes = 0
-            logging.debug('Bytes read on the current message %d, cursor %d, buff_l %d.' % (self.srv_cur_msg_bytes, cursor, buff_l))
-            return cursor-delay_bytes
+
+        self.state = READ_ERR_MSG
+        return cursor+4
+
+    def _srv_err_msg(self, buff, buff_l, cursor):
+
+        if buff_l < cursor+self.eml:
+            return None
+
+        if self.debug:
+            logging.debug('Msg [%s]' % buff[cursor:cursor+self.eml])
+
+        self.state = DISCONNECTED
+        return cursor+self.eml
+
+    _CLI_STEPS = {                          # state ---> step
+        READ_VERSION:       _cli_version,
+        CLI_SEC_TYPE:       _cli_sec_type,
+        CLI_SHARED:         _cli_shared,
+        CLI_MSG:            _cli_msg,
+        CLI_PIX_FORMAT:     _cli_pix_format,
+        CLI_ENCODINGS:      _cli_encodings,
+        CLI_ENCODINGS+1:    _cli_encodings_list,
+        CLI_FBUFFER_REQ:    _cli_fbuffer_req,
+        CLI_KEY_EVT:        _cli_key_evt,
+        CLI_POINTER_EVT:    _cli_pointer_evt,
+        CLI_CUT_TEXT:       _cli_cut_text,
+        CLI_CUT_TEXT+1:     _cli_cut_text_data
+    }
+
+    _SRV_STEPS = {                          # state ---> step, SRV_UNKNOWN is SRV_FBUFFER
+        READ_VERSION:                   _srv_version,
+        READ_NOST:                      _srv_nost,
+        READ_SEC_TYPES:                 _srv_sec_types,
+        READ_SEC_RESULT:                _srv_sec_result,
+        READ_SRV_INIT:                  _srv_init,
+        READ_SRV_NAME:                  _srv_name,
+        SRV_MSG:                        _srv_msg,
+        SRV_FBUFFER:                    _srv_fbuffer,
+        SRV_FBUFFER_RECT:               _srv_rectangle,
+        SRV_FBUFFER_ENC_RAW:            _srv_payload,
+        SRV_FBUFFER_ENC_COPYRECT:       _srv_copyrect,
+        SRV_FBUFFER_ENC_POINTER_POS:    _srv_pseudo,
+        SRV_FBUFFER_ENC_X11CURSOR:      _srv_pseudo,
+        SRV_FBUFFER_ENC_CURSOR:         _srv_payload,
+        SRV_TEXT:                       _srv_text,
+        SRV_TEXT+1:                     _srv_text_data,
+        SRV_COLMAP:                     _srv_colmap,
+        SRV_COLMAP+1:                   _srv_colmap_colors,
+        SRV_BELL:                       _srv_bell,
+        READ_ERR:                       _srv_err,
+        READ_ERR_MSG:                   _srv_err_msg
+    }
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Routing - longest-prefix matching of request paths to handlers.
+
+The orchestration of a port is compiled into a prefix trie once, a lookup
+walks the path at most once, and recently resolved paths are remembered
+in an LRU.
+"""
+
+class RoutingIndex:
+    """
+    Maps a path to the handler entry with the longest matching criteria.
+
+    The entries are the dicts of the routing map::
+
+        {'criteria': '/hobs', 'instance': handler_instance, 'params': params}
+
+    When two entries have the same criteria the one added first is used.
+
+    The LRU is kept as two generations of dicts, paths used in the current
+    generation survive when it is retired. This evicts roughly the least
+    recently used paths, with only dict operations, which are atomic, on
+    the path of a lookup.
+    """
+
+    def __init__(self, entries=(), cache_size=1024):
+
+        self.root       = {}                    # char ---> node, None ---> entry
+        self.entries    = []
+        self.cache_size = cache_size
+
+        self.recent     = {}                    # path ---> entry, current generation
+        self.old        = {}                    # path ---> entry, previous generation
+
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+
+        node = self.root
+        for char in entry['criteria']:
+            node = node.setdefault(char, {})
+        node.setdefault(None, entry)
+
+        self.entries.append(entry)
+
+        self.recent = {}
+        self.old    = {}
+
+    def _walk(self, path):
+        """Entry of the longest criteria which is a prefix of path."""
+
+        node    = self.root
+        match   = node.get(None)
+
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None, match)
+
+        return match
+
+    def lookup(self, path):
+        """Handler entry for path, None when nothing matches."""
+
+        recent = self.recent
+        try:
+            return recent[path]
+        except KeyError:
+            pass
+
+        try:
+            entry = self.old[path]              # Used again, keep it
+        except KeyError:
+            entry = self._walk(path)
+
+        if self.cache_size:
+            recent[path] = entry
+            if len(recent) >= self.cache_size / 2:
+                self.old    = recent            # Retire the generation
+                self.recent = {}
+
+        return entry
+
+    def cached(self):
+        """Paths currently cached."""
+        return set(self.old) | set(self.recent)
+
+    def __len__(self):
+        return len(self.entries)
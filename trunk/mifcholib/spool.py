@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Spool - bounded buffering of bytes which cannot be written yet.
+
+A pipe waiting for its sink to recover keeps reading from its source into
+a Spool. Bytes are kept in memory, within a limit per spool and a Budget
+shared by all spools, beyond that they spill to a temporary file which is
+limited per spool too. When even that is full the session has to go.
+"""
+import collections
+import threading
+import tempfile
+
+import mifcholib.metrics as metrics
+
+BUFFERED = metrics.gauge(
+    'mifcho_recovery_buffer_bytes',
+    'Bytes buffered while sinks recover, where is "memory" or "disk".',
+    ('where',)
+)
+DROPPED = metrics.counter(
+    'mifcho_recovery_dropped_total',
+    'Sessions dropped since their recovery buffer was full.'
+)
+
+class SpoolFull(Exception):
+    pass
+
+class Budget:
+    """Memory shared by all spools, and what they spilled to disk."""
+
+    def __init__(self, limit=67108864):
+
+        self.limit      = int(limit)
+        self.lock       = threading.Lock()
+        self.memory     = 0
+        self.disk       = 0
+        self.dropped    = 0
+
+    def reserve(self, nbytes):
+        """Take nbytes of memory, False when the budget does not allow it."""
+
+        self.lock.acquire()
+        granted = self.memory + nbytes <= self.limit
+        if granted:
+            self.memory += nbytes
+            BUFFERED.set(self.memory, labels=('memory',))
+        self.lock.release()
+
+        return granted
+
+    def release(self, nbytes):
+
+        self.lock.acquire()
+        self.memory -= nbytes
+        BUFFERED.set(self.memory, labels=('memory',))
+        self.lock.release()
+
+    def spilled(self, nbytes):
+        """Account nbytes written to, or when negative removed from, disk."""
+
+        self.lock.acquire()
+        self.disk += nbytes
+        BUFFERED.set(self.disk, labels=('disk',))
+        self.lock.release()
+
+    def drop(self):
+
+        self.lock.acquire()
+        self.dropped += 1
+        self.lock.release()
+
+        DROPPED.inc()
+
+    def report(self):
+
+        return {
+            'limit':    self.limit,
+            'memory':   self.memory,
+            'disk':     self.disk,
+            'dropped':  self.dropped
+        }
+
+class Spool:
+    """
+    Bytes in order of writing, the first 'memory' bytes in memory and up to
+    'disk' bytes after them in a temporary file.
+    """
+
+    def __init__(self, budget, memory=262144, disk=16777216, chunk_size=65536):
+
+        self.budget     = budget
+        self.memory     = int(memory)
+        self.disk       = int(disk)
+        self.chunk_size = chunk_size
+
+        self.chunks     = collections.deque()   # In memory, before anything on disk
+        self.in_memory  = 0
+        self.on_disk    = 0
+        self.file       = None
+
+    def __len__(self):
+        return self.in_memory + self.on_disk
+
+    def write(self, data):
+        """Append data, raises SpoolFull when it does not fit."""
+
+        n = len(data)
+
+        if self.file is None and self.in_memory + n <= self.memory and self.budget.reserve(n):
+            self.chunks.append(data)
+            self.in_memory += n
+            return
+
+        if self.on_disk + n > self.disk:
+            self.budget.drop()
+            raise SpoolFull('%d bytes spooled.' % len(self))
+
+        if self.file is None:                   # Later bytes follow on disk
+            self.file = tempfile.TemporaryFile(prefix='mifcho-spool-')
+
+        self.file.write(data)
+        self.on_disk += n
+        self.budget.spilled(n)
+
+    def drain(self):
+        """Yield and remove the spooled bytes in order, in chunks."""
+
+        while self.chunks:
+            data = self.chunks.popleft()
+            self.in_memory -= len(data)
+            self.budget.release(len(data))
+            yield data
+
+        if self.file is not None:
+            self.file.seek(0)
+            while self.on_disk > 0:
+                data = self.file.read(min(self.chunk_size, self.on_disk))
+                if not data:
+                    break
+                self.on_disk -= len(data)
+                self.budget.spilled(-len(data))
+                yield data
+
+        self.close()
+
+    def close(self):
+        """Discard what is left, giving its memory back to the budget."""
+
+        self.budget.release(self.in_memory)
+        self.budget.spilled(-self.on_disk)
+        self.chunks.clear()
+        self.in_memory  = 0
+        self.on_disk    = 0
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,9 +1,25 @@
 #!/usr/bin/env python
 """ThreadUtils."""
+import collections
 import threading
 import logging
-import Queue
-from Queue import Empty
+import select
+import fcntl
+import time
+import os
+
+import mifcholib.metrics as metrics
+
+QUEUE_DEPTH = metrics.gauge(
+    'mifcho_workerpool_queue_depth',
+    'Jobs ordered but not yet picked up by a worker.',
+    ('pool',)
+)
+QUEUE_WAIT = metrics.histogram(
+    'mifcho_workerpool_wait_seconds',
+    'Time a job waits in the queue of a WorkerPool.',
+    ('pool',)
+)
 
 class Worker(threading.Thread):
     """A common interface for non-WorkerPool threads."""
@@ -39,10 +55,30 @@ class Worker(threading.Thread):
     def deallocate(self):
         pass
 
+class _Slot:
+    """A worker thread of a WorkerPool, parked on its own lock while idle."""
+
+    def __init__(self, job=None):
+
+        self.job        = job               # Handed over before the lock is released
+        self.lock       = threading.Lock()
+        self.lock.acquire()
+        self.idle_since = None
+
 class WorkerPool(threading.Thread):
     """
-    Basic WorkerPool implementation, each thread polls a queue for jobs.
-    Executing the work() method when retrieving a job from the queue.
+    Elastic WorkerPool, between min_instances and max_instances threads
+    execute the work() method for the jobs placed with order().
+
+    An idle worker blocks on a lock of its own, order() hands the job to
+    the most recently idle one. When no worker is idle the job is queued,
+    and a worker is added once the oldest job has waited grow_wait
+    seconds. Workers idle for idle_timeout seconds are stopped, down to
+    min_instances. Stopping hands each idle worker the sentinel None.
+
+    The thread of the pool itself starts the minimum of workers and
+    grows and shrinks the pool, it sleeps in select() on a self-pipe
+    until the next deadline.
 
     WorkerPool interface: start/stop/order
     Override the work() method
@@ -51,66 +87,207 @@ class WorkerPool(threading.Thread):
 
     w_count = 0
 
-    def __init__(self, name, max_instances=4):
+    def __init__(self, name, max_instances=4, min_instances=1, idle_timeout=60, grow_wait=0):
 
-        thread_name = 'WorkerPool-%d-%s' % (WorkerPool.w_count, name)
+        self.thread_name = 'WorkerPool-%d-%s' % (WorkerPool.w_count, name)
         WorkerPool.w_count += 1
         
         self.running = True
 
-        self.max_instances  = int(max_instances)
-        self.instances      = []
-        self.work_queue     = Queue.Queue()
+        self.pool_name      = name
+        self.max_instances  = max(int(max_instances), 1)
+        self.min_instances  = min(int(min_instances), self.max_instances)
+        self.idle_timeout   = float(idle_timeout)
+        self.grow_wait      = float(grow_wait)
 
-        for i in xrange(self.max_instances):
-            w_name = "%s-%d" % (thread_name, i)
-            w = threading.Thread(name=w_name, target=self._work_loop)
-            self.instances.append(w)
+        self.lock       = threading.Lock()
+        self.jobs       = collections.deque()   # (ordered, job) waiting for a worker
+        self.idle       = []                    # Parked _Slots, most recently idle last
+        self.instances  = []                    # Worker threads
+        self.spawned    = 0
 
-        threading.Thread.__init__(self, name=thread_name+'-main')
+        (self.wake_r, self.wake_w) = os.pipe()  # Wakes the pool-thread
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        threading.Thread.__init__(self, name=self.thread_name+'-main')
         self.daemon = True
 
-    def _work_loop(self):
-        
-        while self.running:
-            try:
+    def _spawn(self, job=None):
+        """Add a worker, starting with job, the lock must be held."""
 
-                work = self.work_queue.get(True, 0.5)
-                logging.debug("Got work!")
-                if work:
-                    self.work(work)
-                self.work_queue.task_done()
-            
-            except Empty: # we dont care that the queue is empty
-                                # We just want to re-evaluate self.running
-                pass    
-            except Queue.Empty: # we dont care that the queue is empty
-                                # We just want to re-evaluate self.running
-                pass
-            except:             # Something much worse happened
-                logging.error("Bad mojo when working...", exc_info=3)
+        slot = _Slot(job)
+        w = threading.Thread(
+            name    = '%s-%d' % (self.thread_name, self.spawned),
+            target  = self._work_loop,
+            args    = (slot,)
+        )
+        w.daemon = True
+        self.spawned += 1
+
+        self.instances.append(w)
+        w.start()
+
+    def _dequeue(self):
+        """Oldest queued job, the lock must be held."""
+
+        (ordered, job) = self.jobs.popleft()
+        QUEUE_DEPTH.dec(labels=(self.pool_name,))
+        QUEUE_WAIT.observe(time.time() - ordered, labels=(self.pool_name,))
+
+        return job
+
+    def _next(self, slot):
+        """Next job for the worker of slot, blocks while there is none."""
+
+        self.lock.acquire()
+
+        if not self.running:
+            self.lock.release()
+            return None
+
+        if self.jobs:
+            job = self._dequeue()
+            self.lock.release()
+            return job
+
+        slot.idle_since = time.time()
+        self.idle.append(slot)
+        self.lock.release()
+
+        slot.lock.acquire()                     # Released by order(), _maintain() or stop()
+        return slot.job
+
+    def _work_loop(self, slot):
+
+        job = slot.job
+        while True:
+
+            if job:
+                try:
+                    self.work(job)
+                except:             # Something much worse happened
+                    logging.error("Bad mojo when working...", exc_info=3)
+
+            job = self._next(slot)
+            if job is None:         # Sentinel
+                break
+
+        self.lock.acquire()
+        self.instances.remove(threading.current_thread())
+        self.lock.release()
 
         logging.debug('Exiting work loop.')
 
+    def _wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError:                         # Pipe is full, so it is awake
+            pass
+
+    def _maintain(self):
+        """
+        Grow for jobs waiting too long, stop workers idle too long. Returns
+        the seconds until something might need to be done again.
+        """
+
+        now     = time.time()
+        expired = []
+
+        self.lock.acquire()
+
+        while self.jobs and len(self.instances) < self.max_instances and \
+              now - self.jobs[0][0] >= self.grow_wait:
+            self._spawn(self._dequeue())
+
+        while self.idle and len(self.instances) - len(expired) > self.min_instances and \
+              now - self.idle[0].idle_since >= self.idle_timeout:
+            expired.append(self.idle.pop(0))
+
+        timeout = self.idle_timeout
+        if self.idle and len(self.instances) - len(expired) > self.min_instances:
+            timeout = self.idle[0].idle_since + self.idle_timeout - now
+        if self.jobs and len(self.instances) < self.max_instances:
+            timeout = min(timeout, self.jobs[0][0] + self.grow_wait - now)
+
+        self.lock.release()
+
+        for slot in expired:
+            slot.job = None
+            slot.lock.release()
+
+        return max(timeout, 0)
+
     def run(self):
         
-        logging.debug("Starting %d workers..." % len(self.instances))
-        for w in self.instances: # Start worker-threads
-            w.start()
+        logging.debug("Starting %d workers..." % self.min_instances)
 
-        for w in self.instances: # Wait for them to exit
+        self.lock.acquire()
+        while len(self.instances) < self.min_instances:
+            self._spawn()
+        self.lock.release()
+
+        while self.running:
+
+            try:
+                select.select([self.wake_r], [], [], self._maintain())
+                os.read(self.wake_r, 4096)
+            except (OSError, select.error):
+                pass
+
+        self.lock.acquire()
+        workers = list(self.instances)
+        self.lock.release()
+
+        for w in workers: # Wait for them to exit
             w.join()
+
+        for fd in (self.wake_r, self.wake_w):
+            os.close(fd)
+
         logging.debug("Stopped.")
 
     def stop(self):
         """Stop the WorkerPool."""
 
         self.running = False
+
+        self.lock.acquire()
+        idle        = self.idle
+        self.idle   = []
+        self.lock.release()
+
+        for slot in idle:   # Sentinels, busy workers stop after their job
+            slot.job = None
+            slot.lock.release()
+
+        self._wake()
         self.deallocate()
 
     def order(self, work):
-        """Place a job on the queue."""
-        self.work_queue.put_nowait(work)
+        """Hand a job to an idle worker, or queue it."""
+
+        self.lock.acquire()
+
+        if self.idle:
+            slot = self.idle.pop()
+            self.lock.release()
+
+            QUEUE_WAIT.observe(0.0, labels=(self.pool_name,))
+            slot.job = work
+            slot.lock.release()
+            return
+
+        self.jobs.append((time.time(), work))
+        QUEUE_DEPTH.inc(labels=(self.pool_name,))
+
+        grow = len(self.instances) < self.max_instances
+        if grow and not self.grow_wait:
+            self._spawn(self._dequeue())
+        self.lock.release()
+
+        if grow and self.grow_wait:
+            self._wake()            # Pool-thread grows when the job waits too long
 
     def work(self, work):
         """Execute the actual work, override this method."""
@@ -10,6 +10,7 @@ class Tunnel:
         self.event = event
         self.client_connection  = client_connection
         self.peer_connection    = peer_connection
+        self.compression        = 'none'    # Agreed on by the peer calling back
 
     @classmethod
     def fromconnections(cls, client_connection, peer_connection):
@@ -1,4 +1,13 @@
 #!/usr/bin/env python
+"""
+Websockets - the hixie-76 draft and RFC 6455.
+
+Hixie-76 frames are text only, payloads are base64-encoded. RFC 6455
+frames carry the payloads as they are in binary frames.
+"""
+import collections
+import threading
+import binascii
 import logging
 import hashlib
 import struct
@@ -17,6 +26,22 @@ class MsgUtilException(Exception):
 class ConnectionTerminatedException(MsgUtilException):
     pass
 
+VERSION = '13'                              # RFC 6455
+GUID    = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT         = 0x1
+OP_BINARY       = 0x2
+OP_CLOSE        = 0x8
+OP_PING         = 0x9
+OP_PONG         = 0xA
+
+MAX_PAYLOAD = 16777216                      # Largest frame, or fragmented message, accepted
+
+_SHORT  = struct.Struct('!BB')
+_MEDIUM = struct.Struct('!BBH')
+_LONG   = struct.Struct('!BBQ')
+
 def key_to_num(key):
     """Extract the hidden number from a websocket handshake key."""
     
@@ -146,3 +171,182 @@ def receive_message(c):
             if frame_type == 0x00:
                 return message
             # Discard data of other types.
+
+def accept_key(key):
+    """Sec-WebSocket-Accept of the Sec-WebSocket-Key of a RFC 6455 handshake."""
+    return base64.b64encode(hashlib.sha1(key.strip() + GUID).digest())
+
+def mask(key, data):
+    """
+    XOR data with the four byte masking-key.
+
+    The bytes are XOR'ed as one long integer, which is done in C, instead
+    of a byte at a time in Python.
+    """
+
+    length = len(data)
+    if not length:
+        return ''
+
+    key = (key * (length / 4 + 1))[:length]
+    masked = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(key), 16)
+
+    return binascii.unhexlify('%0*x' % (length * 2, masked))
+
+def format_frame(payload, opcode=OP_BINARY, fin=True, mask_key=None):
+    """A RFC 6455 frame, frames sent by servers are not masked."""
+
+    b0 = (0x80 if fin else 0) | opcode
+    b1 = 0x80 if mask_key else 0
+    length = len(payload)
+
+    if length < 126:
+        head = _SHORT.pack(b0, b1 | length)
+    elif length < 65536:
+        head = _MEDIUM.pack(b0, b1 | 126, length)
+    else:
+        head = _LONG.pack(b0, b1 | 127, length)
+
+    if mask_key:
+        return head + mask_key + mask(mask_key, payload)
+
+    return head + payload
+
+class FrameStream:
+    """
+    Reads and writes the RFC 6455 frames of a connection.
+
+    Bytes are received with recv_into() a pre-allocated buffer and every
+    frame they complete is parsed at once, so a frame costs at most one
+    syscall and small frames share one. Pings are answered, a close is
+    echoed and ends the stream with ConnectionTerminatedException.
+
+    It is the server end, frames of the client must be masked. Frames
+    and fragmented messages beyond max_payload raise MsgUtilException.
+    """
+
+    def __init__(self, conn, buffer_size=65536, max_payload=MAX_PAYLOAD):
+
+        self.conn           = conn
+        self.max_payload    = max_payload
+
+        self.chunk  = bytearray(buffer_size)
+        self.buf    = bytearray()               # Bytes of incomplete frames
+        self.frames = collections.deque()       # (fin, opcode, payload)
+
+        self.opcode     = None                  # Opcode of the fragmented message
+        self.fragments  = []
+        self.size       = 0                     # Of the fragments, at most max_payload
+
+        self.lock = threading.Lock()            # Pongs are sent by the reader
+
+    def send(self, payload, opcode=OP_BINARY):
+
+        frame = format_frame(payload, opcode)
+
+        self.lock.acquire()
+        try:
+            self.conn.sendall(frame)
+        finally:
+            self.lock.release()
+
+    def close(self, code=1000):
+        self.send(struct.pack('!H', code), OP_CLOSE)
+
+    def _fill(self):
+        """Receive what is available and parse the frames it completes."""
+
+        received = self.conn.recv_into(self.chunk, len(self.chunk))
+        if not received:
+            raise ConnectionTerminatedException('Connection closed.')
+
+        self.buf.extend(buffer(self.chunk, 0, received))
+        self._parse()
+
+    def _parse(self):
+
+        buf     = self.buf
+        end     = len(buf)
+        offset  = 0
+
+        while end - offset >= 2:
+
+            (b0, b1) = _SHORT.unpack_from(buf, offset)
+
+            length  = b1 & 0x7f
+            head    = 2
+            if length == 126:
+                if end - offset < 4:
+                    break
+                length  = _MEDIUM.unpack_from(buf, offset)[2]
+                head    = 4
+            elif length == 127:
+                if end - offset < 10:
+                    break
+                length  = _LONG.unpack_from(buf, offset)[2]
+                head    = 10
+
+            if length > self.max_payload:
+                raise MsgUtilException('Frame of %d bytes is too large.' % length)
+
+            if not b1 & 0x80:                   # RFC 6455 5.1, clients mask every frame
+                raise MsgUtilException('Unmasked frame from the client.')
+            head += 4
+
+            if end - offset < head + length:
+                break
+
+            key     = str(buf[offset+head-4:offset+head])
+            payload = mask(key, str(buf[offset+head:offset+head+length]))
+
+            self.frames.append((b0 & 0x80, b0 & 0x0f, payload))
+            offset += head + length
+
+        if offset:
+            del buf[:offset]
+
+    def receive_frame(self):
+        """Next frame as (fin, opcode, payload)."""
+
+        while not self.frames:
+            self._fill()
+
+        return self.frames.popleft()
+
+    def receive_message(self):
+        """Payload of the next text or binary message, fragments are joined."""
+
+        while True:
+
+            (fin, opcode, payload) = self.receive_frame()
+
+            if opcode == OP_PING:
+                self.send(payload, OP_PONG)
+
+            elif opcode == OP_PONG:
+                pass
+
+            elif opcode == OP_CLOSE:
+                logging.debug('WSCLI termination.')
+                try:
+                    self.send(payload[:2], OP_CLOSE)
+                except:
+                    pass
+                raise ConnectionTerminatedException
+
+            else:
+                if opcode != OP_CONTINUATION:
+                    self.opcode     = opcode
+                    self.fragments  = []
+                    self.size       = 0
+
+                self.size += len(payload)
+                if self.size > self.max_payload:
+                    raise MsgUtilException('Message of more than %d bytes.' % self.max_payload)
+                self.fragments.append(payload)
+
+                if fin:
+                    message = ''.join(self.fragments)
+                    self.fragments  = []
+                    self.size       = 0
+                    return message
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Zero-copy relaying of bytes between two sockets.
+
+On Linux the bytes are moved with splice() through a kernel pipe and never
+enter Python, elsewhere recv_into() a pre-allocated buffer and sending a
+memoryview of it avoids creating a string per chunk. Files are sent with
+sendfile() when available.
+"""
+import ctypes.util
+import logging
+import ctypes
+import socket
+import errno
+import os
+
+SPLICE_F_MOVE       = 1
+SPLICE_F_NONBLOCK   = 2
+
+_AGAIN = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def _load_splice():
+    """Get splice() from libc, None when it is not available."""
+
+    try:
+        libc    = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        splice  = libc.splice
+    except (OSError, AttributeError):
+        return None
+
+    splice.argtypes = [
+        ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint
+    ]
+    splice.restype  = ctypes.c_ssize_t
+
+    return splice
+
+def _load_sendfile():
+    """Get sendfile() from os or libc, None when it is not available."""
+
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+
+    try:
+        libc        = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _sendfile   = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+
+    _sendfile.argtypes = [
+        ctypes.c_int, ctypes.c_int,
+        ctypes.POINTER(ctypes.c_longlong), ctypes.c_size_t
+    ]
+    _sendfile.restype  = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+
+        off = ctypes.c_longlong(offset)
+        sent = _sendfile(out_fd, in_fd, ctypes.byref(off), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        return sent
+
+    return sendfile
+
+_splice     = _load_splice()
+_sendfile   = _load_sendfile()
+
+def splice(fd_in, fd_out, length, flags=SPLICE_F_MOVE):
+    """Move up to 'length' bytes from fd_in to fd_out, one of them must be a pipe."""
+
+    moved = _splice(fd_in, None, fd_out, None, length, flags)
+    if moved < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+    return moved
+
+def sendfile(output_conn, f, offset, count, chunk_size=65536):
+    """
+    Send 'count' bytes of file f, from 'offset', to output_conn.
+
+    The kernel copies the bytes when output_conn is a plain socket,
+    otherwise they are read and sent in chunks, e.g. for TLS.
+    """
+
+    if _sendfile and not getattr(output_conn, 'use_tls', True) and output_conn.fileno():
+
+        out_fd  = output_conn.fileno()
+        in_fd   = f.fileno()
+        while count > 0:
+
+            try:
+                sent = _sendfile(out_fd, in_fd, offset, min(count, 1 << 30))
+            except OSError, e:
+                if e.args[0] in _AGAIN:
+                    continue
+                raise
+
+            if sent == 0:               # File was truncated
+                raise EOFError('File ended before %d more bytes were sent.' % count)
+
+            offset  += sent
+            count   -= sent
+
+        return
+
+    f.seek(offset)
+    while count > 0:
+
+        chunk = f.read(min(count, chunk_size))
+        if not chunk:
+            raise EOFError('File ended before %d more bytes were sent.' % count)
+
+        output_conn.sendall(chunk)
+        count -= len(chunk)
+
+class Relay:
+    """
+    Moves bytes from input_conn to output_conn.
+
+    Works on blocking sockets, where fill() and flush() block, and on
+    non-blocking sockets, where they do as much as possible without waiting.
+    The attributes paused/on_readable/flush match reactor.Flow.
+    """
+
+    def __init__(self, input_conn, output_conn, chunk_size=65536, use_splice=True, stats=None):
+
+        self.input_conn     = input_conn
+        self.output_conn    = output_conn
+        self.chunk_size     = chunk_size
+        self.stats          = stats         # FlowStats counting what is relayed
+
+        self.use_splice = use_splice and _splice is not None
+
+        self.queued = 0             # Bytes read but not yet written
+        self.offset = 0             # Position of queued bytes in buffer
+        self.spill  = ''            # Bytes taken from a read-ahead buffer
+        self.paused = False
+
+        if self.use_splice:
+            (self.pipe_r, self.pipe_w) = os.pipe()
+        else:
+            self.buff = bytearray(chunk_size)
+            self.view = memoryview(self.buff)
+
+    def fill(self):
+        """
+        Read a chunk, returns amount of bytes read, 0 on end-of-file and
+        None when nothing is available on a non-blocking socket.
+        """
+
+        try:
+            if self.input_conn.pending():   # Read-ahead of the Connection goes first
+                self.spill = self.input_conn.recv(self.chunk_size)
+                n = len(self.spill)
+            elif self.use_splice:
+                n = splice(self.input_conn.fileno(), self.pipe_w, self.chunk_size)
+            else:
+                n = self.input_conn.recv_into(self.buff, self.chunk_size)
+                self.offset = 0
+
+        except (OSError, socket.error), e:
+            if e.args[0] in _AGAIN:
+                return None
+            raise
+
+        self.queued = n
+        return n
+
+    def flush(self):
+        """Write queued bytes, returns True when everything was written."""
+
+        try:
+            while self.queued > 0:
+
+                if self.spill:
+                    n = self.output_conn.send(self.spill)
+                    self.spill = self.spill[n:]
+                elif self.use_splice:
+                    n = splice(self.pipe_r, self.output_conn.fileno(), self.queued)
+                else:
+                    n = self.output_conn.send(self.view[self.offset:self.offset+self.queued])
+                    self.offset += n
+
+                self.queued -= n
+
+        except (OSError, socket.error), e:
+            if e.args[0] not in _AGAIN:
+                raise
+
+        self.paused = self.queued > 0
+        return not self.paused
+
+    def on_readable(self):
+
+        while not self.paused:
+
+            n = self.fill()
+            if n == 0:
+                raise EOFError
+            elif n is None:
+                break
+
+            self.flush()
+            if self.stats is not None:
+                self.stats.record(n, self.queued)
+
+    def run(self, running=lambda: True):
+        """Relay until end-of-file, for blocking sockets."""
+
+        while running():
+
+            n = self.fill()
+            if not n:
+                break
+            self.flush()
+            if self.stats is not None:
+                self.stats.record(n, self.queued)
+
+    def close(self):
+
+        if self.use_splice:
+            for fd in (self.pipe_r, self.pipe_w):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+import unittest
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.accounting import Traffic, PipeStats, route_name
+
+class TestAccounting(unittest.TestCase):
+
+  def test_pipe_stats(self):
+    stats = PipeStats(route_name(('localhost', '5900')))
+    self.assertEqual((stats.route, stats.peer), ('localhost:5900', 'direct'))
+
+    stats.source_to_sink.record(10, 0)
+    self.assertEqual(stats.sink_to_source.first, None)
+    stats.sink_to_source.record(100, 40)
+    stats.sink_to_source.record(20, 0)
+
+    report = stats.report(time.time())
+    self.assertEqual(report['sink_to_source']['bytes'], 120)
+    self.assertEqual(report['sink_to_source']['messages'], 2)
+    self.assertEqual(report['sink_to_source']['buffered'], 0)
+    self.assertTrue(0 <= report['ttfb'] <= report['age'])
+    self.assertTrue(report['idle'] <= report['age'])
+
+  def test_aggregates(self):
+    traffic = Traffic(1)
+    a = PipeStats('localhost:5900', 'B')
+    b = PipeStats('localhost:5900', 'C')
+    c = PipeStats('localhost:22', 'B')
+    for stats in (a, b, c):
+      traffic.open(stats)
+      stats.source_to_sink.record(10, 5)
+
+    traffic.close(c)
+    traffic.close(c)                        # Closing twice counts once
+
+    report = traffic.report()
+    self.assertEqual(len(report['pipes']), 2)
+    self.assertEqual(report['routes']['localhost:5900']['pipes'], 2)
+    self.assertEqual(report['routes']['localhost:5900']['source_to_sink']['buffered'], 10)
+    self.assertEqual(report['routes']['localhost:22']['closed'], 1)
+    self.assertEqual(report['peers']['B']['source_to_sink']['bytes'], 20)
+    self.assertEqual(report['peers']['B']['source_to_sink']['messages'], 2)
+
+  def test_history(self):
+    traffic = Traffic(1, history=3)
+    stats = PipeStats('localhost:5900')
+    traffic.open(stats)
+
+    for i in xrange(5):
+      traffic.stamp = time.time() - 1
+      stats.sink_to_source.record(1000, 0)
+      traffic.sample()
+
+    self.assertAlmostEqual(stats.sink_to_source.rate, 1000, -1)
+
+    route = traffic.report()['routes']['localhost:5900']
+    self.assertEqual(len(route['history']), 3)
+    self.assertAlmostEqual(route['sink_to_source']['rate'], 1000, -1)
+    self.assertEqual(route['source_to_sink']['rate'], 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+import unittest
+import socket
+import threading
+import struct
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib import rfb
+from mifcholib.broadcast import Broadcast, Broadcasts
+from mifcholib.connection import Connection
+
+W, H = 4, 2
+
+class Registry:
+
+  def __init__(self):
+    self.removed = []
+
+  def remove(self, broadcast, abandoned=False):
+    self.removed.append(broadcast)
+    broadcast.stop()
+
+def update(x, y, w, h, pixels):
+  return rfb.framebufferUpdate([rfb.Rectangle(x, y, w, h, pixels)])
+
+def screen(pixels):
+  return update(0, 0, W, H, pixels)
+
+def wait_for(condition, timeout=5):
+  """Polls condition until it holds, False when it did not in time."""
+  deadline = time.time() + timeout
+  while not condition():
+    if time.time() > deadline:
+      return False
+    time.sleep(0.01)
+  return True
+
+def handshake(bpp=32):
+  return ''.join([
+    rfb.protocolVersion(),
+    rfb.securityTypes([1]),
+    rfb.securityResult(True),
+    rfb.serverInit(W, H, rfb.pixelFormat(bpp, 24, 0, 1, 255, 255, 255, 16, 8, 0), 'desktop')
+  ])
+
+class TestBroadcast(unittest.TestCase):
+
+  def setUp(self):
+    (self.server, client) = socket.socketpair()
+    self.server.sendall(handshake())
+
+    self.registry = Registry()
+    self.broadcast = Broadcast(self.registry, (('localhost', 5900), None), Connection(client))
+    self.broadcast.handshake()
+    self.broadcast.start()
+
+  def tearDown(self):
+    self.server.close()
+    self.broadcast.join(2)
+
+  def viewer(self):
+    v = self.broadcast.attach()
+    self.assertEqual(v.recv(4096), rfb.protocolVersion())
+    v.sendall(rfb.protocolVersion() + '\x01' + '\x01')
+    return v
+
+  def test_late_joiner(self):
+    a = self.viewer()
+    self.assertEqual(a.recv(4096), ''.join([
+      rfb.securityTypes([1]),
+      rfb.securityResult(True),
+      rfb.serverInit(W, H, rfb.pixelFormat(32, 24, 0, 1, 255, 255, 255, 16, 8, 0), 'desktop'),
+      screen('d' * W*H*4)                   # Nothing painted yet
+    ]))
+
+    self.server.sendall(update(0, 0, 2, 1, 'AAAABBBB'))
+    self.assertEqual(a.recv(4096), update(0, 0, 2, 1, 'AAAABBBB'))   # Whole, once parsed
+
+    b = self.viewer()
+    self.assertTrue(b.recv(4096).endswith(screen('AAAABBBB' + 'd' * 24)))
+
+    b.close()
+    a.close()
+    self.assertEqual(self.registry.removed, [self.broadcast])
+
+  def test_slow_viewer(self):
+    self.broadcast.backlog = 64
+    a = self.viewer()
+    a.recv(4096)
+
+    for pixels in ['AAAABBBB', 'CCCCDDDD', 'EEEEFFFF']:
+      self.server.sendall(update(0, 0, 2, 1, pixels))
+    self.assertTrue(wait_for(lambda: a.frame))  # Replaced by the third
+
+    self.assertEqual(a.recv(4096), screen('EEEEFFFF' + 'd' * 24))
+
+  def test_backlog_below_screen(self):
+    self.broadcast.backlog = 32             # Less than the screen queued for a joiner
+    a = self.viewer()
+
+    self.server.sendall(update(0, 0, 2, 1, 'AAAABBBB'))
+    self.assertTrue(wait_for(lambda: a.behind()))
+
+    self.assertTrue(a.recv(4096).endswith(screen('d' * W*H*4) + update(0, 0, 2, 1, 'AAAABBBB')))
+
+  def test_exclusive_control(self):
+    self.broadcast.exclusive = True
+    a = self.viewer()
+    b = self.viewer()
+
+    b.sendall(rfb.keyEvent(1, struct.pack('!I', 98)))
+    a.sendall(rfb.keyEvent(1, struct.pack('!I', 97)))
+    a.close()
+    b.sendall(rfb.keyEvent(1, struct.pack('!I', 99)))
+
+    expected = rfb.keyEvent(1, struct.pack('!I', 97)) + rfb.keyEvent(1, struct.pack('!I', 99))
+    received = ''
+    self.server.settimeout(5)
+    while not received.endswith(expected):  # Forwarded as sent, times out otherwise
+      received += self.server.recv(65536)
+    self.assertFalse(rfb.keyEvent(1, struct.pack('!I', 98)) in received)
+
+class TestPixelFormat(unittest.TestCase):
+
+  def setUp(self):
+    (self.server, client) = socket.socketpair()
+    self.server.sendall(handshake(16))
+
+    self.broadcast = Broadcast(Registry(), (('localhost', 5900), None), Connection(client))
+    self.broadcast.handshake()
+
+  def tearDown(self):
+    self.server.close()
+    self.broadcast.stop()
+
+  def test_server_format(self):
+    self.server.settimeout(5)
+    received = self.server.recv(65536)
+    self.assertTrue(rfb.setPixForm(32, 24, 0, 1, 255, 255, 255, 16, 8, 0) in received)
+    self.assertEqual(self.broadcast.rfb_state.framebuffer.bypp, 4)
+    self.assertEqual(self.broadcast.server_init(), rfb.serverInit(W, H, rfb.PIXEL_FORMAT, 'desktop'))
+
+  def test_viewer_format(self):
+    v = self.broadcast.attach()
+    v.sendall(rfb.protocolVersion() + '\x01' + '\x01')
+    v.sendall(rfb.setPixForm(32, 24, 0, 1, 255, 255, 255, 16, 8, 0))
+    self.assertRaises(socket.error, v.sendall, rfb.setPixForm(16, 16, 0, 1, 31, 63, 31, 11, 5, 0))
+
+class CM:
+  """Connects to a socketpair per address, the server ends are kept."""
+
+  def __init__(self):
+    self.servers = {}
+    self.torn = []
+
+  def connect(self, address, peer_id=None):
+    (self.servers[address], client) = socket.socketpair()
+    return Connection(client)
+
+  def teardown(self, conn):
+    self.torn.append(conn)
+    conn.close()
+
+class TestBroadcasts(unittest.TestCase):
+
+  def setUp(self):
+    self.cm = CM()
+    self.broadcasts = Broadcasts(self.cm)
+    self.broadcasts.handshake_timeout = 0.5
+
+  def tearDown(self):
+    self.broadcasts.stop()
+    for server in self.cm.servers.values():
+      server.close()
+
+  def test_silent_server(self):
+    silent = []
+    t = threading.Thread(target=lambda: silent.append(self.broadcasts.viewer(('silent', 5900))))
+    t.start()
+    self.assertTrue(wait_for(lambda: ('silent', 5900) in self.cm.servers))
+
+    self.cm.connect = lambda address, peer_id=None: Connection(self.server(address))
+    v = self.broadcasts.viewer(('desktop', 5900))   # Not held up by the silent one
+    self.assertTrue(v is not None)
+    self.assertTrue(t.is_alive())
+
+    t.join(5)
+    self.assertEqual(silent, [None])
+    self.assertEqual(len(self.cm.torn), 1)
+    self.assertEqual(self.broadcasts.connecting, {})
+    v.close()
+
+  def test_joined_while_leaving(self):
+    self.cm.connect = lambda address, peer_id=None: Connection(self.server(address))
+    a = self.broadcasts.viewer(('desktop', 5900))
+    broadcast = a.broadcast
+    b = self.broadcasts.viewer(('desktop', 5900))
+    self.assertTrue(b.broadcast is broadcast)
+
+    self.broadcasts.remove(broadcast, abandoned=True)   # As by a leaving a, b attached since
+    self.assertTrue(self.broadcasts.active.values() == [broadcast] and not broadcast.done)
+
+    a.close()
+    b.close()
+    self.assertEqual(self.broadcasts.active, {})
+    broadcast.join(2)
+    self.assertTrue(broadcast.done)
+
+  def server(self, address):
+    (server, client) = socket.socketpair()
+    server.sendall(handshake())
+    self.cm.servers[address] = server
+    return client
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+import unittest
+import socket
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.connection import Connection
+from mifcholib.compression import DeflateConnection, negotiate
+
+def pair(**kwargs):
+  (a, b) = socket.socketpair()
+  return (DeflateConnection(Connection(a), **kwargs), DeflateConnection(Connection(b), **kwargs))
+
+class TestCompression(unittest.TestCase):
+
+  def test_negotiate(self):
+    self.assertEqual(negotiate('deflate', True), 'deflate')
+    self.assertEqual(negotiate('deflate', False), 'none')
+    self.assertEqual(negotiate(None, True), 'none')
+
+  def test_round_trip(self):
+    (a, b) = pair()
+    messages = ['hello', 'x' * 4096, 'hello again']
+    for m in messages:
+      a.sendall(m)
+      self.assertEqual(b.recv(4096), m)   # Each message is readable on its own
+
+    b.sendall('reply')
+    self.assertEqual(a.recv(4096), 'reply')
+
+    report = a.report()
+    self.assertEqual(report['sent']['plain'], sum(len(m) for m in messages))
+    self.assertTrue(report['sent']['ratio'] < 0.5)
+    self.assertEqual(report['received']['plain'], 5)
+
+    a.close()
+    self.assertEqual(b.recv(4096), '')
+
+  def test_switches_off(self):
+    (a, b) = pair(window=8192, probe=16384)
+    data = [os.urandom(4096) for i in xrange(6)]
+    for d in data:
+      a.sendall(d)
+      self.assertEqual(b.recv(4096), d)
+
+    self.assertEqual(a.switched, 1)
+    self.assertTrue(a.enabled)              # Probing again after 16384 raw bytes
+    self.assertTrue(a.report()['sent']['ratio'] < 1.01)
+
+if __name__ == '__main__':
+  unittest.main()
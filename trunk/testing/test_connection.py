@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import unittest
+import socket
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.connection import Connection
+import mifcholib.messages as messages
+
+class TestBufferedConnection(unittest.TestCase):
+  
+  def setUp(self):
+    (self.a, b) = socket.socketpair()
+    self.conn = Connection(b)
+  
+  def tearDown(self):
+    self.a.close()
+    self.conn.close()
+  
+  def test_readline_split(self):
+    self.conn.buffer_size = 3           # Terminator split across reads
+    self.a.sendall('GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+    self.assertEqual(self.conn.readline(), 'GET / HTTP/1.1\r\n')
+    self.assertEqual(self.conn.readline(), 'Host: x\r\n')
+    self.assertEqual(self.conn.readline(), '\r\n')
+  
+  def test_readline_eof(self):
+    self.a.sendall('partial')
+    self.a.close()
+    self.assertEqual(self.conn.readline(), 'partial')
+    self.assertEqual(self.conn.readline(), '')
+  
+  def test_request_and_body(self):
+    self.a.sendall('POST /hobs/session/1/2 HTTP/1.1\r\nContent-Length: 5\r\n\r\nhelloRFB 003.008\n')
+    (method, uri, version, headers) = messages.get_request(self.conn)
+    self.assertEqual((method, uri, version), ('POST', '/hobs/session/1/2', 'HTTP/1.1'))
+    self.assertEqual(headers, [('Content-Length', '5')])
+    self.assertEqual(self.conn.read_bytes(5), 'hello')
+    self.assertEqual(self.conn.pending(), 12)
+  
+  def test_handoff(self):
+    self.a.sendall('X-Header: 1\r\nbuffered')
+    self.conn.readline()
+    self.assertEqual(self.conn.recv(3), 'buf')  # Buffered bytes come first
+    buff = bytearray(16)
+    self.assertEqual(self.conn.recv_into(buff), 5)
+    self.assertEqual(str(buff[:5]), 'fered')
+    self.a.sendall('socket')
+    self.assertEqual(self.conn.recv(16), 'socket')
+
+  def test_compaction(self):
+    self.conn.buffer_size = 65536
+    lines = ['line %06d\r\n' % i for i in xrange(20000)]
+    self.a.sendall(''.join(lines[:10000]))
+    self.assertEqual([self.conn.readline() for i in xrange(5000)], lines[:5000])
+    self.a.sendall(''.join(lines[10000:]))
+    self.assertEqual([self.conn.readline() for i in xrange(5000, 20000)], lines[5000:])
+    self.assertTrue(self.conn.rpos <= 65536 + len(lines[0]))  # Consumed bytes are dropped
+    self.assertEqual(self.conn.buffered(), 0)
+
+  def test_head(self):
+    self.conn.append('GET / HTTP/1.1\r\nHost: x\r\n')
+    self.assertEqual(self.conn.head(), None)
+    self.conn.append('\r\nnext')
+    self.assertEqual(self.conn.head(), 'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+    self.conn.readline()
+    self.assertEqual(self.conn.head(), 'Host: x\r\n\r\n')   # From the unread bytes on
+
+if __name__ == '__main__':
+  unittest.main()
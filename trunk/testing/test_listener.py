@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import unittest
+import socket
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.connection import Connection
+from mifcholib.listener import Incoming, MAX_BODY
+import mifcholib.dispatchers as dispatchers
+
+class Dispatcher:
+  reads_head = True
+
+class CM:
+
+  def __init__(self, port):
+    self.routing_map = {port: {'dispatcher': Dispatcher()}}
+    self.torn = []
+
+  def teardown(self, conn):
+    self.torn.append(conn)
+    conn.close()
+
+class TestLargeBody(unittest.TestCase):
+
+  def setUp(self):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    self.client = socket.create_connection(server.getsockname())
+    (s, address) = server.accept()
+    server.close()
+
+    self.cm   = CM(s.getsockname()[1])
+    self.conn = Connection(s)
+    self.head = 'POST /hobs HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (MAX_BODY + 10)
+
+  def tearDown(self):
+    self.client.close()
+    self.conn.close()
+
+  def test_read_ahead(self):
+    self.client.sendall(self.head + 'x' * MAX_BODY)
+    while self.conn.buffered() < len(self.head) + MAX_BODY:
+      self.conn.append(self.conn.s.recv(65536))
+
+    incoming = Incoming(self.cm, self.conn, ('127.0.0.1', 1))
+    self.assertEqual(incoming.needed, len(self.head) + MAX_BODY)   # The rest is not waited for
+    self.assertTrue(incoming.ready())
+
+  def test_read_body(self):
+    self.client.sendall('x' * 20 + 'GET')
+    env = {'mifcho.conn': self.conn, 'wsgi.input': 'x' * 10, 'mifcho.body_pending': 20}
+    self.assertTrue(dispatchers.read_body(self.cm, env))
+    self.assertEqual((env['wsgi.input'], env['mifcho.body_pending']), ('x' * 30, 0))
+    self.assertEqual(self.conn.recv(16), 'GET')                     # The next request
+
+  def test_client_left(self):
+    self.client.sendall('x' * 5)
+    self.client.close()
+    env = {'mifcho.conn': self.conn, 'wsgi.input': '', 'mifcho.body_pending': 20}
+    self.assertFalse(dispatchers.read_body(self.cm, env))
+    self.assertEqual(self.cm.torn, [self.conn])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import unittest
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.longpoll import WaiterTable
+
+class TestWaiterTable(unittest.TestCase):
+  
+  def setUp(self):
+    self.woken = []
+    self.table = WaiterTable('test', self.woken.append)
+    self.table.start()
+  
+  def tearDown(self):
+    self.table.stop()
+  
+  def test_pending_data(self):
+    self.table.put('a', 'x')
+    self.table.put('a', 'y')
+    self.assertFalse(self.table.park('a', {}, 10))
+    self.assertEqual(self.table.take('a'), 'xy')
+    self.assertEqual(self.table.take('a'), '')
+  
+  def test_woken_by_data(self):
+    poll = {'id': 1}
+    self.assertTrue(self.table.park('a', poll, 10))
+    self.table.put('b', 'other')
+    self.assertEqual(self.woken, [])
+    
+    self.table.put('a', 'x')
+    self.assertEqual(self.woken, [poll])
+    self.assertTrue('mifcho.woken' in poll)
+    self.assertEqual(self.table.take('a'), 'x')
+  
+  def test_expires(self):
+    late  = {'id': 'late'}
+    early = {'id': 'early'}
+    self.table.park('a', late, 0.6)
+    self.table.park('b', early, 0.2)
+    
+    time.sleep(0.4)
+    self.assertEqual(self.woken, [early])
+    time.sleep(0.4)
+    self.assertEqual(self.woken, [early, late])
+    self.assertEqual(self.table.parked, {})
+  
+  def test_superseded(self):
+    first = {'id': 1}
+    self.table.park('a', first, 10)
+    self.table.park('a', {'id': 2}, 10)
+    self.assertEqual(self.woken, [first])
+
+  def test_discard(self):
+    poll = {'id': 1}
+    self.table.put('a', 'x')
+    self.table.discard('a')
+    self.assertTrue(self.table.park('a', poll, 10))
+    self.table.discard('a')
+    self.assertEqual(self.woken, [poll])
+    self.assertEqual((self.table.pending, self.table.sizes, self.table.parked), ({}, {}, {}))
+
+  def test_max_pending(self):
+    self.table.max_pending = 4
+    self.assertTrue(self.table.put('a', 'xxx'))
+    self.assertFalse(self.table.put('a', 'yy'))   # Not polled, refused
+    self.assertTrue(self.table.put('b', 'yy'))
+    self.assertEqual(self.table.take('a'), 'xxx')
+    self.assertTrue(self.table.put('a', 'yy'))
+
+if __name__ == '__main__':
+  unittest.main()
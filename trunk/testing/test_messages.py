@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import unittest
+import socket
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.connection import Connection
+import mifcholib.messages as messages
+
+class CountingConnection:
+  """Records every write."""
+  
+  def __init__(self):
+    self.writes = []
+  
+  def sendall(self, data):
+    self.writes.append(data)
+
+class TestSingleWrite(unittest.TestCase):
+  
+  def test_response(self):
+    c = CountingConnection()
+    messages.send_response(c, 200, 'OK', 'HTTP/1.1', [
+      ('Content-Length', 5),
+      ('Content-Type', 'text/plain')
+    ], 'hello')
+    self.assertEqual(c.writes, [
+      'HTTP/1.1 200 OK\r\nContent-Length: 5\r\nContent-Type: text/plain\r\n\r\nhello'
+    ])
+  
+  def test_request(self):
+    c = CountingConnection()
+    messages.send_request(c, 'POST', '/mifcho/tunnel', headers=[('X-Mifcho-Id', 'A')])
+    self.assertEqual(c.writes, [
+      'POST /mifcho/tunnel HTTP/1.1\r\nHost: localhost:8080\r\nX-Mifcho-Id: A\r\n\r\n'
+    ])
+  
+  def test_large_body(self):
+    c = CountingConnection()
+    body = 'x' * (messages.inline_body+1)
+    messages.send_response(c, 200, 'OK', 'HTTP/1.1', [], body)
+    self.assertEqual(c.writes, ['HTTP/1.1 200 OK\r\n\r\n', body])
+  
+  def test_templates(self):
+    self.assertEqual(
+      messages.TUNNEL_REQUEST.format('A', 'localhost', 22, 'deflate'),
+      messages.format_request('POST', '/mifcho/tunnel', headers=[
+        ('X-Mifcho-Id', 'A'),
+        ('X-Mifcho-Tunnel-EndpointHost', 'localhost'),
+        ('X-Mifcho-Tunnel-EndpointPort', 22),
+        ('X-Mifcho-Tunnel-Compression', 'deflate')
+      ])
+    )
+    self.assertEqual(
+      messages.SWITCHING_PROTOCOLS.format('B', 'none'),
+      messages.format_response(101, 'Switching Protocols', headers=[
+        ('X-Mifcho-Id', 'B'),
+        ('X-Mifcho-Tunnel-Compression', 'none')
+      ])
+    )
+  
+  def test_roundtrip(self):
+    (a, b) = socket.socketpair()
+    conn = Connection(b)
+    messages.TUNNEL_CALLBACK_REQUEST.send(a, 'A', 't1', 'host', 80, 'none')
+    (method, uri, version, headers) = messages.get_request(conn)
+    self.assertEqual((method, uri), ('POST', '/mifcho/tunnel_request'))
+    self.assertEqual(dict(headers)['X-Mifcho-Tunnel-EndpointPort'], '80')
+    a.close()
+    conn.close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mifcholib.metrics as metrics
+
+class TestMetrics(unittest.TestCase):
+  
+  def test_registry(self):
+    c = metrics.counter('test_registry_total', 'Test.', ('port',))
+    self.assertTrue(metrics.counter('test_registry_total', 'Test.') is c)
+    c.inc(labels=(80,))
+    c.inc(2, labels=(80,))
+    c.inc(labels=(443,))
+    self.assertEqual(c.samples(), [((80,), 3), ((443,), 1)])
+  
+  def test_gauge(self):
+    g = metrics.gauge('test_gauge', 'Test.')
+    g.inc(5)
+    g.dec(2)
+    self.assertEqual(g.samples(), [((), 3)])
+    g.remove()
+    self.assertEqual(g.samples(), [])
+  
+  def test_histogram(self):
+    h = metrics.histogram('test_histogram_seconds', 'Test.', buckets=(1, 2, 3, 4))
+    for v in [0.5, 1.5, 1.5, 2.5, 10]:
+      h.observe(v)
+    ((labels, (counts, total, count)),) = h.samples()
+    self.assertEqual(counts, [1, 2, 1, 0, 1])
+    self.assertEqual(count, 5)
+    self.assertAlmostEqual(total, 16.0)
+    self.assertAlmostEqual(h.quantile(0.5, counts), 1.75)
+    
+    sample = metrics.report()['test_histogram_seconds']['samples'][0]
+    self.assertEqual(sample['count'], 5)
+    self.assertAlmostEqual(sample['avg'], 3.2)
+
+  def test_exposition(self):
+    c = metrics.counter('test_exposition_total', 'Test.', ('peer',))
+    c.inc(3, labels=('a"b',))
+    self.assertEqual(c.exposition(), [
+      '# HELP test_exposition_total Test.',
+      '# TYPE test_exposition_total counter',
+      'test_exposition_total{peer="a\\"b"} 3'
+    ])
+
+    h = metrics.histogram('test_exposition_seconds', 'Test.', ('port',), buckets=(0.5, 1.0))
+    for v in [0.25, 0.75, 2]:
+      h.observe(v, labels=(80,))
+    self.assertEqual(h.exposition()[2:], [
+      'test_exposition_seconds_bucket{port="80",le="0.5"} 1',
+      'test_exposition_seconds_bucket{port="80",le="1.0"} 2',
+      'test_exposition_seconds_bucket{port="80",le="+Inf"} 3',
+      'test_exposition_seconds_sum{port="80"} 3.0',
+      'test_exposition_seconds_count{port="80"} 3'
+    ])
+
+    text = metrics.exposition()
+    self.assertTrue(text.endswith('\n'))
+    self.assertTrue('# TYPE test_exposition_seconds histogram\n' in text)
+
+if __name__ == '__main__':
+  unittest.main()
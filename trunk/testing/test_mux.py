@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+import unittest
+import socket
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.accounting import Traffic
+from mifcholib.connection import Connection
+from mifcholib.mux import Carrier, Stream, HEADER, OPEN, WINDOW, DATA
+from mifcholib.reactor import ReactorPool
+
+class CM:
+  """What carriers and pipes use of a connection-manager, piping on reactors."""
+
+  def __init__(self, endpoint):
+    self.endpoint = endpoint
+    self.reactors = ReactorPool(1)
+    self.traffic  = Traffic()
+    self.pipes    = []
+    self.opened   = []
+
+  def connect(self, address, peer_id=None, use_tls=False):
+    return Connection(self.endpoint)
+
+  def pick_reactor(self):
+    return self.reactors.pick()
+
+  def teardown(self, conn):
+    try:
+      conn.shutdown()
+      conn.close()
+    except:
+      pass
+
+class Peer:
+  id      = 'B'
+  carrier = None
+
+class TestMux(unittest.TestCase):
+
+  def setUp(self):
+    (self.endpoint, theirs) = socket.socketpair()
+    self.endpoint.settimeout(5)
+    self.cm = CM(theirs)
+    self.cm.reactors.start()
+
+    (a, b) = socket.socketpair()
+    self.opener   = Carrier(self.cm, Connection(a), Peer(), True)
+    self.acceptor = Carrier(self.cm, Connection(b), Peer(), False)
+    for carrier in [self.opener, self.acceptor]:
+      carrier.start()
+
+  def tearDown(self):
+    for pipe in self.cm.pipes:
+      pipe.stop()
+      pipe.join(2)
+    for carrier in [self.opener, self.acceptor]:
+      carrier.stop()
+      carrier.join(2)
+    self.cm.reactors.stop()
+    self.cm.reactors.join()
+    self.endpoint.close()
+
+  def test_pipe_on_reactors(self):
+    stream = self.opener.open(('localhost', 5900), timeout=5)
+    self.assertTrue(stream is not None)
+
+    deadline = time.time() + 5
+    while not self.cm.pipes and time.time() < deadline:
+      time.sleep(0.01)                      # Appended after OPEN_OK is sent
+    pipe = self.cm.pipes[0]
+    self.assertFalse(pipe.reactive())       # The stream end has no descriptor
+    self.assertEqual(pipe.reactor, None)
+
+    stream.settimeout(5)
+    stream.sendall('ping')
+    self.assertEqual(self.endpoint.recv(16), 'ping')
+    self.endpoint.sendall('pong')
+    self.assertEqual(stream.recv(16), 'pong')
+
+class TestBadFrames(unittest.TestCase):
+
+  def setUp(self):
+    (self.raw, theirs) = socket.socketpair()
+    self.cm = CM(None)
+    self.peer = Peer()
+    self.carrier = Carrier(self.cm, Connection(theirs), self.peer, False)
+    self.peer.carrier = self.carrier
+    self.stream = Stream(self.carrier, 1, ('localhost', 5900))
+    self.carrier.streams[self.stream.id] = self.stream
+    self.carrier.start()
+
+  def tearDown(self):
+    self.carrier.stop()
+    self.raw.close()
+
+  def assertDropped(self):
+    self.carrier.join(5)
+    self.assertFalse(self.carrier.is_alive())
+    self.assertTrue(self.peer.carrier is None)
+    self.assertEqual(self.carrier.streams, {})
+    self.assertTrue(self.stream.closed)
+
+  def test_bad_open(self):
+    self.raw.sendall(HEADER.pack(OPEN, 2, 9) + 'localhost')          # No port
+    self.assertDropped()
+
+  def test_short_window(self):
+    self.raw.sendall(HEADER.pack(WINDOW, self.stream.id, 1) + 'x')
+    self.assertDropped()
+
+  def test_cut_short(self):
+    self.raw.sendall(HEADER.pack(DATA, self.stream.id, 10) + 'abc')
+    self.raw.shutdown(socket.SHUT_WR)
+    self.assertDropped()
+    self.assertRaises(socket.error, self.stream.recv, 16)            # Nothing fed, broken
+
+if __name__ == '__main__':
+  unittest.main()
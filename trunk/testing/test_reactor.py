@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import unittest
+import threading
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.reactor import Reactor
+
+class TestTimers(unittest.TestCase):
+
+  def setUp(self):
+    self.reactor = Reactor()
+    self.reactor.start()
+    self.called = []
+
+    running = threading.Event()             # Before stop() in tearDown
+    self.reactor.call_soon(running.set)
+    self.assertTrue(running.wait(5))
+
+  def tearDown(self):
+    self.reactor.stop()
+    self.reactor.join(2)
+
+  def test_cancel(self):
+    fired = threading.Event()
+    self.reactor.call_later(0.1, self.called.append, 'cancelled').cancel()
+    self.reactor.call_later(0.2, fired.set)
+
+    self.assertTrue(fired.wait(5))
+    self.assertEqual(self.called, [])
+    self.assertEqual((self.reactor.timers, self.reactor.cancelled), ([], 0))
+
+  def test_cancel_after_run(self):
+    fired = threading.Event()
+    timer = self.reactor.call_later(0, fired.set)
+    self.assertTrue(fired.wait(5))
+    timer.cancel()                          # Nothing left to drop
+    self.assertEqual(self.reactor.cancelled, 0)
+
+  def test_compaction(self):
+    timers = [self.reactor.call_later(60, self.called.append, i) for i in xrange(200)]
+    for timer in timers[:150]:
+      timer.cancel()
+
+    self.assertTrue(len(self.reactor.timers) < 150)   # Rebuilt without most cancelled ones
+    self.assertEqual(
+      len([t for t in self.reactor.timers if t[2].fun is not None]), 50
+    )
+    self.assertEqual(len(self.reactor.timers) - 50, self.reactor.cancelled)
+
+if __name__ == '__main__':
+  unittest.main()
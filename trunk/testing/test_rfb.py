@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Equivalence of RFBStatemachine, a session is fed in chunks of various
+sizes, like a Piper does, and the bytes released, the states and the
+message progress after every chunk must stay the same. The digests were
+recorded with the recursive implementation.
+"""
+import unittest
+import hashlib
+import logging
+import struct
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib import rfb
+
+SERVER_NAME = 'secret.example.org'
+
+def server_stream():
+  return ''.join([
+    rfb.protocolVersion(),
+    rfb.securityTypes([1]),
+    rfb.securityResult(True),
+    rfb.serverInit(4, 2, rfb.pixelFormat(32, 24, 0, 1, 255, 255, 255, 16, 8, 0), SERVER_NAME),
+    struct.pack('!BBH', 0, 0, 3),                 # Framebuffer update of 3 rectangles
+    rfb.rectangleHeader(0, 0, 2, 1, 0) + 'R' * 8, # Raw
+    rfb.rectangleHeader(1, 1, 0, 0, -232),        # Pointer position
+    rfb.rectangleHeader(0, 0, 2, 2, -239) + 'C' * 16 + 'M' * 2,   # Cursor
+    rfb.bell(),
+    rfb.serverCutText('cut and paste'),
+    struct.pack('!BBH', 0, 0, 0),                 # Empty framebuffer update
+    struct.pack('!BBH', 0, 0, 1),
+    rfb.rectangleHeader(0, 0, 4, 2, 0) + 'P' * 32
+  ])
+
+def client_stream():
+  return ''.join([
+    rfb.protocolVersion(),
+    rfb.securityType(1),
+    rfb.clientInit(1),
+    rfb.setPixForm(32, 24, 0, 1, 255, 255, 255, 16, 8, 0),
+    rfb.setEncodings([5, 16, 0, 1, -239]),
+    rfb.framebufferUpdateRequest(1, 0, 0, 4, 2),
+    rfb.keyEvent(1, struct.pack('!I', 0xff0d)),
+    rfb.pointerEvent(1, 2, 1),
+    struct.pack('!BBBBI', 6, 0, 0, 0, 5) + 'hello',  # Client cut text
+    rfb.framebufferUpdateRequest(0, 0, 0, 4, 2)
+  ])
+
+def progress(sm, direction):
+  """State, and bytes read of the current message, of one direction."""
+
+  if direction == 'srv':
+    return (sm.state, sm.prev_state, sm.srv_cur_msg_bytes, sm.nor)
+  return (sm.cli_state, sm.cli_prev_state, sm.cli_cur_msg_bytes)
+
+def feed(sm, direction, stream, size):
+  """
+  Feed stream in chunks of size, returns the bytes released and a trace
+  of what each call released and the progress after it.
+  """
+
+  parse = sm.from_srv if direction == 'srv' else sm.from_cli
+
+  buff  = bytearray()
+  out   = []
+  trace = []
+  for i in xrange(0, len(stream), size):
+    buff.extend(stream[i:i+size])
+    to_send = parse(buff, len(buff))
+    out.append(str(buff[:to_send]))
+    del buff[:to_send]
+    trace.append((to_send, progress(sm, direction)))
+
+  return (''.join(out), trace)
+
+def digest(direction, stream):
+  """Digest of feeding stream in chunks of the sizes below."""
+
+  h = hashlib.md5()
+  for size in [1, 2, 3, 4, 5, 7, 11, 13, 64, len(stream)]:
+    sm = rfb.RFBStatemachine()
+    (out, trace) = feed(sm, direction, stream, size)
+    h.update(repr((size, out, trace, sorted(sm.server.items()), sorted(sm.client.items()))))
+
+  return h.hexdigest()
+
+class TestRFBStatemachine(unittest.TestCase):
+
+  def anonymized(self, stream):
+    return stream.replace(
+      struct.pack('!I', len(SERVER_NAME)) + SERVER_NAME,
+      struct.pack('!I', len('MiG Desktop')) + 'MiG Desktop'
+    )
+
+  def test_server_whole(self):
+    stream = server_stream()
+    sm = rfb.RFBStatemachine()
+    (out, trace) = feed(sm, 'srv', stream, len(stream))
+
+    self.assertEqual(out, self.anonymized(stream))
+    self.assertEqual(sm.state, rfb.SRV_MSG)
+    self.assertEqual(sm.server['name'], SERVER_NAME)
+    self.assertEqual((sm.server['w'], sm.server['h'], sm.server['bpp']), (4, 2, 32))
+    self.assertEqual(sm.rectangle, {'x': 0, 'y': 0, 'w': 4, 'h': 2, 'enc': 0})
+
+  def test_client_whole(self):
+    stream = client_stream()
+    sm = rfb.RFBStatemachine()
+    (out, trace) = feed(sm, 'cli', stream, len(stream))
+
+    self.assertEqual(out, stream.replace(rfb.setEncodings([5, 16, 0, 1, -239]), rfb.setEncodings([0, 1])))
+    self.assertEqual(sm.cli_state, rfb.CLI_MSG)
+
+  def test_server_chunked(self):
+    self.assertEqual(digest('srv', server_stream()), '7db9b136a1c4e1b413c00d612ff2b07a')
+
+  def test_client_chunked(self):
+    self.assertEqual(digest('cli', client_stream()), '73fcf7acd9f31545aec1c53b5fcb2f1f')
+
+  def test_split_messages(self):             # Copy-rect and colour-map, read when complete
+    sm = rfb.RFBStatemachine()
+    sm.state = rfb.SRV_MSG
+    sm.server['bpp'] = 32
+    stream = ''.join([
+      struct.pack('!BBH', 0, 0, 1),
+      rfb.rectangleHeader(0, 0, 2, 2, 1) + struct.pack('!HH', 1, 1),
+      struct.pack('!BBHH', 1, 0, 0, 2) + struct.pack('!6H', 1, 2, 3, 4, 5, 6),
+      rfb.bell()
+    ])
+    (out, trace) = feed(sm, 'srv', stream, 1)
+    self.assertEqual(out, stream)
+    self.assertEqual(sm.state, rfb.SRV_BELL)
+    self.assertEqual((sm.fc, sm.noc), (0, 2))
+
+  def test_stream_rectangles(self):
+    stream = server_stream()
+    split  = stream.index(SERVER_NAME) + len(SERVER_NAME)   # Handshake is read as a whole
+    for size in [1, 3, 7, 64]:
+      sm = rfb.RFBStatemachine(stream_rectangles=True)
+      (head, _)     = feed(sm, 'srv', stream[:split], split)
+      (out, trace)  = feed(sm, 'srv', stream[split:], size)
+      
+      self.assertEqual(head + out, self.anonymized(stream))
+      self.assertEqual(sm.state, rfb.SRV_MSG)
+      
+      held = [len(stream[split:split+(i+1)*size]) - sum(t[0] for t in trace[:i+1]) for i in xrange(len(trace))]
+      self.assertTrue(max(held) < 12 + size)   # Only message-heads are held back
+  
+  def test_payload_left(self):
+    sm = rfb.RFBStatemachine(stream_rectangles=True)
+    sm.state = rfb.SRV_MSG
+    sm.server['bpp'] = 32
+    
+    buff = bytearray(struct.pack('!BBH', 0, 0, 2) + rfb.rectangleHeader(0, 0, 10, 10, 0) + 'x' * 150)
+    self.assertEqual(sm.from_srv(buff, len(buff)), len(buff))
+    self.assertEqual(sm.payload_left(), 250)
+    
+    buff = bytearray('x' * 250 + rfb.rectangleHeader(0, 0, 8, 2, -239) + 'c' * 10)
+    self.assertEqual(sm.from_srv(buff, len(buff)), len(buff))
+    self.assertEqual(sm.state, rfb.SRV_FBUFFER_ENC_CURSOR)
+    self.assertEqual(sm.payload_left(), 8*2*4 + 2 - 10)
+
+  def test_mirror(self):
+    stream = ''.join([
+      rfb.protocolVersion(),
+      rfb.securityTypes([1]),
+      rfb.securityResult(True),
+      rfb.serverInit(4, 2, rfb.pixelFormat(32, 24, 0, 1, 255, 255, 255, 16, 8, 0), SERVER_NAME),
+      struct.pack('!BBH', 0, 0, 3),
+      rfb.rectangleHeader(0, 0, 2, 1, 0) + 'AAAABBBB',
+      rfb.rectangleHeader(2, 1, 2, 1, 0) + 'CCCCDDDD',
+      rfb.rectangleHeader(0, 1, 2, 1, 1) + struct.pack('!HH', 0, 0)   # Copy of the first
+    ])
+    split = stream.index(SERVER_NAME) + len(SERVER_NAME)
+    for size in [1, 3, 7, 64]:
+      sm = rfb.RFBStatemachine(stream_rectangles=True, mirror=True)
+      feed(sm, 'srv', stream[:split], split)
+      feed(sm, 'srv', stream[split:], size)
+      self.assertEqual(str(sm.framebuffer.pixels), 'AAAABBBB' + 'd' * 8 + 'AAAABBBBCCCCDDDD')
+
+    overlay = rfb.Rectangle(1, 0, 1, 1, 'XXXX')
+    self.assertEqual(
+      sm.framebuffer.update(overlay),
+      rfb.framebufferUpdate([rfb.Rectangle(0, 0, 4, 2, 'AAAAXXXX' + 'd' * 8 + 'AAAABBBBCCCCDDDD')])
+    )
+    self.assertEqual(str(sm.framebuffer.pixels)[4:8], 'BBBB')   # The mirror itself is untouched
+
+  def test_client_pixel_format(self):
+    sm = rfb.RFBStatemachine(stream_rectangles=True, mirror=True)
+    feed(sm, 'srv', ''.join([
+      rfb.protocolVersion(),
+      rfb.securityTypes([1]),
+      rfb.securityResult(True),
+      rfb.serverInit(4, 2, rfb.pixelFormat(32, 24, 0, 1, 255, 255, 255, 16, 8, 0), SERVER_NAME),
+      struct.pack('!BBH', 0, 0, 1),
+      rfb.rectangleHeader(0, 0, 1, 1, 0) + 'AAAA'
+    ]), 64)
+    feed(sm, 'cli', ''.join([
+      rfb.protocolVersion(),
+      rfb.securityType(1),
+      rfb.clientInit(1),
+      rfb.setPixForm(16, 16, 0, 1, 31, 63, 31, 11, 5, 0)
+    ]), 64)
+    self.assertEqual(sm.pixel_format, (16, 16, 0, 1, 31, 63, 31, 11, 5, 0))
+
+    stream = struct.pack('!BBH', 0, 0, 2) + ''.join([
+      rfb.rectangleHeader(0, 0, 2, 1, 0) + 'AABB',  # Two bytes per pixel from now on
+      rfb.rectangleHeader(2, 1, 2, 1, 0) + 'CCDD'
+    ])
+    (out, trace) = feed(sm, 'srv', stream, 3)
+    self.assertEqual(out, stream)
+    self.assertEqual(sm.state, rfb.SRV_MSG)
+    self.assertEqual(str(sm.framebuffer.pixels), 'AABB' + 'dddd' + 'dddd' + 'CCDD')
+
+  def test_debug_logging(self):
+    logging.getLogger().setLevel(logging.DEBUG)
+    try:
+      self.assertEqual(digest('srv', server_stream()), '7db9b136a1c4e1b413c00d612ff2b07a')
+      self.assertEqual(digest('cli', client_stream()), '73fcf7acd9f31545aec1c53b5fcb2f1f')
+    finally:
+      logging.getLogger().setLevel(logging.WARNING)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.routing import RoutingIndex
+
+def entry(criteria, name=None):
+  return {'criteria': criteria, 'instance': name or criteria, 'params': None}
+
+class TestRoutingIndex(unittest.TestCase):
+  
+  def setUp(self):
+    self.index = RoutingIndex([
+      entry('/hobs'),
+      entry('/mifcho'),
+      entry('/mifcho/tunnel'),
+      entry('/static')
+    ])
+  
+  def lookup(self, path):
+    e = self.index.lookup(path)
+    return e['instance'] if e else None
+  
+  def test_longest_prefix(self):
+    self.assertEqual(self.lookup('/mifcho/tunnel_request'), '/mifcho/tunnel')
+    self.assertEqual(self.lookup('/mifcho/handshake/'), '/mifcho')
+    self.assertEqual(self.lookup('/hobs/session/1'), '/hobs')
+  
+  def test_order_independent(self):
+    index = RoutingIndex([entry('/mifcho/tunnel'), entry('/mifcho')])
+    self.assertEqual(index.lookup('/mifcho/tunnel')['instance'], '/mifcho/tunnel')
+    self.assertEqual(index.lookup('/mifcho/park')['instance'], '/mifcho')
+  
+  def test_first_of_duplicates(self):
+    index = RoutingIndex([entry('/a', 'first'), entry('/a', 'second')])
+    self.assertEqual(index.lookup('/a/b')['instance'], 'first')
+  
+  def test_no_match(self):
+    self.assertEqual(self.lookup('/nothing'), None)
+    self.assertEqual(self.lookup(''), None)
+  
+  def test_cache(self):
+    index = RoutingIndex([entry('/a'), entry('/b')], cache_size=4)
+    for path in ['/a/1', '/b/1', '/a/2', '/a/1', '/a/3']:
+      index.lookup(path)
+    self.assertEqual(index.cached(), set(['/a/1', '/a/2', '/a/3']))  # '/b/1' evicted
+    index.add(entry('/a/1'))
+    self.assertEqual(index.cached(), set())                         # Invalidated
+    self.assertEqual(index.lookup('/a/1')['instance'], '/a/1')
+
+if __name__ == '__main__':
+  unittest.main()
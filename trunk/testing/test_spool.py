@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+import unittest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.spool import Budget, Spool, SpoolFull
+
+class TestSpool(unittest.TestCase):
+
+  def test_in_memory(self):
+    budget = Budget(1000)
+    spool = Spool(budget, memory=100, disk=0)
+    spool.write('a' * 60)
+    spool.write('b' * 40)
+    self.assertEqual(budget.memory, 100)
+
+    self.assertRaises(SpoolFull, spool.write, 'c')
+    self.assertEqual(budget.dropped, 1)
+
+    self.assertEqual(''.join(spool.drain()), 'a' * 60 + 'b' * 40)
+    self.assertEqual((len(spool), budget.memory), (0, 0))
+
+  def test_spill_in_order(self):
+    budget = Budget(1000)
+    spool = Spool(budget, memory=10, disk=100, chunk_size=7)
+    data = [chr(ord('a')+i) * 6 for i in xrange(10)]
+    for d in data:
+      spool.write(d)
+    self.assertEqual((spool.in_memory, spool.on_disk), (6, 54))
+    self.assertEqual((budget.memory, budget.disk), (6, 54))
+
+    self.assertEqual(''.join(spool.drain()), ''.join(data))
+    self.assertEqual((budget.memory, budget.disk), (0, 0))
+    self.assertTrue(spool.file is None)
+
+  def test_global_budget(self):
+    budget = Budget(50)
+    a = Spool(budget, memory=40, disk=100)
+    b = Spool(budget, memory=40, disk=100)
+    a.write('a' * 40)
+    b.write('b' * 20)                       # Only 10 bytes left in the budget
+    self.assertEqual((b.in_memory, b.on_disk), (0, 20))
+
+    a.close()
+    b.close()
+    self.assertEqual(budget.report(), {'limit': 50, 'memory': 0, 'disk': 0, 'dropped': 0})
+
+if __name__ == '__main__':
+  unittest.main()
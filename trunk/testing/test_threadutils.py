@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+import threading
+import unittest
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mifcholib.threadutils import WorkerPool
+
+class Pool(WorkerPool):
+
+  def __init__(self, *args, **kwargs):
+
+    self.done = []
+    self.gate = threading.Event()
+    self.finished = threading.Condition()
+
+    WorkerPool.__init__(self, 'TestPool', *args, **kwargs)
+
+  def work(self, job):
+
+    if job == 'block':
+      self.gate.wait()
+
+    self.finished.acquire()
+    self.done.append((job, time.time()))
+    self.finished.notify()
+    self.finished.release()
+
+  def wait_done(self, count, timeout=5):
+
+    deadline = time.time() + timeout
+    self.finished.acquire()
+    while len(self.done) < count and time.time() < deadline:
+      self.finished.wait(0.05)
+    self.finished.release()
+
+def workers(pool):
+  pool.lock.acquire()
+  count = len(pool.instances)
+  pool.lock.release()
+  return count
+
+class TestWorkerPool(unittest.TestCase):
+
+  def test_grows_and_shrinks(self):
+    pool = Pool(4, 1, idle_timeout=0.2)
+    pool.start()
+    time.sleep(0.05)
+    self.assertEqual(workers(pool), 1)
+
+    for i in xrange(6):
+      pool.order('block')
+    self.assertEqual(workers(pool), 4)        # Capped, two jobs are queued
+    self.assertEqual(len(pool.jobs), 2)
+
+    pool.gate.set()
+    pool.wait_done(6)
+    self.assertEqual(len(pool.done), 6)
+
+    time.sleep(0.6)
+    self.assertEqual(workers(pool), 1)        # Idle workers stopped, down to the minimum
+
+    pool.stop()
+    pool.join(2)
+    self.assertFalse(pool.is_alive())
+    self.assertEqual(workers(pool), 0)
+
+  def test_grow_wait(self):
+    pool = Pool(2, 1, grow_wait=0.1)
+    pool.start()
+    time.sleep(0.05)
+
+    pool.order('block')
+    ordered = time.time()
+    pool.order('fast')
+    self.assertEqual(workers(pool), 1)        # Not yet waited long enough
+
+    pool.wait_done(1)
+    self.assertEqual(pool.done[0][0], 'fast')
+    self.assertTrue(pool.done[0][1] - ordered >= 0.1)
+    self.assertEqual(workers(pool), 2)
+
+    pool.gate.set()
+    pool.stop()
+    pool.join(2)
+    self.assertFalse(pool.is_alive())
+
+  def test_handoff_latency(self):
+    pool = Pool(2, 2)
+    pool.start()
+    time.sleep(0.05)
+
+    latencies = []
+    for i in xrange(20):
+      ordered = time.time()
+      pool.order('job-%d' % i)
+      pool.wait_done(i+1)
+      latencies.append(pool.done[-1][1] - ordered)
+
+    self.assertTrue(sorted(latencies)[10] < 0.005)
+
+    pool.stop()
+    pool.join(2)
+    self.assertFalse(pool.is_alive())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import unittest
+import socket
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mifcholib.ws as ws
+
+class TestRFC6455(unittest.TestCase):
+  
+  def setUp(self):
+    (self.client, server) = socket.socketpair()
+    self.stream = ws.FrameStream(server, buffer_size=16)
+  
+  def tearDown(self):
+    self.client.close()
+    self.stream.conn.close()
+  
+  def test_accept_key(self):                  # Example of RFC 6455 section 1.3
+    self.assertEqual(ws.accept_key('dGhlIHNhbXBsZSBub25jZQ=='), 's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+  
+  def test_mask(self):
+    key  = '\x01\x02\x03\x04'
+    data = ''.join(chr(i % 256) for i in range(1001))
+    
+    masked = ws.mask(key, data)
+    self.assertEqual(masked, ''.join(chr(ord(c) ^ ord(key[i % 4])) for (i, c) in enumerate(data)))
+    self.assertEqual(ws.mask(key, masked), data)
+    self.assertEqual(ws.mask(key, '\x00'), '\x01')
+    self.assertEqual(ws.mask(key, ''), '')
+  
+  def test_lengths(self):
+    for length in [0, 125, 126, 65535, 65536, 100000]:
+      payload = 'x' * length
+      self.client.sendall(ws.format_frame(payload, mask_key='abcd'))
+      self.assertEqual(self.stream.receive_message(), payload)
+  
+  def test_frames_in_one_read(self):
+    self.client.sendall(''.join(ws.format_frame(m, mask_key='wxyz') for m in ['a', 'bc', 'def']))
+    self.assertEqual(
+      [self.stream.receive_message() for _ in range(3)],
+      ['a', 'bc', 'def']
+    )
+  
+  def test_fragments_and_ping(self):
+    self.client.sendall(
+      ws.format_frame('frag', ws.OP_BINARY, fin=False, mask_key='1234') +
+      ws.format_frame('hey', ws.OP_PING, mask_key='1234') +
+      ws.format_frame('ment', ws.OP_CONTINUATION, mask_key='1234')
+    )
+    self.assertEqual(self.stream.receive_message(), 'fragment')
+    self.assertEqual(self.client.recv(16), ws.format_frame('hey', ws.OP_PONG))
+  
+  def test_close(self):
+    self.client.sendall(ws.format_frame('\x03\xe8', ws.OP_CLOSE, mask_key='1234'))
+    self.assertRaises(ws.ConnectionTerminatedException, self.stream.receive_message)
+    self.assertEqual(self.client.recv(16), '\x88\x02\x03\xe8')
+  
+  def test_too_large(self):
+    self.stream.max_payload = 10
+    self.client.sendall(ws.format_frame('x' * 11, mask_key='1234'))
+    self.assertRaises(ws.MsgUtilException, self.stream.receive_message)
+
+  def test_fragments_too_large(self):
+    self.stream.max_payload = 10
+    self.client.sendall(
+      ws.format_frame('x' * 6, ws.OP_BINARY, fin=False, mask_key='1234') +
+      ws.format_frame('x' * 6, ws.OP_CONTINUATION, fin=False, mask_key='1234')
+    )
+    self.assertRaises(ws.MsgUtilException, self.stream.receive_message)
+
+  def test_unmasked(self):
+    self.client.sendall(ws.format_frame('unmasked'))
+    self.assertRaises(ws.MsgUtilException, self.stream.receive_message)
+
+if __name__ == '__main__':
+  unittest.main()